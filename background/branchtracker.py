@@ -18,6 +18,8 @@ import sys
 import os
 import time
 import traceback
+import threading
+import Queue
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(sys.argv[0]), "..")))
 
@@ -29,92 +31,145 @@ import configuration
 
 class BranchTracker(background.utils.BackgroundProcess):
     def __init__(self):
-        super(BranchTracker, self).__init__(service=configuration.services.BRANCHTRACKER)
+        service = configuration.services.BRANCHTRACKER
 
-    def update(self, trackedbranch_id, repository_id, local_name, remote, remote_name, forced):
-        repository = gitutils.Repository.fromId(self.db, repository_id)
+        super(BranchTracker, self).__init__(service=service)
+
+        self.__max_workers = service.get("max_workers", 4)
+        self.__fetch_timeout = service.get("fetch_timeout", 600)
+        self.__remote_fetch_timeouts = service.get("remote_fetch_timeouts", {})
+
+        self.__queue = Queue.Queue()
+        self.__finished = threading.Event()
+        self.__lock = threading.Lock()
+        self.__running = set()
+        self.__statistics = {}
+        self.__remote_id_counter = 0
+
+    def getFetchTimeout(self, remote):
+        return self.__remote_fetch_timeouts.get(remote, self.__fetch_timeout)
+
+    def recordDuration(self, remote, operation, duration):
+        self.debug("  %s %s in %.2f seconds" % (operation, remote, duration))
+
+        with self.__lock:
+            statistics = self.__statistics.setdefault(remote, {}).setdefault(operation, [0, 0.0, 0.0])
+            statistics[0] += 1
+            statistics[1] += duration
+            statistics[2] = max(statistics[2], duration)
+
+    def __logStatistics(self):
+        with self.__lock:
+            statistics = self.__statistics
+            self.__statistics = {}
+
+        if not statistics:
+            return
+
+        def total(item):
+            return sum(accumulated for count, accumulated, maximum in item[1].values())
+
+        message = "remote statistics for the last hour (slowest first):"
+
+        for remote, operations in sorted(statistics.items(), key=total, reverse=True):
+            message += "\n  %s:" % remote
+            for operation in ("fetch", "push"):
+                if operation in operations:
+                    count, accumulated, maximum = operations[operation]
+                    message += " %s: %d, avg %.2f s, max %.2f s;" % (operation, count, accumulated / count, maximum)
+
+        self.info(message)
+
+    def update(self, db, repository, remote_id, trackedbranch_id, local_name, remote, remote_name, forced, fetch_error):
+        """Update a single tracked branch (or the tags, if 'local_name' is "*")
+           from 'remote'.  Branches have already been fetched by
+           updateRemote(), into refs/remotes/<remote_id>/, unless that failed
+           with 'fetch_error'.  Returns false if the tracking should be
+           disabled."""
 
         try:
-            remote_id = "t%d" % int((time.time() * 1e6) % 1e9)
+            current = None
+            new = None
+            tags = []
 
-            repository.runRelay("remote", "add", remote_id, remote)
+            if local_name == "*":
+                before = time.time()
+                output = repository.runRelay("fetch", remote, "refs/tags/*:refs/tags/*", include_stderr=True,
+                                             timeout=self.getFetchTimeout(remote))
+                self.recordDuration(remote, "fetch", time.time() - before)
+                for line in output.splitlines():
+                    if "[new tag]" in line:
+                        tags.append(line.rsplit(" ", 1)[-1])
+            else:
+                if fetch_error: raise fetch_error
+                try: current = repository.run("rev-parse", "refs/heads/%s" % local_name).strip()
+                except: pass
+                new = repository.runRelay("rev-parse", "refs/remotes/%s/%s" % (remote_id, remote_name)).strip()
 
-            try:
-                current = None
-                new = None
-                tags = []
+            if current != new or tags:
+                before = time.time()
 
                 if local_name == "*":
-                    output = repository.runRelay("fetch", remote_id, "refs/tags/*:refs/tags/*", include_stderr=True)
-                    for line in output.splitlines():
-                        if "[new tag]" in line:
-                            tags.append(line.rsplit(" ", 1)[-1])
+                    returncode, stdout, stderr = repository.runRelay("push", "--force", "origin", *[("refs/tags/%s" % tag) for tag in tags],
+                                                                     check_errors=False)
                 else:
-                    repository.runRelay("fetch", "--quiet", "--no-tags", remote_id, "refs/heads/%s:refs/remotes/%s/%s" % (remote_name, remote_id, remote_name))
-                    try: current = repository.run("rev-parse", "refs/heads/%s" % local_name).strip()
-                    except: pass
-                    new = repository.runRelay("rev-parse", "refs/remotes/%s/%s" % (remote_id, remote_name)).strip()
+                    returncode, stdout, stderr = repository.runRelay("push", "--force", "origin", "refs/remotes/%s/%s:refs/heads/%s" % (remote_id, remote_name, local_name),
+                                                                     check_errors=False)
+
+                self.recordDuration(remote, "push", time.time() - before)
+
+                stderr = stderr.replace("\x1b[K", "")
 
-                if current != new or tags:
+                if returncode == 0:
                     if local_name == "*":
-                        returncode, stdout, stderr = repository.runRelay("push", "--force", "origin", *[("refs/tags/%s" % tag) for tag in tags],
-                                                                         check_errors=False)
+                        for tag in tags:
+                            self.info("  updated tag: %s" % tag)
+                    elif current:
+                        self.info("  updated branch: %s: %s..%s" % (local_name, current[:8], new[:8]))
                     else:
-                        returncode, stdout, stderr = repository.runRelay("push", "--force", "origin", "refs/remotes/%s/%s:refs/heads/%s" % (remote_id, remote_name, local_name),
-                                                                         check_errors=False)
-
-                    stderr = stderr.replace("\x1b[K", "")
-
-                    if returncode == 0:
-                        if local_name == "*":
-                            for tag in tags:
-                                self.info("  updated tag: %s" % tag)
-                        elif current:
-                            self.info("  updated branch: %s: %s..%s" % (local_name, current[:8], new[:8]))
-                        else:
-                            self.info("  created branch: %s: %s" % (local_name, new[:8]))
-
-                        hook_output = ""
-
-                        for line in stderr.splitlines():
-                            if line.startswith("remote: "):
-                                self.debug("  [hook] " + line[8:])
-                                hook_output += line[8:] + "\n"
-
-                        if local_name != "*":
-                            cursor = self.db.cursor()
-                            cursor.execute("INSERT INTO trackedbranchlog (branch, from_sha1, to_sha1, hook_output, successful) VALUES (%s, %s, %s, %s, %s)",
-                                           (trackedbranch_id, current if current else '0' * 40, new if new else '0' * 40, hook_output, True))
-                            self.db.commit()
+                        self.info("  created branch: %s: %s" % (local_name, new[:8]))
+
+                    hook_output = ""
+
+                    for line in stderr.splitlines():
+                        if line.startswith("remote: "):
+                            self.debug("  [hook] " + line[8:])
+                            hook_output += line[8:] + "\n"
+
+                    if local_name != "*":
+                        cursor = db.cursor()
+                        cursor.execute("INSERT INTO trackedbranchlog (branch, from_sha1, to_sha1, hook_output, successful) VALUES (%s, %s, %s, %s, %s)",
+                                       (trackedbranch_id, current if current else '0' * 40, new if new else '0' * 40, hook_output, True))
+                        db.commit()
+                else:
+                    if local_name == "*":
+                        error = "update of tags from %s failed" % remote
                     else:
-                        if local_name == "*":
-                            error = "update of tags from %s failed" % remote
-                        else:
-                            error = "update of branch %s from %s in %s failed" % (local_name, remote_name, remote)
+                        error = "update of branch %s from %s in %s failed" % (local_name, remote_name, remote)
 
-                        hook_output = ""
+                    hook_output = ""
 
-                        for line in stderr.splitlines():
-                            error += "\n    " + line
-                            if line.startswith("remote: "):
-                                hook_output += line[8:] + "\n"
+                    for line in stderr.splitlines():
+                        error += "\n    " + line
+                        if line.startswith("remote: "):
+                            hook_output += line[8:] + "\n"
 
-                        self.error(error)
+                    self.error(error)
 
-                        cursor = self.db.cursor()
+                    cursor = db.cursor()
 
-                        if local_name != "*":
-                            cursor.execute("""INSERT INTO trackedbranchlog (branch, from_sha1, to_sha1, hook_output, successful)
+                    if local_name != "*":
+                        cursor.execute("""INSERT INTO trackedbranchlog (branch, from_sha1, to_sha1, hook_output, successful)
                                                    VALUES (%s, %s, %s, %s, %s)""",
-                                           (trackedbranch_id, current, new, hook_output, False))
-                            self.db.commit()
+                                       (trackedbranch_id, current, new, hook_output, False))
+                        db.commit()
 
-                        cursor.execute("SELECT uid FROM trackedbranchusers WHERE branch=%s", (trackedbranch_id,))
-                        recipients = [dbutils.User.fromId(self.db, user_id) for (user_id,) in cursor]
+                    cursor.execute("SELECT uid FROM trackedbranchusers WHERE branch=%s", (trackedbranch_id,))
+                    recipients = [dbutils.User.fromId(db, user_id) for (user_id,) in cursor]
 
-                        if local_name == "*":
-                            mailutils.sendMessage(recipients, "%s: update of tags from %s stopped!" % (repository.name, remote),
-                                                  """\
+                    if local_name == "*":
+                        mailutils.sendMessage(recipients, "%s: update of tags from %s stopped!" % (repository.name, remote),
+                                              """\
 The automatic update of tags in
   %s:%s
 from the remote
@@ -126,9 +181,9 @@ Output from Critic's git hook
 -----------------------------
 
 %s""" % (configuration.HOSTNAME, repository.path, remote, hook_output))
-                        else:
-                            mailutils.sendMessage(recipients, "%s: update from %s in %s stopped!" % (local_name, remote_name, remote),
-                                                  """\
+                    else:
+                        mailutils.sendMessage(recipients, "%s: update from %s in %s stopped!" % (local_name, remote_name, remote),
+                                              """\
 The automatic update of the branch '%s' in
   %s:%s
 from the branch '%s' in
@@ -141,13 +196,10 @@ Output from Critic's git hook
 
 %s""" % (local_name, configuration.base.HOSTNAME, repository.path, remote_name, remote, hook_output))
 
-                        # Disable the tracking.
-                        return False
-                else:
-                    self.debug("  fetched %s in %s; no changes" % (remote_name, remote))
-            finally:
-                try: repository.runRelay("remote", "rm", remote_id)
-                except: pass
+                    # Disable the tracking.
+                    return False
+            else:
+                self.debug("  fetched %s in %s; no changes" % (remote_name, remote))
 
             # Everything went well; keep the tracking enabled.
             return True
@@ -170,11 +222,109 @@ Output from Critic's git hook
             # enabled and spam the system administrator(s).
             return True
 
+    def updateRemote(self, db, repository_id, remote, rows):
+        """Update all tracked branches in one repository that track 'remote',
+           fetching all of them with a single 'git fetch'."""
+
+        repository = gitutils.Repository.fromId(db, repository_id)
+
+        with self.__lock:
+            self.__remote_id_counter += 1
+            remote_id = "t%d-%d" % (int((time.time() * 1e6) % 1e9), self.__remote_id_counter)
+
+        def refspec(remote_name):
+            return "refs/heads/%s:refs/remotes/%s/%s" % (remote_name, remote_id, remote_name)
+
+        branches = sorted(set(remote_name for trackedbranch_id, local_name, remote_name, forced, next_at in rows if local_name != "*"))
+        fetch_errors = {}
+
+        if branches:
+            timeout = self.getFetchTimeout(remote)
+            before = time.time()
+
+            try:
+                repository.runRelay("fetch", "--quiet", "--no-tags", remote, *map(refspec, branches), timeout=timeout)
+            except Exception, error:
+                if len(branches) == 1:
+                    fetch_errors[branches[0]] = error
+                else:
+                    # Probably just one of the branches that is missing or
+                    # broken; fetch them one at a time to find out which.
+                    for remote_name in branches:
+                        try: repository.runRelay("fetch", "--quiet", "--no-tags", remote, refspec(remote_name), timeout=timeout)
+                        except Exception, error: fetch_errors[remote_name] = error
+
+            self.recordDuration(remote, "fetch", time.time() - before)
+
+        for trackedbranch_id, local_name, remote_name, forced, next_at in rows:
+            if local_name == "*":
+                self.info("checking tags in %s" % remote)
+            else:
+                self.info("checking %s in %s" % (remote_name, remote))
+
+            cursor = db.cursor()
+
+            if self.update(db, repository, remote_id, trackedbranch_id, local_name, remote, remote_name, forced, fetch_errors.get(remote_name)):
+                cursor.execute("""UPDATE trackedbranches
+                                     SET updating=FALSE
+                                   WHERE id=%s""",
+                               (trackedbranch_id,))
+                self.info("  %s: next scheduled update at %s" % (local_name, next_at))
+            else:
+                cursor.execute("""UPDATE trackedbranches
+                                     SET updating=FALSE,
+                                         disabled=TRUE
+                                   WHERE id=%s""",
+                               (trackedbranch_id,))
+                self.info("  %s: tracking disabled" % local_name)
+
+            db.commit()
+
+        for remote_name in branches:
+            try: repository.runRelay("update-ref", "-d", "refs/remotes/%s/%s" % (remote_id, remote_name))
+            except: pass
+
+    def __worker(self):
+        db = dbutils.Database()
+
+        try:
+            while True:
+                item = self.__queue.get()
+                if item is None: break
+
+                key, rows = item
+
+                try:
+                    self.updateRemote(db, key[0], key[1], rows)
+                except:
+                    self.exception()
+                    try: db.rollback()
+                    except: pass
+                finally:
+                    with self.__lock:
+                        self.__running.discard(key)
+                    self.__finished.set()
+        finally:
+            db.close()
+
     def run(self):
         self.db = dbutils.Database()
 
+        self.register_maintenance(hour=None, minute=0, callback=self.__logStatistics)
+
+        workers = []
+
+        for index in range(self.__max_workers):
+            worker = threading.Thread(target=self.__worker)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
         while not self.terminated:
             self.interrupted = False
+            self.__finished.clear()
+
+            self.run_maintenance()
 
             cursor = self.db.cursor()
             cursor.execute("""SELECT id, repository, local_name, remote, remote_name, forced
@@ -184,73 +334,85 @@ Output from Critic's git hook
                             ORDER BY next ASC NULLS FIRST""")
             rows = cursor.fetchall()
 
+            # Group the branches by repository and remote, so that each remote
+            # is fetched from once, by one worker.  Remotes that are already
+            # being updated are left until that update has finished.
+            groups = {}
+            ordered_keys = []
+            postponed = False
+
+            with self.__lock:
+                running = self.__running.copy()
+
             for trackedbranch_id, repository_id, local_name, remote, remote_name, forced in rows:
-                if local_name == "*":
-                    self.info("checking tags in %s" % remote)
-                else:
-                    self.info("checking %s in %s" % (remote_name, remote))
+                key = (repository_id, remote)
+
+                if key in running:
+                    postponed = True
+                    continue
+
+                if key not in groups:
+                    groups[key] = []
+                    ordered_keys.append(key)
 
                 cursor.execute("""UPDATE trackedbranches
                                      SET previous=NOW(),
                                          next=NOW() + delay,
                                          updating=TRUE
-                                   WHERE repository=%s
-                                     AND local_name=%s
+                                   WHERE id=%s
                                RETURNING next::text""",
-                               (repository_id, local_name))
+                               (trackedbranch_id,))
                 next_at = cursor.fetchone()[0]
 
-                self.db.commit()
-
-                if self.update(trackedbranch_id, repository_id, local_name, remote, remote_name, forced):
-                    cursor.execute("""UPDATE trackedbranches
-                                         SET updating=FALSE
-                                       WHERE repository=%s
-                                         AND local_name=%s""",
-                                   (repository_id, local_name))
-                    self.info("  next scheduled update at %s" % next_at)
-                else:
-                    cursor.execute("""UPDATE trackedbranches
-                                         SET updating=FALSE,
-                                             disabled=TRUE
-                                       WHERE repository=%s
-                                         AND local_name=%s""",
-                                   (repository_id, local_name))
-                    self.info("  tracking disabled")
+                groups[key].append((trackedbranch_id, local_name, remote_name, forced, next_at))
 
-                self.db.commit()
+            self.db.commit()
 
-                if self.terminated: break
+            for key in ordered_keys:
+                with self.__lock:
+                    self.__running.add(key)
+                self.__queue.put((key, groups[key]))
 
             cursor.execute("""SELECT 1
                                 FROM trackedbranches
-                               WHERE NOT disabled
-                                 AND next IS NULL""")
+                               WHERE NOT disabled""")
 
             if not cursor.fetchone():
-                cursor.execute("""SELECT 1
+                self.info("nothing to do; sleeping one hour")
+                delay = 3600
+            else:
+                cursor.execute("""SELECT EXTRACT('epoch' FROM (MIN(next) - NOW()))
                                     FROM trackedbranches
-                                   WHERE NOT disabled""")
+                                   WHERE NOT disabled
+                                     AND NOT updating""")
 
-                if not cursor.fetchone():
-                    self.info("nothing to do; sleeping one hour")
-                    delay = 3600
-                else:
-                    cursor.execute("""SELECT EXTRACT('epoch' FROM (MIN(next) - NOW()))
-                                        FROM trackedbranches
-                                       WHERE NOT disabled""")
+                delay = max(0, int(cursor.fetchone()[0] or 3600))
 
-                    delay = max(0, int(cursor.fetchone()[0] or 0))
+                if postponed or ordered_keys:
+                    # Check again when an update has finished, since branches
+                    # may be waiting for their remote to become available.
+                    self.debug("sleeping %d seconds, or until an update finishes" % delay)
+                elif delay:
+                    self.debug("sleeping %d seconds" % delay)
 
-                    if delay: self.debug("sleeping %d seconds" % delay)
+            self.db.commit()
 
-                if delay:
-                    before = time.time()
-                    time.sleep(delay)
-                    if self.interrupted:
-                        self.debug("sleep interrupted after %.2f seconds" % (time.time() - before))
+            if delay:
+                before = time.time()
 
-            self.db.commit()
+                # Sleep in short steps, so that signals (which are only handled
+                # in the main thread, between steps) are noticed.
+                while not (self.terminated or self.interrupted or self.__finished.is_set()) \
+                        and time.time() - before < delay:
+                    self.__finished.wait(min(1.0, delay - (time.time() - before)))
+
+                if self.interrupted:
+                    self.debug("sleep interrupted after %.2f seconds" % (time.time() - before))
+
+        for worker in workers:
+            self.__queue.put(None)
+        for worker in workers:
+            worker.join()
 
 tracker = BranchTracker()
 tracker.run()
@@ -23,7 +23,7 @@ import configuration
 
 from dbutils import Database
 
-if "--json-job" in sys.argv[1:]:
+if "--json-job" in sys.argv[1:] or "--json-worker" in sys.argv[1:]:
     from resource import getrlimit, setrlimit, RLIMIT_RSS
     from traceback import print_exc
 
@@ -35,22 +35,42 @@ if "--json-job" in sys.argv[1:]:
     from changeset.create import createChangeset
     from textutils import json_decode, json_encode
 
-    request = json_decode(sys.stdin.read())
+    if "--json-worker" in sys.argv[1:]:
+        from background.utils import runJSONWorker
 
-    try:
+        # The database connection, and the repositories (and their 'git
+        # cat-file --batch' processes) cached in it, are kept for the
+        # lifetime of the worker process.
         db = Database()
 
-        createChangeset(db, request)
+        def handleRequest(request):
+            try:
+                createChangeset(db, request)
+                return request
+            except:
+                db.rollback()
+                raise
+
+        runJSONWorker(handleRequest)
 
         db.close()
+    else:
+        request = json_decode(sys.stdin.read())
+
+        try:
+            db = Database()
+
+            createChangeset(db, request)
+
+            db.close()
 
-        sys.stdout.write(json_encode(request))
-    except:
-        print "Request:"
-        print json_encode(request, indent=2)
-        print
+            sys.stdout.write(json_encode(request))
+        except:
+            print "Request:"
+            print json_encode(request, indent=2)
+            print
 
-        print_exc(file=sys.stdout)
+            print_exc(file=sys.stdout)
 else:
     from background.utils import JSONJobServer
 
@@ -65,6 +85,10 @@ else:
             super(ChangesetServer, self).__init__(service=configuration.services.CHANGESET)
 
             self.register_maintenance(hour=2, minute=15, callback=self.__purge)
+            self.register_maintenance(hour=2, minute=45, callback=self.__evictObjects)
+
+        def request_group(self, request):
+            return request["repository_name"]
 
         def request_started(self, job, request):
             super(ChangesetServer, self).request_started(job, request)
@@ -81,6 +105,14 @@ else:
                                  parent_sha1[:8], request["child_sha1"][:8],
                                  request["repository_name"], job.pid))
 
+        def __evictObjects(self):
+            from gitutils import DiskObjectCache
+
+            evicted, total_size = DiskObjectCache.evict()
+
+            if evicted:
+                self.info("evicted %d objects from on-disk object cache; %d bytes remaining" % (evicted, total_size))
+
         def __purge(self):
             db = Database()
             cursor = db.cursor()
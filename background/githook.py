@@ -29,6 +29,8 @@ if "--slave" in sys.argv[1:]:
     import traceback
 
     import index
+    import configuration
+    import background.utils
 
     data = sys.stdin.read()
     request = json_decode(data)
@@ -52,6 +54,14 @@ if "--slave" in sys.argv[1:]:
     user_name = request["user_name"]
     repository_name = request["repository_name"]
 
+    # Changesets and syntax highlighting needed while processing a push are
+    # requested with lower priority than those needed to render pages.
+    # Pushes by the system user are made by the branch tracker.
+    if user_name == configuration.base.SYSTEM_USER_NAME:
+        background.utils.setDefaultPriority(background.utils.PRIORITY_BACKGROUND)
+    else:
+        background.utils.setDefaultPriority(background.utils.PRIORITY_PUSH)
+
     sys.stdout = StringIO.StringIO()
 
     index.init()
@@ -22,17 +22,34 @@ from subprocess import Popen as process
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(sys.argv[0]), "..")))
 
-if "--json-job" in sys.argv[1:]:
-    from syntaxhighlight.generate import generateHighlight
-    from background.utils import json_decode, json_encode
-
-    request = json_decode(sys.stdin.read())
-
-    request["highlighted"] = generateHighlight(repository_path=request["repository_path"],
-                                               sha1=request["sha1"],
-                                               language=request["language"])
-
-    sys.stdout.write(json_encode(request))
+if "--json-job" in sys.argv[1:] or "--json-worker" in sys.argv[1:]:
+    import itertools
+
+    from syntaxhighlight.generate import generateHighlight, generateHighlights
+    from background.utils import json_decode, json_encode, runJSONWorker
+
+    def handleRequest(request):
+        request["highlighted"] = generateHighlight(repository_path=request["repository_path"],
+                                                   sha1=request["sha1"],
+                                                   language=request["language"])
+        return request
+
+    def handleBatch(requests):
+        # The job server batches requests per repository, but handle any
+        # mix by processing each run of requests for the same repository
+        # together.
+        for repository_path, group in itertools.groupby(requests, key=lambda request: request["repository_path"]):
+            group = list(group)
+            highlighted = generateHighlights(repository_path, [(request["sha1"], request["language"]) for request in group])
+
+            for request, request_highlighted in itertools.izip(group, highlighted):
+                request["highlighted"] = request_highlighted
+                yield request
+
+    if "--json-worker" in sys.argv[1:]:
+        runJSONWorker(handleRequest, handleBatch)
+    else:
+        sys.stdout.write(json_encode(handleRequest(json_decode(sys.stdin.read()))))
 else:
     from background.utils import JSONJobServer
     from syntaxhighlight.context import importCodeContexts
@@ -48,6 +65,9 @@ else:
 
             self.register_maintenance(hour=3, minute=15, callback=self.__compact)
 
+        def request_group(self, request):
+            return request["repository_path"]
+
         def request_started(self, job, request):
             super(HighlightServer, self).request_started(job, request)
 
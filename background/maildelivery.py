@@ -18,6 +18,14 @@ import sys
 import os
 import os.path
 import time
+import ast
+import errno
+import select
+import struct
+import threading
+import Queue
+import ctypes
+import ctypes.util
 
 import smtplib
 import email.mime.text
@@ -36,107 +44,266 @@ class User():
         self.email = email
         self.fullname = fullname
 
+def parseMail(data):
+    """Parse the contents of a mail file written by mailutils.queueMail().
+
+       The file contains the repr() of a dictionary whose values are literals
+       or User(...) expressions.  It is parsed as a Python expression, but
+       only those kinds of values are accepted; nothing is evaluated."""
+
+    def convert(node):
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == "User" \
+                and not node.keywords and not node.starargs and not node.kwargs:
+            return User(*map(convert, node.args))
+        elif isinstance(node, ast.Dict):
+            return dict(zip(map(convert, node.keys), map(convert, node.values)))
+        elif isinstance(node, ast.List):
+            return map(convert, node.elts)
+        else:
+            return ast.literal_eval(node)
+
+    return convert(ast.parse(data.strip(), mode="eval").body)
+
+class Inotify(object):
+    """Minimal wrapper around Linux's inotify API, via ctypes."""
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO    = 0x00000080
+
+    def __init__(self, path, mask):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+        self.__fd = libc.inotify_init()
+        if self.__fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init() failed")
+
+        if libc.inotify_add_watch(self.__fd, path, mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.__fd)
+            raise OSError(error, "inotify_add_watch() failed")
+
+    def fileno(self):
+        return self.__fd
+
+    def read(self):
+        """Read the pending events and return the names of the files they were
+           about."""
+
+        data = os.read(self.__fd, 65536)
+        names = []
+        offset = 0
+
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+            offset += struct.calcsize("iIII")
+            names.append(data[offset:offset + length].rstrip("\0"))
+            offset += length
+
+        return names
+
+    def close(self):
+        os.close(self.__fd)
+
 class MailDelivery(PeerServer):
-    def __init__(self):
-        super(MailDelivery, self).__init__(service=configuration.services.MAILDELIVERY)
+    class Connection(object):
+        """One SMTP connection, used by one delivery thread at a time."""
 
-        self.__connection = None
+        def __init__(self, server):
+            self.server = server
+            self.__connection = None
+            self.last_used = 0
 
-        self.register_maintenance(hour=3, minute=45, callback=self.__cleanup)
+        def connected(self):
+            return self.__connection is not None
 
-    def run(self):
-        try:
-            sleeptime = 0
+        def connect(self):
+            if not self.__connection:
+                attempts = 0
 
-            while not self.terminated:
-                self.interrupted = False
+                while True:
+                    try:
+                        if configuration.smtp.USE_SSL:
+                            connection = smtplib.SMTP_SSL()
+                        else:
+                            connection = smtplib.SMTP()
 
-                filenames = os.listdir(configuration.paths.OUTBOX)
-                pending = []
+                        connection.connect(configuration.smtp.HOST, configuration.smtp.PORT)
 
-                for filename in filenames:
-                    if filename.endswith(".txt"):
-                        pending.append("%s/%s" % (configuration.paths.OUTBOX, filename))
+                        if configuration.smtp.USE_STARTTLS:
+                            connection.starttls()
 
-                if pending:
-                    self.__connect()
-                    sleeptime = 0
+                        if configuration.smtp.USERNAME and configuration.smtp.PASSWORD:
+                            connection.login(configuration.smtp.USERNAME, configuration.smtp.PASSWORD)
 
-                    for filename in sorted(pending):
-                        age = time.time() - os.stat(filename).st_ctime
+                        self.__connection = connection
+                        self.server.debug("connected")
+                        break
+                    except:
+                        self.server.error("failed to connect to SMTP server")
 
-                        if age > 60:
-                            self.warning("%s: file created %d seconds ago" % (os.path.basename(filename), age))
+                    attempts += 1
+                    seconds = min(60, 2 ** attempts)
 
-                        lines = open(filename).readlines()
+                    self.server.info("sleeping %d seconds" % seconds)
 
-                        try:
-                            self.__send(**eval(lines[0]))
-                        except:
-                            self.exception()
-                            os.rename(filename, "%s/%s.invalid" % (configuration.paths.OUTBOX, os.path.basename(filename)))
-                            continue
+                    time.sleep(seconds)
 
-                        os.rename(filename, "%s/sent/%s.sent" % (configuration.paths.OUTBOX, os.path.basename(filename)))
-                else:
-                    if sleeptime > 25:
-                        self.__disconnect()
+        def disconnect(self):
+            if self.__connection:
+                try:
+                    self.__connection.quit()
+                    self.server.debug("disconnected")
+                except: pass
 
-                    before = time.time()
-                    timeout = (30 - sleeptime) if self.__connection else self.run_maintenance()
+                self.__connection = None
 
-                    self.debug("sleeping %d seconds" % timeout)
+        def sendmail(self, from_address, to_addresses, message):
+            self.connect()
+            self.__connection.sendmail(from_address, to_addresses, message)
+            self.last_used = time.time()
 
-                    time.sleep(timeout)
+    def __init__(self):
+        service = configuration.services.MAILDELIVERY
 
-                    if self.interrupted:
-                        self.debug("sleep interrupted after %.2f seconds" % (time.time() - before))
+        super(MailDelivery, self).__init__(service=service)
 
-                    sleeptime += (time.time() - before)
-        finally:
-            self.__disconnect()
+        self.__queue = Queue.Queue()
+        self.__queued = set()
+        self.__lock = threading.Lock()
+        self.__connections = [MailDelivery.Connection(self) for index in range(service.get("max_connections", 4))]
+        self.__statistics = { "sent": 0, "failed": 0, "latency": 0.0, "max_latency": 0.0, "max_queued": 0 }
 
-    def __connect(self):
-        if not self.__connection:
-            attempts = 0
+        self.register_maintenance(hour=3, minute=45, callback=self.__cleanup)
+        self.register_maintenance(hour=None, minute=0, callback=self.__logStatistics)
+
+    def run(self):
+        try:
+            inotify = Inotify(configuration.paths.OUTBOX, Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO)
+        except (OSError, AttributeError):
+            self.info("inotify not available; polling %s" % configuration.paths.OUTBOX)
+            inotify = None
+
+        threads = []
+
+        for connection in self.__connections:
+            thread = threading.Thread(target=self.__deliver, args=(connection,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        try:
+            while not self.terminated:
+                self.interrupted = False
+
+                self.__scan()
+
+                timeout = self.run_maintenance() or 86400
+
+                if inotify is None:
+                    # Without inotify, only a SIGHUP from sendPendingMails()
+                    # (or this timeout) triggers a new scan.
+                    timeout = min(timeout, 30)
 
-            while True:
                 try:
-                    if configuration.smtp.USE_SSL:
-                        self.__connection = smtplib.SMTP_SSL()
+                    if inotify is not None:
+                        readable, _, _ = select.select([inotify], [], [], timeout)
+                        if readable: inotify.read()
                     else:
-                        self.__connection = smtplib.SMTP()
+                        time.sleep(timeout)
+                except (select.error, OSError), error:
+                    if error.args[0] != errno.EINTR: raise
+        finally:
+            for thread in threads:
+                self.__queue.put(None)
+            for thread in threads:
+                thread.join()
+            for connection in self.__connections:
+                connection.disconnect()
+            if inotify:
+                inotify.close()
+
+    def __scan(self):
+        filenames = sorted(filename for filename in os.listdir(configuration.paths.OUTBOX) if filename.endswith(".txt"))
+
+        with self.__lock:
+            for filename in filenames:
+                if filename not in self.__queued:
+                    self.__queued.add(filename)
+                    self.__queue.put(filename)
+
+            queued = len(self.__queued)
+            self.__statistics["max_queued"] = max(self.__statistics["max_queued"], queued)
+
+        if filenames:
+            self.debug("%d messages queued" % queued)
+
+    def __deliver(self, connection):
+        while True:
+            try:
+                filename = self.__queue.get(timeout=5)
+            except Queue.Empty:
+                # Close connections that have been idle for a while.
+                if connection.connected() and time.time() - connection.last_used > 25:
+                    connection.disconnect()
+                continue
 
-                    self.__connection.connect(configuration.smtp.HOST, configuration.smtp.PORT)
+            if filename is None:
+                break
 
-                    if configuration.smtp.USE_STARTTLS:
-                        self.__connection.starttls()
+            try:
+                self.__deliverFile(connection, filename)
+            except:
+                self.exception()
+            finally:
+                with self.__lock:
+                    self.__queued.discard(filename)
 
-                    if configuration.smtp.USERNAME and configuration.smtp.PASSWORD:
-                        self.__connection.login(configuration.smtp.USERNAME, configuration.smtp.PASSWORD)
+    def __deliverFile(self, connection, filename):
+        path = os.path.join(configuration.paths.OUTBOX, filename)
 
-                    self.debug("connected")
-                    break
-                except:
-                    self.error("failed to connect to SMTP server")
+        try:
+            queued_at = os.stat(path).st_ctime
+        except OSError:
+            # Already delivered (and moved) by a previous scan.
+            return
 
-                attempts += 1
-                seconds = min(60, 2 ** attempts)
+        age = time.time() - queued_at
 
-                self.info("sleeping %d seconds" % seconds)
+        if age > 60:
+            self.warning("%s: file created %d seconds ago" % (filename, age))
 
-                time.sleep(seconds)
+        try:
+            self.__send(connection, **parseMail(open(path).read()))
+        except:
+            self.exception()
+            os.rename(path, os.path.join(configuration.paths.OUTBOX, filename + ".invalid"))
+            with self.__lock:
+                self.__statistics["failed"] += 1
+            return
 
-    def __disconnect(self):
-        if self.__connection:
-            try:
-                self.__connection.quit()
-                self.debug("disconnected")
-            except: pass
+        os.rename(path, os.path.join(configuration.paths.OUTBOX, "sent", filename + ".sent"))
 
-            self.__connection = None
+        latency = time.time() - queued_at
+
+        self.debug("%s: delivered %.2f seconds after being queued" % (filename, latency))
+
+        with self.__lock:
+            self.__statistics["sent"] += 1
+            self.__statistics["latency"] += latency
+            self.__statistics["max_latency"] = max(self.__statistics["max_latency"], latency)
+
+    def __logStatistics(self):
+        with self.__lock:
+            statistics = self.__statistics
+            self.__statistics = { "sent": 0, "failed": 0, "latency": 0.0, "max_latency": 0.0, "max_queued": len(self.__queued) }
+
+        if statistics["sent"] or statistics["failed"]:
+            self.info("last hour: %d messages sent, %d invalid; latency avg %.2f s, max %.2f s; max %d queued"
+                      % (statistics["sent"], statistics["failed"],
+                         statistics["latency"] / max(1, statistics["sent"]), statistics["max_latency"],
+                         statistics["max_queued"]))
 
-    def __send(self, message_id, parent_message_id, headers, from_user, to_user, recipients, subject, body, **kwargs):
+    def __send(self, connection, message_id, parent_message_id, headers, from_user, to_user, recipients, subject, body, **kwargs):
         def isascii(s):
             return all(ord(c) < 128 for c in s)
 
@@ -188,7 +355,7 @@ class MailDelivery(PeerServer):
 
         while True:
             try:
-                self.__connection.sendmail(configuration.base.SYSTEM_USER_EMAIL, [to_user.email], message.as_string())
+                connection.sendmail(configuration.base.SYSTEM_USER_EMAIL, [to_user.email], message.as_string())
                 return
             except:
                 self.exception()
@@ -198,9 +365,8 @@ class MailDelivery(PeerServer):
 
                 self.error("delivery failure: sleeping %d seconds" % sleeptime)
 
-                self.__disconnect()
+                connection.disconnect()
                 time.sleep(sleeptime)
-                self.__connect()
 
     def __cleanup(self):
         now = time.time()
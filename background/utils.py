@@ -28,6 +28,7 @@ import traceback
 import signal
 import fcntl
 import time
+import collections
 
 from textutils import json_encode, json_decode, indent
 
@@ -36,6 +37,97 @@ def freeze(d):
 def thaw(f):
     return dict(f)
 
+# Priorities of requests to services based on JSONJobServer.  Queued requests
+# with higher priority are started before queued requests with lower
+# priority.
+PRIORITY_BACKGROUND = 0
+PRIORITY_PUSH = 1
+PRIORITY_INTERACTIVE = 2
+
+PRIORITY_NAMES = { PRIORITY_BACKGROUND: "background",
+                   PRIORITY_PUSH: "push",
+                   PRIORITY_INTERACTIVE: "interactive" }
+
+default_priority = PRIORITY_INTERACTIVE
+
+def setDefaultPriority(priority):
+    """Set the priority of requests sent by this process when the caller
+       doesn't specify one."""
+    global default_priority
+    default_priority = priority
+
+def getDefaultPriority():
+    return default_priority
+
+def getRSS(pid):
+    for line in open("/proc/%d/status" % pid):
+        words = line.split()
+        if words[0] == "VmRSS:":
+            if words[2].lower() == "kb": unit = 1024
+            elif words[2].lower() == "mb": unit = 1024 ** 2
+            elif words[2].lower() == "gb": unit = 1024 ** 3
+            else: raise Exception, "unknown unit: %s" % words[2]
+            return int(words[1]) * unit
+    else: raise Exception, "invalid pid"
+
+def runJSONWorker(handle_request, handle_batch=None):
+    """Process JSON requests read from stdin until EOF.
+
+       Each line of input is either a single request or a batch (a list) of
+       requests, encoded as JSON.  For each request, the result of calling
+       handle_request() with it is written to stdout as a single line of
+       JSON, as soon as it is available.  If handle_batch() is specified, it
+       is instead called with each batch, and should return an iterable of
+       the results, in order; if it raises an exception, the requests it
+       hasn't returned results for are handled one at a time by
+       handle_request() instead.  If an exception is raised by
+       handle_request(), the request is returned with an added "error" item
+       containing the traceback.
+
+       Anything else written to stdout while handling requests is
+       redirected to stderr, so that it can't corrupt the results.  The
+       server terminates idle workers with SIGTERM when shutting down, which
+       is not an error."""
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    output = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    def writeResult(result):
+        output.write(json_encode(result) + "\n")
+        output.flush()
+
+    def writeError(request):
+        result = request.copy()
+        result["error"] = "Request:\n%s\n\n%s" % (json_encode(request, indent=2), traceback.format_exc())
+        writeResult(result)
+
+    while True:
+        line = sys.stdin.readline()
+        if not line: break
+
+        requests = json_decode(line)
+        if not isinstance(requests, list): requests = [requests]
+
+        written = 0
+
+        if handle_batch and len(requests) > 1:
+            try:
+                for result in handle_batch([request.copy() for request in requests]):
+                    writeResult(result)
+                    written += 1
+            except Exception:
+                # Don't fail the whole rest of the batch because of one bad
+                # request; handle the remaining requests one at a time
+                # instead, so that only the one that fails again gets an
+                # error.
+                pass
+
+        for request in requests[written:]:
+            try: writeResult(handle_request(request.copy()))
+            except Exception: writeError(request)
+
 class AdministratorMailHandler(logging.Handler):
     def __init__(self, logfile_path):
         super(AdministratorMailHandler, self).__init__()
@@ -122,8 +214,12 @@ class BackgroundProcess(object):
 
     def register_maintenance(self, hour, minute, callback):
         now = time.localtime()
-        since_last = (now[3] * 3600 + now[4] * 60) - (hour * 3600 + minute * 60)
-        if since_last < 0: since_last += 86400
+        if hour is None:
+            since_last = (now[4] - minute) * 60
+            if since_last < 0: since_last += 3600
+        else:
+            since_last = (now[3] * 3600 + now[4] * 60) - (hour * 3600 + minute * 60)
+            if since_last < 0: since_last += 86400
         self.__maintenance_hooks.append([hour, minute, callback, time.time() - since_last])
 
     def run_maintenance(self):
@@ -170,6 +266,7 @@ class PeerServer(BackgroundProcess):
             self.__reading = reading
             self.__read_data = ""
             self.__read_closed = False
+            self.__line_based = False
 
             if reading and reading.fileno() != writing.fileno():
                 fcntl.fcntl(reading, fcntl.F_SETFL, fcntl.fcntl(reading, fcntl.F_GETFL) | os.O_NONBLOCK)
@@ -207,6 +304,13 @@ class PeerServer(BackgroundProcess):
             if self.__read_closed: return self.__read_data
             else: return None
 
+        def set_line_based(self):
+            """Call handle_line() for each line of input as it is read.
+
+               Whatever remains after the last newline character is passed
+               to handle_input() as usual when the input is closed."""
+            self.__line_based = True
+
         def do_read(self):
             while True:
                 read = os.read(self.__reading.fileno(), 4096)
@@ -217,6 +321,10 @@ class PeerServer(BackgroundProcess):
                     self.handle_input(self.__read_data)
                     break
                 self.__read_data += read
+                if self.__line_based:
+                    while "\n" in self.__read_data:
+                        line, self.__read_data = self.__read_data.split("\n", 1)
+                        self.handle_line(line)
 
         def writing_done(self, writing):
             writing.close()
@@ -224,6 +332,9 @@ class PeerServer(BackgroundProcess):
         def reading_done(self, reading):
             reading.close()
 
+        def handle_line(self, line):
+            pass
+
         def destroy(self):
             pass
 
@@ -334,9 +445,16 @@ class PeerServer(BackgroundProcess):
                 poll = select.poll()
                 poll.register(self.__listening_socket, select.POLLIN)
 
+                # A socket peer reads and writes the same file descriptor, so
+                # combine the events to wait for per file descriptor.
+                masks = {}
+
                 for peer in self.__peers:
-                    if peer.writing(): poll.register(peer.writing(), select.POLLOUT)
-                    if peer.reading(): poll.register(peer.reading(), select.POLLIN)
+                    if peer.writing(): masks[peer.writing().fileno()] = masks.get(peer.writing().fileno(), 0) | select.POLLOUT
+                    if peer.reading(): masks[peer.reading().fileno()] = masks.get(peer.reading().fileno(), 0) | select.POLLIN
+
+                for fd, mask in masks.items():
+                    poll.register(fd, mask)
 
                 def fileno(file):
                     if file: return file.fileno()
@@ -374,9 +492,9 @@ class PeerServer(BackgroundProcess):
                             except: pass
                     else:
                         for peer in self.__peers[:]:
-                            if fd == fileno(peer.writing()) and event != select.POLLIN:
+                            if fd == fileno(peer.writing()) and event & ~select.POLLIN:
                                 catch_error(peer.do_write)
-                            if fd == fileno(peer.reading()) and event != select.POLLOUT:
+                            if fd == fileno(peer.reading()) and event & ~select.POLLOUT:
                                 catch_error(peer.do_read)
                             if peer.is_finished():
                                 peer.destroy()
@@ -445,6 +563,9 @@ class JSONJobServer(PeerServer):
             self.write(json_encode(request))
             self.close()
 
+        def add_client(self, request, client):
+            self.clients.add(client)
+
         def handle_input(self, value):
             try: result = json_decode(value)
             except ValueError:
@@ -454,46 +575,367 @@ class JSONJobServer(PeerServer):
             for client in self.clients: client.add_result(result)
             self.server.request_finished(self, self.request, result)
 
-    class JobClient(PeerServer.SocketPeer):
+    class Worker(PeerServer.ChildProcess):
+        """Long-lived child process that processes one batch of requests at a
+           time.
+
+           Used instead of Job when the service is configured with
+           "worker_pool" enabled.  The child process is started with the
+           "--json-worker" argument, and is expected to call runJSONWorker()
+           to process requests.  Results are read back one at a time, in the
+           order of the requests in the batch, as they are finished."""
+
+        def __init__(self, server):
+            super(JSONJobServer.Worker, self).__init__(server, [sys.executable, sys.argv[0], "--json-worker"])
+            self.set_line_based()
+            self.pending = []
+            self.processed = 0
+
+        def start(self, batch):
+            assert not self.pending
+            self.pending = batch
+            if len(batch) == 1:
+                self.write(json_encode(batch[0][1]) + "\n")
+            else:
+                self.write(json_encode([request for clients, request in batch]) + "\n")
+
+        def add_client(self, request, client):
+            for pending_clients, pending_request in self.pending:
+                if pending_request == request:
+                    pending_clients.add(client)
+
+        def __finish(self, result):
+            clients, request = self.pending.pop(0)
+            for client in clients: client.add_result(result)
+            self.server.request_finished(self, request, result)
+
+        def handle_line(self, value):
+            try: result = json_decode(value)
+            except ValueError:
+                self.server.error("invalid response:\n" + indent(value))
+                result = self.pending[0][1].copy()
+                result["error"] = value
+            self.processed += 1
+            self.__finish(result)
+            if not self.pending:
+                self.server.worker_idle(self)
+
         def handle_input(self, value):
-            self.__requests = json_decode(value)
+            self.server.retire_worker(self, "process exited")
+            while self.pending:
+                result = self.pending[0][1].copy()
+                result["error"] = "worker process (pid=%d) exited unexpectedly\n%s" % (self.pid, value)
+                self.__finish(result)
+
+        def destroy(self):
+            if not self.is_finished():
+                self.kill(signal.SIGTERM)
+            super(JSONJobServer.Worker, self).destroy()
+
+    class JobClient(PeerServer.SocketPeer):
+        """Connection from a client.
+
+           The client sends one command, encoded as JSON, terminated by a
+           newline character or by shutting down its end of the connection:
+
+             [request, ...]
+               Process the requests and reply with a list of the results when
+               all have been processed.
+
+             { "requests": [request, ...], "stream": true }
+               Process the requests and reply with each result, one per line,
+               as soon as it is available.
+
+             { "requests": [request, ...], "async": true }
+               Reply immediately with { "ticket": ticket } and process the
+               requests in the background.
+
+             { "ticket": ticket }
+               Reply with { "ticket": ticket, "pending": count,
+               "results": [result, ...] } where "results" are the results of
+               the ticket's finished requests."""
+
+        def __init__(self, server, clientsocket):
+            super(JSONJobServer.JobClient, self).__init__(server, clientsocket)
+            self.set_line_based()
+            self.__command = None
+            self.__stream = False
+
+        def __handle_command(self, value):
+            self.__command = json_decode(value)
+            if isinstance(self.__command, list):
+                self.__requests = self.__command
+            elif "ticket" in self.__command:
+                self.write(json_encode(self.server.poll_ticket(self.__command["ticket"])) + "\n")
+                self.close()
+                return
+            elif self.__command.get("async"):
+                ticket = self.server.add_ticket(self.__command["requests"])
+                self.write(json_encode({ "ticket": ticket }) + "\n")
+                self.close()
+                return
+            else:
+                self.__requests = self.__command["requests"]
+                self.__stream = bool(self.__command.get("stream"))
             self.__results = []
-            self.server.add_requests(self, self.__requests)
+            if self.__requests:
+                self.server.add_requests(self, self.__requests)
+            else:
+                if not self.__stream: self.write(json_encode([]))
+                self.close()
+
+        def handle_line(self, value):
+            if self.__command is None: self.__handle_command(value)
+
+        def handle_input(self, value):
+            if self.__command is None and value.strip(): self.__handle_command(value)
 
         def add_result(self, result):
             self.__results.append(result)
-            if len(self.__results) == len(self.__requests):
+            if self.__stream:
+                self.write(json_encode(result) + "\n")
+                if len(self.__results) == len(self.__requests):
+                    self.close()
+            elif len(self.__results) == len(self.__requests):
                 self.write(json_encode(self.__results))
                 self.close()
 
+    class Ticket(object):
+        """Pseudo-client collecting the results of asynchronous requests."""
+
+        def __init__(self, ticket_id, requests):
+            self.id = ticket_id
+            self.pending = len(requests)
+            self.results = []
+            self.finished_at = None if requests else time.time()
+
+        def add_result(self, result):
+            self.results.append(result)
+            self.pending -= 1
+            if not self.pending:
+                self.finished_at = time.time()
+
+    class QueuedRequest(object):
+        def __init__(self, client, priority, group):
+            self.clients = set([client])
+            self.client = client
+            self.priority = priority
+            self.group = group
+            self.queued_at = time.time()
+
+    class Queue(object):
+        """Queued requests of one priority.
+
+           Requests are taken from each group (repository) in turn, and within
+           a group from each client in turn, so that a client queueing a large
+           number of requests doesn't starve other clients, or other
+           repositories."""
+
+        def __init__(self, priority):
+            self.priority = priority
+            self.name = PRIORITY_NAMES.get(priority, str(priority))
+            self.groups = collections.OrderedDict()
+            self.length = 0
+            self.started = 0
+            self.total_wait = 0.0
+            self.max_wait = 0.0
+
+        def add(self, group, client, frozen):
+            clients = self.groups.setdefault(group, collections.OrderedDict())
+            clients.setdefault(client, []).append(frozen)
+            self.length += 1
+
+        def remove(self, group, client, frozen):
+            clients = self.groups[group]
+            clients[client].remove(frozen)
+            if not clients[client]: del clients[client]
+            if not clients: del self.groups[group]
+            self.length -= 1
+
+        def take(self, count):
+            group, clients = self.groups.popitem(last=False)
+            taken = []
+            while clients and len(taken) < count:
+                client, queued = clients.popitem(last=False)
+                taken.append(queued.pop(0))
+                if queued: clients[client] = queued
+            if clients: self.groups[group] = clients
+            self.length -= len(taken)
+            return taken
+
+        def record_wait(self, wait):
+            self.started += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
     def __init__(self, service):
         super(JSONJobServer, self).__init__(service)
         self.__queued_requests = {}
+        self.__queues = {}
+        self.__tickets = {}
         self.__started_requests = {}
+        self.__busy_jobs = set()
         self.__max_jobs = service.get("max_jobs", 4)
+        self.__max_queued = service.get("max_queued")
+        self.__worker_pool = service.get("worker_pool", False)
+        self.__worker_max_jobs = service.get("worker_max_jobs", 100)
+        self.__worker_rss_limit = service.get("rss_limit")
+        self.__workers = []
+        self.__idle_workers = []
+
+        # Batching requires the worker pool; with one process per request
+        # each request is its own batch.
+        if self.__worker_pool:
+            self.__batch_size = service.get("worker_batch_size", 1)
+        else:
+            self.__batch_size = 1
+
+        self.register_maintenance(hour=None, minute=0, callback=self.__logQueueStatistics)
+        self.register_maintenance(hour=None, minute=30, callback=self.__expireTickets)
+
+    def __getWorker(self):
+        if self.__idle_workers:
+            return self.__idle_workers.pop()
+        worker = JSONJobServer.Worker(self)
+        self.__workers.append(worker)
+        self.add_peer(worker)
+        return worker
+
+    def __getQueue(self, priority):
+        if priority not in self.__queues:
+            self.__queues[priority] = JSONJobServer.Queue(priority)
+        return self.__queues[priority]
+
+    def __logQueueStatistics(self):
+        for priority in sorted(self.__queues.keys(), reverse=True):
+            queue = self.__queues[priority]
+            if queue.started:
+                self.info("queue statistics: %s: %d requests started, wait time average %.2f s, max %.2f s; %d requests queued"
+                          % (queue.name, queue.started, queue.total_wait / queue.started, queue.max_wait, queue.length))
+                queue.started = 0
+                queue.total_wait = queue.max_wait = 0.0
+
+    def retire_worker(self, worker, reason):
+        if worker in self.__workers:
+            self.debug("retiring worker (pid=%d): %s" % (worker.pid, reason))
+            if worker in self.__idle_workers: self.__idle_workers.remove(worker)
+            self.__workers.remove(worker)
+            worker.close()
 
     def __startJobs(self):
-        while self.__queued_requests and len(self.__started_requests) < self.__max_jobs:
-            frozen, clients = self.__queued_requests.popitem()
-            request = thaw(frozen)
-            job = JSONJobServer.Job(self, clients, request)
-            self.add_peer(job)
-            self.request_started(job, request)
+        while self.__queued_requests and len(self.__busy_jobs) < self.__max_jobs:
+            queue = max([queue for queue in self.__queues.values() if queue.length],
+                        key=lambda queue: queue.priority)
+
+            now = time.time()
+            batch = []
+
+            for frozen in queue.take(self.__batch_size):
+                queued = self.__queued_requests.pop(frozen)
+                wait = now - queued.queued_at
+                queue.record_wait(wait)
+                self.debug("starting %s request after %.2f s in queue" % (queue.name, wait))
+                batch.append((queued.clients, thaw(frozen)))
+
+            if self.__worker_pool:
+                job = self.__getWorker()
+                job.start(batch)
+            else:
+                clients, request = batch[0]
+                job = JSONJobServer.Job(self, clients, request)
+                self.add_peer(job)
+
+            self.__busy_jobs.add(job)
+
+            for clients, request in batch:
+                self.request_started(job, request)
 
     def add_requests(self, client, requests):
+        rejected = 0
+
         for request in requests:
+            request = request.copy()
+            priority = request.pop("priority", PRIORITY_INTERACTIVE)
             frozen = freeze(request)
             if frozen in self.__started_requests:
-                self.__started_requests[frozen].clients.add(client)
+                self.__started_requests[frozen].add_client(request, client)
+            elif frozen in self.__queued_requests:
+                queued = self.__queued_requests[frozen]
+                queued.clients.add(client)
+                if priority > queued.priority:
+                    self.__getQueue(queued.priority).remove(queued.group, queued.client, frozen)
+                    self.__getQueue(priority).add(queued.group, queued.client, frozen)
+                    queued.priority = priority
             else:
-                self.__queued_requests.setdefault(frozen, set()).add(client)
+                queue = self.__getQueue(priority)
+                if self.__max_queued is not None and queue.length >= self.__max_queued:
+                    result = request.copy()
+                    result["error"] = "too many queued requests (%d) with priority '%s'" % (queue.length, queue.name)
+                    client.add_result(result)
+                    rejected += 1
+                    continue
+                group = self.request_group(request)
+                self.__queued_requests[frozen] = JSONJobServer.QueuedRequest(client, priority, group)
+                queue.add(group, client, frozen)
+
+        if rejected:
+            self.info("rejected %d requests: queue full" % rejected)
+
         self.__startJobs()
 
+    def add_ticket(self, requests):
+        ticket = JSONJobServer.Ticket(os.urandom(8).encode("hex"), requests)
+        self.__tickets[ticket.id] = ticket
+        if requests: self.add_requests(ticket, requests)
+        return ticket.id
+
+    def poll_ticket(self, ticket_id):
+        ticket = self.__tickets.get(ticket_id)
+        if not ticket:
+            return { "ticket": ticket_id, "error": "invalid ticket" }
+        return { "ticket": ticket_id, "pending": ticket.pending, "results": ticket.results }
+
+    def __expireTickets(self):
+        # Forget the results of tickets that finished more than an hour ago.
+        deadline = time.time() - 3600
+        for ticket_id, ticket in self.__tickets.items():
+            if ticket.finished_at is not None and ticket.finished_at < deadline:
+                del self.__tickets[ticket_id]
+
     def handle_peer(self, peersocket, peeraddress):
         return JSONJobServer.JobClient(self, peersocket)
 
     def peer_destroyed(self, peer):
-        if isinstance(peer, JSONJobServer.Job): self.__startJobs()
+        if isinstance(peer, (JSONJobServer.Job, JSONJobServer.Worker)):
+            self.__busy_jobs.discard(peer)
+            self.__startJobs()
+
+    def worker_idle(self, worker):
+        self.__busy_jobs.discard(worker)
+        if self.restart_requested:
+            self.retire_worker(worker, "restart requested")
+        elif worker.processed >= self.__worker_max_jobs:
+            self.retire_worker(worker, "processed %d requests" % worker.processed)
+        else:
+            rss = None
+            if self.__worker_rss_limit is not None:
+                try: rss = getRSS(worker.pid)
+                except: pass
+            if rss is not None and rss > self.__worker_rss_limit:
+                self.retire_worker(worker, "RSS limit exceeded (%d bytes)" % rss)
+            else:
+                self.__idle_workers.append(worker)
+        self.__startJobs()
+
+    def requestRestart(self):
+        super(JSONJobServer, self).requestRestart()
+        for worker in self.__idle_workers[:]:
+            self.retire_worker(worker, "restart requested")
+
+    def request_group(self, request):
+        """Return a key identifying requests that can be processed in the same
+           batch by one worker, such as the name of the repository."""
+        return None
 
     def request_started(self, job, request):
         self.__started_requests[freeze(request)] = job
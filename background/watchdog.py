@@ -25,20 +25,9 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(sys.argv[0]), ".
 
 import configuration
 
-from background.utils import BackgroundProcess
+from background.utils import BackgroundProcess, getRSS
 from mailutils import sendAdministratorMessage
 
-def getRSS(pid):
-    for line in open("/proc/%d/status" % pid):
-        words = line.split()
-        if words[0] == "VmRSS:":
-            if words[2].lower() == "kb": unit = 1024
-            elif words[2].lower() == "mb": unit = 1024 ** 2
-            elif words[2].lower() == "gb": unit = 1024 ** 3
-            else: raise Exception, "unknown unit: %s" % words[2]
-            return int(words[1]) * unit
-    else: raise Exception, "invalid pid"
-
 class Watchdog(BackgroundProcess):
     def __init__(self):
         super(Watchdog, self).__init__(service=configuration.services.WATCHDOG)
@@ -16,42 +16,111 @@
 
 import configuration
 import socket
+import time
+import background.utils
 from textutils import json_encode, json_decode, indent
 
-def requestChangesets(requests):
+def _connect(command):
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(configuration.services.CHANGESET["address"])
+    connection.sendall(json_encode(command) + "\n")
+    return connection
+
+def _prepare(requests, priority):
+    if priority is None: priority = background.utils.getDefaultPriority()
+    return [dict(request, priority=priority) for request in requests]
+
+def _decode(line):
+    try:
+        return json_decode(line)
+    except:
+        raise Exception, "Changeset background service failed: returned an invalid response (%r)" % line
+
+def _checkResults(results):
+    errors = []
+
+    for result in results:
+        if "error" in result:
+            errors.append(result["error"])
+
+    if errors:
+        raise Exception, "Changeset background service failed: one or more requests failed\n%s" % "\n".join(map(indent, errors))
+
+def streamChangesets(requests, priority=None):
+    """Request changesets and yield each result as soon as it is available.
+
+       Results are yielded in the order the changesets are finished, which is
+       not necessarily the order of the requests.  Failed requests are
+       yielded as results with an "error" item."""
+
+    requests = _prepare(requests, priority)
+
     try:
-        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        connection.connect(configuration.services.CHANGESET["address"])
-        connection.send(json_encode(requests))
-        connection.shutdown(socket.SHUT_WR)
+        connection = _connect({ "requests": requests, "stream": True })
+        received = 0
 
-        data = ""
+        try:
+            for line in connection.makefile("r"):
+                yield _decode(line)
+                received += 1
+        finally:
+            connection.close()
+    except socket.error, error:
+        raise Exception, "Changeset background service failed: %s" % error[1]
 
-        while True:
-            received = connection.recv(4096)
-            if not received: break
-            data += received
+    if received != len(requests):
+        raise Exception, "Changeset background service failed: didn't process all requested changesets"
 
+def requestChangesets(requests, priority=None):
+    """Request changesets and wait until all have been processed."""
+
+    _checkResults(list(streamChangesets(requests, priority)))
+
+def requestChangesetsAsync(requests, priority=None):
+    """Request changesets and return a ticket without waiting.
+
+       The ticket can be passed to pollChangesets() to check the progress."""
+
+    try:
+        connection = _connect({ "requests": _prepare(requests, priority), "async": True })
+        response = connection.makefile("r").readline()
         connection.close()
     except socket.error, error:
         raise Exception, "Changeset background service failed: %s" % error[1]
 
+    return _decode(response)["ticket"]
+
+def pollChangesets(ticket):
+    """Return the number of pending requests and the results of the finished
+       requests of the ticket returned by requestChangesetsAsync()."""
+
     try:
-        results = json_decode(data)
-    except:
-        raise Exception, "Changeset background service failed: returned an invalid response (%r)" % data
+        connection = _connect({ "ticket": ticket })
+        response = connection.makefile("r").readline()
+        connection.close()
+    except socket.error, error:
+        raise Exception, "Changeset background service failed: %s" % error[1]
 
-    if type(results) != list:
-        raise Exception, "Changeset background service failed: %s" % str(results)
+    status = _decode(response)
 
-    if len(results) != len(requests):
-        raise Exception, "Changeset background service failed: didn't process all requested changesets"
+    if "error" in status:
+        raise Exception, "Changeset background service failed: %s" % status["error"]
 
-    errors = []
+    return status["pending"], status["results"]
 
-    for result in results:
-        if "error" in result:
-            errors.append(result["error"])
+def waitForChangesets(ticket, timeout):
+    """Wait at most 'timeout' seconds for the requests of the ticket to be
+       processed.  Returns True if they were, and False otherwise."""
 
-    if errors:
-        raise Exception, "Changeset background service failed: one or more requests failed\n%s" % "\n".join(map(indent, errors))
+    deadline = time.time() + timeout
+    delay = 0.05
+
+    while True:
+        pending, results = pollChangesets(ticket)
+        if not pending:
+            _checkResults(results)
+            return True
+        if time.time() + delay > deadline:
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
@@ -14,11 +14,18 @@
 # License for the specific language governing permissions and limitations under
 # the License.
 
+import itertools
+
 import dbutils
 import gitutils
+import diff
 import diff.merge
 import diff.parse
 
+# Number of files whose old and new versions are fetched from the repository
+# together when analyzing chunks.
+LOAD_LINES_BATCH = 100
+
 def createChangeset(db, request):
     repository_name = request["repository_name"]
     changeset_type = request["changeset_type"]
@@ -26,6 +33,37 @@ def createChangeset(db, request):
     repository = gitutils.Repository.fromName(db, repository_name)
 
     def insertChangeset(db, parent, child, files):
+        def needsLines(file):
+            return any(not chunk.analysis and chunk.delete_count != 0 and chunk.insert_count != 0
+                       for chunk in file.chunks)
+
+        # Analyze the chunks of a batch of files at a time, as they are read
+        # from 'files' (which may be an iterator), and then drop the files'
+        # lines and chunks, keeping only what is inserted into the database.
+        analyzed = []
+
+        files = iter(files)
+
+        while True:
+            batch = list(itertools.islice(files, LOAD_LINES_BATCH))
+            if not batch: break
+
+            # Load the file versions needed by the chunk analysis below for
+            # the whole batch of files at once.
+            diff.File.loadPlainLines(filter(needsLines, batch))
+
+            for file in batch:
+                file_chunks_values = []
+
+                for index, chunk in enumerate(file.chunks):
+                    chunk.analyze(file, index == len(file.chunks) - 1)
+                    file_chunks_values.append((chunk.delete_offset, chunk.delete_count, chunk.insert_offset, chunk.insert_count, chunk.analysis, 1 if chunk.is_whitespace else 0))
+
+                file.clean()
+                analyzed.append((file, file_chunks_values))
+
+        files = [file for file, file_chunks_values in analyzed]
+
         while True:
             # Inserting new files will often clash when creating multiple
             # related changesets in parallel.  It's a simple operation, so if it
@@ -51,26 +89,25 @@ def createChangeset(db, request):
 
         file_ids = set()
 
-        for file in files:
+        for file, file_chunks_values in analyzed:
             if file.id in file_ids: raise Exception, "duplicate:%d:%s" % (file.id, file.path)
             file_ids.add(file.id)
 
             fileversions_values.append((changeset_id, file.id, file.old_sha1, file.new_sha1, file.old_mode, file.new_mode))
 
-            for index, chunk in enumerate(file.chunks):
-                chunk.analyze(file, index == len(file.chunks) - 1)
-                chunks_values.append((changeset_id, file.id, chunk.delete_offset, chunk.delete_count, chunk.insert_offset, chunk.insert_count, chunk.analysis, 1 if chunk.is_whitespace else 0))
-
-            file.clean()
+            for values in file_chunks_values:
+                chunks_values.append((changeset_id, file.id) + values)
 
+        # Insert the rows using COPY rather than executemany(), which would
+        # execute a separate INSERT per row.
         if fileversions_values:
-            cursor.executemany("""INSERT INTO fileversions (changeset, file, old_sha1, new_sha1, old_mode, new_mode)
-                                       VALUES (%s, %s, %s, %s, %s, %s)""",
-                               fileversions_values)
+            cursor.copy_from("fileversions",
+                             ("changeset", "file", "old_sha1", "new_sha1", "old_mode", "new_mode"),
+                             fileversions_values)
         if chunks_values:
-            cursor.executemany("""INSERT INTO chunks (changeset, file, deleteOffset, deleteCount, insertOffset, insertCount, analysis, whitespace)
-                                       VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""",
-                               chunks_values)
+            cursor.copy_from("chunks",
+                             ("changeset", "file", "deleteoffset", "deletecount", "insertoffset", "insertcount", "analysis", "whitespace"),
+                             chunks_values)
 
         return changeset_id
 
@@ -78,17 +115,17 @@ def createChangeset(db, request):
         child = gitutils.Commit.fromSHA1(db, repository, request["child_sha1"])
         changes = diff.merge.parseMergeDifferences(db, repository, child)
     else:
+        # The differences are parsed as they are inserted, one batch of files
+        # at a time, rather than all up front.
         if changeset_type == "direct":
             child = gitutils.Commit.fromSHA1(db, repository, request["child_sha1"])
-            changes = diff.parse.parseDifferences(repository, commit=child)
-        elif changeset_type == "custom":
-            parent = gitutils.Commit.fromSHA1(db, repository, request["parent_sha1"])
-            child = gitutils.Commit.fromSHA1(db, repository, request["child_sha1"])
-            changes = diff.parse.parseDifferences(repository, from_commit=parent, to_commit=child)
+            if child.parents: parent_sha1 = child.parents[0]
+            else: parent_sha1 = None
+            changes = { parent_sha1: diff.parse.iterDifferences(repository, commit=child) }
         else:
             parent = gitutils.Commit.fromSHA1(db, repository, request["parent_sha1"])
             child = gitutils.Commit.fromSHA1(db, repository, request["child_sha1"])
-            changes = diff.parse.parseDifferences(repository, from_commit=parent, to_commit=child)
+            changes = { parent.sha1: diff.parse.iterDifferences(repository, from_commit=parent, to_commit=child) }
 
     changeset_ids = request["changeset_ids"] = {}
 
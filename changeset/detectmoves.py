@@ -23,6 +23,7 @@ re_ws = re.compile("\\s+")
 
 SMALLEST_INSERT = 5
 MAXIMUM_GAP = 10
+MAXIMUM_CANDIDATES = 5
 
 class Line:
     def __init__(self, string):
@@ -36,7 +37,7 @@ class Line:
         return self.wsnorm == other.wsnorm
 
     def __ne__(self, other):
-        return self.wsnorm == other.wsnorm
+        return self.wsnorm != other.wsnorm
 
     def __hash__(self):
         return hash(self.wsnorm)
@@ -123,39 +124,92 @@ def compareChunks(source_file, source_chunk, target_file, target_chunk, extra_ta
 
     return None
 
-def findSourceChunk(db, changeset, source_file_ids, target_file, target_chunk, extra_target_chunks):
-    for source_file in changeset.files:
-        if source_file_ids and not source_file.id in source_file_ids: continue
+class SourceIndex:
+    """Index of the deleted lines of all possible source chunks of moved code
+       in a changeset.
+
+       Maps each white-space normalized deleted line to the chunks it was
+       deleted from, so that the source chunks sharing the most lines with a
+       target chunk can be found without comparing it with every chunk."""
 
-        for source_chunk in source_file.chunks:
-            # Should't compare chunk to itself, of course.
-            if target_file == source_file and target_chunk == source_chunk:
-                continue
+    def __init__(self, changeset, source_file_ids):
+        self.sources = []
+        self.lines = {}
 
-            # Much fewer deleted lines than inserted lines in the target chunk;
-            # unlikely to be a relevant source chunk.
-            #if source_chunk.delete_count * 1.5 < target_chunk.insert_count:
-            #    continue
+        for source_file in changeset.files:
+            if source_file_ids and not source_file.id in source_file_ids: continue
 
-            if source_chunk.analysis:
-                # If more than half the deleted lines are mapped against
-                # inserted lines, most likely edited rather than moved code.
-                if source_chunk.delete_count < len(source_chunk.analysis.split(";")) * 2:
+            for source_chunk in source_file.chunks:
+                # No deleted lines; can't be the source of moved code.
+                if not source_chunk.delete_count:
                     continue
 
-            source_file.loadOldLines()
-            source_chunk.deleted_lines = source_file.getOldLines(source_chunk)
+                if source_chunk.analysis:
+                    # If more than half the deleted lines are mapped against
+                    # inserted lines, most likely edited rather than moved code.
+                    if source_chunk.delete_count < len(source_chunk.analysis.split(";")) * 2:
+                        continue
+
+                source_file.loadOldLines()
+                source_chunk.deleted_lines = source_file.getOldLines(source_chunk)
+
+                source_index = len(self.sources)
+                self.sources.append((source_file, source_chunk))
+
+                for wsnorm, count in countLines(map(Line, source_chunk.deleted_lines)).items():
+                    self.lines.setdefault(wsnorm, []).append((source_index, count))
+
+    def findCandidates(self, target_lines):
+        """Return the source chunks sharing at least SMALLEST_INSERT lines with
+           'target_lines', the ones sharing the most lines first."""
+
+        shared = {}
+
+        for wsnorm, count in countLines(target_lines).items():
+            for source_index, source_count in self.lines.get(wsnorm, ()):
+                shared[source_index] = shared.get(source_index, 0) + min(count, source_count)
 
-            new_chunk = compareChunks(source_file, source_chunk, target_file, target_chunk, extra_target_chunks)
+        candidates = sorted((-count, source_index) for source_index, count in shared.items() if count >= SMALLEST_INSERT)
 
-            if new_chunk:
-                return source_file, new_chunk
+        return [self.sources[source_index] for count, source_index in candidates]
+
+def countLines(lines):
+    counts = {}
+    for line in lines:
+        counts[line.wsnorm] = counts.get(line.wsnorm, 0) + 1
+    return counts
+
+def findSourceChunk(db, changeset, source_index, target_file, target_chunk, extra_target_chunks):
+    candidates = source_index.findCandidates(map(Line, target_chunk.inserted_lines))
+    checked = 0
+
+    for source_file, source_chunk in candidates:
+        # Should't compare chunk to itself, of course.
+        if target_file == source_file and target_chunk == source_chunk:
+            continue
+
+        # Only compare with the few chunks sharing the most lines; if none of
+        # them is the source, the others are very unlikely to be.
+        if checked == MAXIMUM_CANDIDATES:
+            break
+        checked += 1
+
+        new_chunk = compareChunks(source_file, source_chunk, target_file, target_chunk, extra_target_chunks)
+
+        if new_chunk:
+            return source_file, new_chunk
 
     return None, None
 
 def detectMoves(db, changeset, source_file_ids=None, target_file_ids=None):
     moves = []
 
+    diff.File.loadPlainLines([file for file in changeset.files
+                              if not source_file_ids or file.id in source_file_ids
+                              or not target_file_ids or file.id in target_file_ids])
+
+    source_index = SourceIndex(changeset, source_file_ids)
+
     for target_file in changeset.files:
         if target_file_ids and not target_file.id in target_file_ids: continue
 
@@ -187,7 +241,7 @@ def detectMoves(db, changeset, source_file_ids=None, target_file_ids=None):
                 target_file.loadNewLines()
                 target_chunk.inserted_lines = target_file.getNewLines(target_chunk)
 
-                source_file, chunk = findSourceChunk(db, changeset, source_file_ids, target_file, target_chunk, extra_target_chunks)
+                source_file, chunk = findSourceChunk(db, changeset, source_index, target_file, target_chunk, extra_target_chunks)
 
                 if source_file and chunk:
                     moves.append((source_file, target_file, chunk))
@@ -22,6 +22,8 @@ from changeset.utils import getCodeContext
 def unified(db, changeset, context_lines=3):
     result = ""
 
+    diff.File.loadPlainLines(changeset.files)
+
     for file in changeset.files:
         file.loadOldLines()
         file.loadNewLines()
@@ -34,6 +34,15 @@ import load
 import dbutils
 import client
 
+class ChangesetPending(Exception):
+    """Raised by createChangeset() when the changeset is still being computed
+       by the changeset service after the specified timeout.  The ticket can
+       be used to check its progress using client.pollChangesets()."""
+
+    def __init__(self, ticket):
+        Exception.__init__(self, "changeset is being computed")
+        self.ticket = ticket
+
 def createFullMergeChangeset(db, user, repository, commit, review=None):
     assert len(commit.parents) > 1
 
@@ -67,7 +76,7 @@ def createChangesets(db, repository, commits):
     if requests:
         client.requestChangesets(requests)
 
-def createChangeset(db, user, repository, commit=None, from_commit=None, to_commit=None, rescan=False, reanalyze=False, conflicts=False, filtered_file_ids=None, review=None, do_highlight=True, load_chunks=True):
+def createChangeset(db, user, repository, commit=None, from_commit=None, to_commit=None, rescan=False, reanalyze=False, conflicts=False, filtered_file_ids=None, review=None, do_highlight=True, load_chunks=True, timeout=None):
     cursor = db.cursor()
 
     if conflicts:
@@ -172,7 +181,12 @@ def createChangeset(db, user, repository, commit=None, from_commit=None, to_comm
 
             request["repository_name"] = repository.name
 
-            client.requestChangesets([request])
+            if timeout is None:
+                client.requestChangesets([request])
+            else:
+                ticket = client.requestChangesetsAsync([request])
+                if not client.waitForChangesets(ticket, timeout):
+                    raise ChangesetPending(ticket)
 
             db.commit()
 
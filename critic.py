@@ -22,6 +22,7 @@ from htmlutils import htmlify, jsify, tabify, Document
 from profiling import Profiler, formatDBProfiling
 from utf8utils import convertUTF8
 import itertools
+import types
 import traceback
 import sys
 import os
@@ -67,6 +68,7 @@ import operation.autocompletedata
 import operation.servicemanager
 import operation.addrepository
 import operation.news
+import operation.checkchangesets
 
 import page.utils
 import page.createreview
@@ -312,8 +314,11 @@ def reapplyfilters(req, db, user):
                                   AND reviewuserfiles.uid IS NULL""",
                             (user.id, review_id))
 
-            for changeset_id, commit_id, file_id, review_file_id in cursor2:
-                users = filters.listUsers(db, file_id)
+            rows = cursor2.fetchall()
+            file_users = filters.listUsersForFiles(db, set(file_id for changeset_id, commit_id, file_id, review_file_id in rows))
+
+            for changeset_id, commit_id, file_id, review_file_id in rows:
+                users = file_users[file_id]
 
                 if user.id in users:
                     if commit_id not in own_commit:
@@ -609,6 +614,7 @@ def processcommits(req, db, user):
     return output.getvalue()
 
 operations = { "fetchlines": operation.fetchlines.FetchLines(),
+               "checkchangesets": operation.checkchangesets.CheckChangesets(),
                "reviewersandwatchers": operation.createreview.ReviewersAndWatchers(),
                "submitreview": operation.createreview.SubmitReview(),
                "fetchremotebranches": operation.createreview.FetchRemoteBranches(),
@@ -885,13 +891,22 @@ def main(environ, start_response):
                     except dbutils.NoSuchUser, error:
                         raise page.utils.DisplayMessage("Invalid URI Parameter!", error.message)
 
-                    if isinstance(result, str) or isinstance(result, Document):
+                    if isinstance(result, str):
+                        req.start()
+                        yield result
+                    elif isinstance(result, Document):
                         req.start()
-                        yield str(result)
+                        for chunk in result.stream():
+                            yield chunk
                     else:
                         for fragment in result:
                             req.start()
-                            yield str(fragment)
+                            if isinstance(fragment, types.GeneratorType):
+                                # Output from Document.stream().
+                                for chunk in fragment:
+                                    yield chunk
+                            else:
+                                yield str(fragment)
 
                     yield "<!-- total request time: %.2f ms -->" % ((time.time() - request_start) * 1000)
 
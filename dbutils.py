@@ -27,11 +27,25 @@ from dbaccess import IntegrityError
 import os
 import os.path
 import time
+import threading
+import StringIO
+
+def copy_value(value):
+    """Format 'value' as a column value in PostgreSQL's COPY text format."""
+
+    if value is None:
+        return "\\N"
+    elif isinstance(value, unicode):
+        value = value.encode("utf-8")
+    else:
+        value = str(value)
+
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
 
 class Session():
     def __init__(self):
         self.__atexit = []
-        self.storage = { "Repository": {}, "User": {}, "Commit": {}, "CommitUserTime": {} }
+        self.storage = { "Repository": {}, "User": {}, "Commit": {}, "CommitUserTime": {}, "Paths": {} }
         self.profiling = {}
 
     def atexit(self, fn):
@@ -120,6 +134,25 @@ class Database(Session):
                 after = time.time()
                 self.__db.recordProfiling(query, after - before, repetitions=len(params))
 
+        def copy_from(self, table, columns, rows):
+            """Insert 'rows' into 'table' using a single COPY command."""
+
+            data = StringIO.StringIO()
+
+            for row in rows:
+                data.write("\t".join(copy_value(value) for value in row))
+                data.write("\n")
+
+            data.seek(0)
+
+            if not self.__profiling:
+                self.__cursor.copy_from(data, table, columns=columns)
+            else:
+                before = time.time()
+                self.__cursor.copy_from(data, table, columns=columns)
+                after = time.time()
+                self.__db.recordProfiling("COPY %s (%s)" % (table, ", ".join(columns)), after - before, rows=self.__cursor.rowcount)
+
     def __init__(self):
         Session.__init__(self)
         self.__connection = dbaccess.connect()
@@ -132,12 +165,14 @@ class Database(Session):
         self.__connection.commit()
         after = time.time()
         self.recordProfiling("<commit>", after - before, 0)
+        path_cache.commit(self)
 
     def rollback(self):
         before = time.time()
         self.__connection.rollback()
         after = time.time()
         self.recordProfiling("<rollback>", after - before, 0)
+        path_cache.rollback(self)
 
     def close(self):
         Session.close(self)
@@ -367,25 +402,232 @@ class User():
             user_id, email, fullname, status = row
             return User.cache(db, User(user_id, name, email, fullname, status))
 
-def find_directory(db, path):
-    path = path.strip("/")
+class PathCache:
+    """Process-wide cache of directory and file IDs.
 
-    cursor = db.cursor()
+       Rows in the directories and files tables are never modified, so the
+       mapping between paths and IDs can be cached for as long as the process
+       lives.  The directories are loaded in one go on first use; files are
+       looked up on demand, any number of them per query.
 
-    try:
-        cursor.execute("SELECT finddirectory(%s)", (path,))
-        directory_id = cursor.fetchone()[0]
-        if directory_id is not None: return directory_id
-    except: pass
+       IDs of rows inserted by the current transaction are kept in the
+       session's storage until the transaction is committed, since they are
+       invalid if it is rolled back instead.
 
-    if "/" in path:
-        directory, name = path.rsplit("/", 1)
-        directory = find_directory(db, directory)
-    else:
-        directory, name = 0, path
+       The cache is shared by all threads in the process.  Changes to it are
+       made while holding a lock, and lookups are single dictionary accesses,
+       so no lock is held while querying the database (which could wait for
+       another thread's transaction.)"""
 
-    cursor.execute("INSERT INTO directories (directory, name) VALUES (%s, %s) RETURNING id", (directory, name))
-    return cursor.fetchone()[0]
+    # Forget all cached file IDs when there are more than this many of them.
+    MAXIMUM_FILES = 1000000
+
+    def __init__(self):
+        self.__entries = { "directories": None, "files": {} } # dict(table -> dict((directory_id, name) -> id))
+        self.__parents = { "directories": None, "files": {} } # dict(table -> dict(id -> (directory_id, name)))
+        self.__lock = threading.Lock()
+
+    def __load(self, db):
+        if self.__entries["directories"] is None:
+            entries = {}
+            parents = {}
+
+            cursor = db.cursor()
+            cursor.execute("SELECT id, directory, name FROM directories")
+
+            for directory_id, parent_id, name in cursor:
+                entries[(parent_id, name)] = directory_id
+                parents[directory_id] = (parent_id, name)
+
+            with self.__lock:
+                if self.__entries["directories"] is None:
+                    self.__entries["directories"] = entries
+                    self.__parents["directories"] = parents
+
+    def __pending(self, db, table):
+        return db.storage["Paths"].setdefault(table, ({}, {}))
+
+    def __add(self, table, rows):
+        with self.__lock:
+            entries = self.__entries[table]
+            parents = self.__parents[table]
+
+            if table == "files" and len(entries) + len(rows) > PathCache.MAXIMUM_FILES:
+                entries.clear()
+                parents.clear()
+
+            for entry_id, directory_id, name in rows:
+                entries[(directory_id, name)] = entry_id
+                parents[entry_id] = (directory_id, name)
+
+    def commit(self, db):
+        for table, (entries, parents) in db.storage["Paths"].items():
+            self.__add(table, [(entry_id, directory_id, name) for (directory_id, name), entry_id in entries.items()])
+        db.storage["Paths"].clear()
+
+    def rollback(self, db):
+        db.storage["Paths"].clear()
+
+    def __find(self, db, table, entries, insert):
+        """Return a dictionary mapping each (directory_id, name) pair in
+           'entries' to an ID from 'table', or to None if 'insert' is false and
+           there is no such row."""
+
+        cached = self.__entries[table]
+        pending, pending_parents = self.__pending(db, table)
+        result = {}
+        missing = []
+
+        for entry in entries:
+            entry_id = cached.get(entry) or pending.get(entry)
+            if entry_id is None: missing.append(entry)
+            else: result[entry] = entry_id
+
+        if missing:
+            cursor = db.cursor()
+            directories, names = zip(*missing)
+
+            cursor.execute("""SELECT id, %(table)s.directory, %(table)s.name
+                                FROM %(table)s
+                                JOIN (SELECT UNNEST(%%s) AS directory, UNNEST(%%s) AS name) AS wanted
+                                  ON (wanted.directory=%(table)s.directory AND wanted.name=%(table)s.name)"""
+                           % { "table": table },
+                           (list(directories), list(names)))
+
+            rows = cursor.fetchall()
+
+            # Rows inserted by this transaction are all in 'pending', so these
+            # have been committed and can be cached.
+            self.__add(table, rows)
+
+            for entry_id, directory_id, name in rows:
+                result[(directory_id, name)] = entry_id
+
+            missing = [entry for entry in missing if entry not in result]
+
+            if missing and insert:
+                directories, names = zip(*missing)
+
+                cursor.execute("""INSERT INTO %s (directory, name)
+                                       SELECT UNNEST(%%s), UNNEST(%%s)
+                                    RETURNING id, directory, name""" % table,
+                               (list(directories), list(names)))
+
+                for entry_id, directory_id, name in cursor:
+                    result[(directory_id, name)] = entry_id
+                    pending[(directory_id, name)] = entry_id
+                    pending_parents[entry_id] = (directory_id, name)
+            else:
+                for entry in missing:
+                    result[entry] = None
+
+        return result
+
+    def findDirectories(self, db, paths, insert=True):
+        """Return a dictionary mapping each path in 'paths' to a directory ID
+           (zero for the root directory), or to None if 'insert' is false and
+           there is no such directory.  Paths are looked up one directory level
+           at a time."""
+
+        self.__load(db)
+
+        paths = set(path.strip("/") for path in paths)
+        levels = {}
+
+        for path in paths:
+            if path:
+                components = path.split("/")
+                for depth in range(1, len(components) + 1):
+                    levels.setdefault(depth, set()).add("/".join(components[:depth]))
+
+        directory_ids = { "": 0 }
+
+        for depth in sorted(levels.keys()):
+            entries = {}
+
+            for path in levels[depth]:
+                parent, _, name = path.rpartition("/")
+                parent_id = directory_ids[parent]
+                if parent_id is None: directory_ids[path] = None
+                else: entries[(parent_id, name)] = path
+
+            for entry, directory_id in self.__find(db, "directories", entries.keys(), insert).items():
+                directory_ids[entries[entry]] = directory_id
+
+        return dict((path, directory_ids[path]) for path in paths)
+
+    def findFiles(self, db, paths, insert=True):
+        """Return a dictionary mapping each path in 'paths' to a file ID, or to
+           None if 'insert' is false and there is no such file."""
+
+        paths = set(path.lstrip("/") for path in paths)
+        directory_ids = self.findDirectories(db, [path.rpartition("/")[0] for path in paths], insert)
+        file_ids = {}
+        entries = {}
+
+        for path in paths:
+            directory, _, name = path.rpartition("/")
+            directory_id = directory_ids[directory]
+            if directory_id is None: file_ids[path] = None
+            else: entries[(directory_id, name)] = path
+
+        for entry, file_id in self.__find(db, "files", entries.keys(), insert).items():
+            file_ids[entries[entry]] = file_id
+
+        return file_ids
+
+    def __parent(self, db, table, entry_id):
+        parent = self.__parents[table].get(entry_id) or self.__pending(db, table)[1].get(entry_id)
+
+        if parent is None:
+            cursor = db.cursor()
+            cursor.execute("SELECT directory, name FROM %s WHERE id=%%s" % table, (entry_id,))
+
+            row = cursor.fetchone()
+            if not row: raise Exception, "invalid %s id: %d" % (table[:-1], entry_id)
+
+            parent = tuple(row)
+
+        return parent
+
+    def explodeDirectory(self, db, directory_id):
+        """Return a list of the IDs of the directories in a directory's path,
+           from the top-most directory to the directory itself."""
+
+        self.__load(db)
+
+        path = []
+
+        while directory_id:
+            path.insert(0, directory_id)
+            directory_id = self.__parent(db, "directories", directory_id)[0]
+
+        return path
+
+    def explodeFiles(self, db, file_ids):
+        """Return a dictionary mapping each file ID in 'file_ids' to a list of
+           the IDs of the directories in the file's path, from the top-most
+           directory to the file's immediate containing directory."""
+
+        self.__load(db)
+
+        file_ids = set(file_ids)
+        pending_parents = self.__pending(db, "files")[1]
+        missing = [file_id for file_id in file_ids
+                   if file_id not in self.__parents["files"] and file_id not in pending_parents]
+
+        if missing:
+            cursor = db.cursor()
+            cursor.execute("SELECT id, directory, name FROM files WHERE id=ANY (%s)", (missing,))
+            self.__add("files", cursor.fetchall())
+
+        return dict((file_id, self.explodeDirectory(db, self.__parent(db, "files", file_id)[0]))
+                    for file_id in file_ids)
+
+path_cache = PathCache()
+
+def find_directory(db, path):
+    return path_cache.findDirectories(db, [path])[path.strip("/")]
 
 def is_directory(db, path):
     cursor = db.cursor()
@@ -412,28 +654,18 @@ def is_file(db, path):
     return bool(cursor.fetchone())
 
 def find_file(db, path):
-    path = path.lstrip("/")
-
-    cursor = db.cursor()
+    return path_cache.findFiles(db, [path])[path.lstrip("/")]
 
-    try:
-        cursor.execute("SELECT findfile(%s)", (path,))
-        file_id = cursor.fetchone()[0]
-        if file_id is not None: return file_id
-    except: pass
+def find_files(db, files):
+    """Set the 'id' attribute of each file in 'files', inserting any missing
+       files and directories.  Like find_file(), this raises IntegrityError if
+       a concurrent transaction inserted one of the same files or directories
+       first; the caller can simply roll back and retry."""
 
-    if "/" in path:
-        directory, name = path.rsplit("/", 1)
-        directory = find_directory(db, directory)
-    else:
-        directory, name = 0, path
+    file_ids = path_cache.findFiles(db, [file.path for file in files])
 
-    cursor.execute("INSERT INTO files (directory, name) VALUES (%s, %s) RETURNING id", (directory, name))
-    return cursor.fetchone()[0]
-
-def find_files(db, files):
     for file in files:
-        file.id = find_file(db, path=file.path)
+        file.id = file_ids[file.path.lstrip("/")]
 
 def find_directory_file(db, path):
     path = path.strip("/")
@@ -458,20 +690,19 @@ def explode_path(db, invalid=None, file_id=None, directory_id=None):
     assert invalid is None
     assert (file_id is None) != (directory_id is None)
 
-    cursor = db.cursor()
-    path = []
-
     if file_id is not None:
-        cursor.execute("SELECT * FROM filepath(%s)", (file_id,))
+        return path_cache.explodeFiles(db, [file_id])[file_id]
+    elif not directory_id:
+        return [directory_id]
     else:
-        path.append(directory_id)
-        if not directory_id: return path
-        cursor.execute("SELECT * FROM directorypath(%s)", (directory_id,))
+        return path_cache.explodeDirectory(db, directory_id)
 
-    for (directory_id,) in cursor:
-        path.insert(0, directory_id)
+def explode_paths(db, file_ids):
+    """Return a dictionary mapping each file ID in 'file_ids' to the same list
+       as explode_path(db, file_id=file_id) would return for it, with a single
+       query for all files not already cached."""
 
-    return path
+    return path_cache.explodeFiles(db, file_ids)
 
 def contained_files(db, directory_id):
     cursor = db.cursor()
@@ -897,6 +1128,89 @@ class Review:
             if not branch: return None
             return Review.fromBranch(db, branch)
 
+def load_commit_graph(repository, included, excluded):
+    """Return a dictionary mapping the SHA-1 of each commit reachable from any
+       commit in 'included' but not from any commit in 'excluded' to the list
+       of its parents' SHA-1s, as listed by a single 'git rev-list --parents'
+       command."""
+
+    graph = {}
+
+    for line in repository.revlist(included, excluded, "--parents"):
+        sha1s = line.split()
+        graph[sha1s[0]] = sha1s[1:]
+
+    return graph
+
+def filter_reachable(db, branch_ids, sha1s):
+    """Return the set of the SHA-1s in 'sha1s' whose commits are in the
+       reachable set of any of the branches in 'branch_ids'."""
+
+    sha1s = list(sha1s)
+
+    if not sha1s or not branch_ids:
+        return set()
+
+    cursor = db.cursor()
+    cursor.execute("""SELECT DISTINCT commits.sha1
+                        FROM commits
+                        JOIN reachable ON (reachable.commit=commits.id)
+                       WHERE reachable.branch=ANY (%s)
+                         AND commits.sha1=ANY (%s)""",
+                   (list(branch_ids), sha1s))
+
+    return set(sha1 for (sha1,) in cursor)
+
+def add_reachable(db, branch_id, sha1s):
+    """Add the commits in 'sha1s' to the branch's reachable set."""
+
+    sha1s = list(sha1s)
+
+    if sha1s:
+        cursor = db.cursor()
+        cursor.execute("""INSERT INTO reachable (branch, commit)
+                               SELECT %s, commits.id
+                                 FROM commits
+                                WHERE commits.sha1=ANY (%s)""",
+                       (branch_id, sha1s))
+
+def remove_reachable(db, branch_id, sha1s):
+    """Remove the commits in 'sha1s' from the branch's reachable set."""
+
+    sha1s = list(sha1s)
+
+    if sha1s:
+        cursor = db.cursor()
+        cursor.execute("""DELETE FROM reachable
+                                USING commits
+                                WHERE reachable.branch=%s
+                                  AND reachable.commit=commits.id
+                                  AND commits.sha1=ANY (%s)""",
+                       (branch_id, sha1s))
+
+def set_reachable(db, branch_id, sha1s):
+    """Make the branch's reachable set consist of exactly the commits in
+       'sha1s', adding and removing only the rows that differ.  Returns a tuple
+       containing the number of commits added and removed."""
+
+    cursor = db.cursor()
+    cursor.execute("""SELECT commits.sha1
+                        FROM commits
+                        JOIN reachable ON (reachable.commit=commits.id)
+                       WHERE reachable.branch=%s""",
+                   (branch_id,))
+
+    current = set(sha1 for (sha1,) in cursor)
+    wanted = set(sha1s)
+
+    added = wanted - current
+    removed = current - wanted
+
+    remove_reachable(db, branch_id, removed)
+    add_reachable(db, branch_id, added)
+
+    return len(added), len(removed)
+
 class Branch:
     def __init__(self, id, repository, name, head, base, tail, branch_type, review_id):
         self.id = id
@@ -937,9 +1251,10 @@ class Branch:
         if self.commits is None:
             cursor = db.cursor()
             cursor.execute("SELECT commits.id, commits.sha1 FROM reachable, commits WHERE reachable.branch=%s AND reachable.commit=commits.id", [self.id])
-            self.commits = []
-            for commit_id, sha1 in cursor:
-                self.commits.append(gitutils.Commit.fromSHA1(db, self.repository, sha1, commit_id=commit_id))
+            rows = cursor.fetchall()
+            self.commits = gitutils.Commit.fromSHA1s(db, self.repository,
+                                                     [sha1 for commit_id, sha1 in rows],
+                                                     [commit_id for commit_id, sha1 in rows])
 
     def rebase(self, db, base):
         cursor = db.cursor()
@@ -953,11 +1268,41 @@ class Branch:
                 if branch_id is None: break
                 bases.append(branch_id)
 
-            expression = "SELECT 1 FROM reachable, commits WHERE branch IN (%s) AND commit=id AND sha1=%%s" % ", ".join(["%s"] * len(bases))
+            cursor.execute("""SELECT commits.sha1
+                                FROM branches
+                                JOIN commits ON (commits.id=branches.head)
+                               WHERE branches.id=ANY (%s)""",
+                           (bases,))
+
+            # Normally, everything reachable from the heads of the base
+            # branches is in their reachable sets, so only the commits that
+            # aren't reachable from those heads need to be looked at.  Those
+            # are listed, with their parents, by a single 'git rev-list'
+            # command, and checked against the reachable sets with a single
+            # query, together with the parents just outside the listed range.
+            graph = load_commit_graph(self.repository, [head], [sha1 for (sha1,) in cursor])
+
+            candidates = set(graph.keys())
+            for parents in graph.values():
+                candidates.update(parents)
+
+            excluded = filter_reachable(db, bases, candidates - force_include)
 
             def exclude(sha1):
-                cursor.execute(expression, bases + [sha1])
-                return cursor.fetchone() is not None
+                if sha1 in force_include: return False
+                if sha1 not in candidates:
+                    # Only reached if a base branch's reachable set lacks a
+                    # commit reachable from its head, so that the walk below
+                    # continues past the listed range.  Check the reachable
+                    # sets for each such commit, instead of assuming that it
+                    # is excluded.
+                    candidates.add(sha1)
+                    excluded.update(filter_reachable(db, bases, [sha1]))
+                return sha1 in excluded
+
+            def parents(sha1):
+                if sha1 in graph: return graph[sha1]
+                return gitutils.Commit.fromSHA1(db, self.repository, sha1).parents
 
             stack = [head.sha1]
             processed = set()
@@ -969,13 +1314,11 @@ class Branch:
                 if sha1 not in processed:
                     processed.add(sha1)
 
-                    commit = gitutils.Commit.fromSHA1(db, self.repository, sha1)
-
                     if sha1 in force_include or not exclude(sha1):
-                        values.append(commit.getId(db))
+                        values.append(sha1)
 
-                        for sha1 in commit.parents:
-                            if sha1 not in processed and (sha1 in force_include or not exclude(sha1)):
+                        for sha1 in parents(sha1):
+                            if sha1 not in processed and not exclude(sha1):
                                 stack.append(sha1)
 
             return values
@@ -984,16 +1327,20 @@ class Branch:
         old_count = cursor.fetchone()[0]
 
         if base.base and base.base.id == self.id:
-            self.loadCommits(db)
+            cursor.execute("""SELECT commits.sha1
+                                FROM commits
+                                JOIN reachable ON (reachable.commit=commits.id)
+                               WHERE reachable.branch=%s""",
+                           (self.id,))
+            our_sha1s = set(sha1 for (sha1,) in cursor)
 
             cursor.execute("SELECT count(*) FROM reachable WHERE branch=%s", (base.id,))
             base_old_count = cursor.fetchone()[0]
 
-            base_reachable = findReachable(base.head, self.base.id, set([commit.sha1 for commit in self.commits]))
+            base_reachable = findReachable(base.head, self.base.id, our_sha1s)
             base_new_count = len(base_reachable)
 
-            cursor.execute("DELETE FROM reachable WHERE branch=%s", [base.id])
-            cursor.executemany("INSERT INTO reachable (branch, commit) VALUES (%s, %s)", [(base.id, commit) for commit in base_reachable])
+            set_reachable(db, base.id, base_reachable)
             cursor.execute("UPDATE branches SET base=%s WHERE id=%s", [self.base.id, base.id])
 
             base.base = self.base
@@ -1005,8 +1352,7 @@ class Branch:
         our_reachable = findReachable(self.head, base.id)
         new_count = len(our_reachable)
 
-        cursor.execute("DELETE FROM reachable WHERE branch=%s", [self.id])
-        cursor.executemany("INSERT INTO reachable (branch, commit) VALUES (%s, %s)", [(self.id, commit) for commit in our_reachable])
+        set_reachable(db, self.id, our_reachable)
         cursor.execute("UPDATE branches SET base=%s WHERE id=%s", [base.id, self.id])
 
         self.base = base
@@ -464,6 +464,37 @@ class File:
         try: return re_indent_tabs_mode.search(modeline).group(1) == "t"
         except: return default
 
+    @staticmethod
+    def loadPlainLines(files):
+        """Load the plain lines of the old and new versions of all files.
+
+           Unlike calling loadOldLines() and loadNewLines() on each file, this
+           fetches all the blobs from the repository in a single batch."""
+        from diff.parse import splitlines
+
+        def wanted(sha1, mode, plain):
+            return sha1 is not None and sha1 != '0' * 40 and mode != "160000" and not plain
+
+        loads = []
+
+        for file in files:
+            if wanted(file.old_sha1, file.old_mode, file.old_plain): loads.append((file, True))
+            if wanted(file.new_sha1, file.new_mode, file.new_plain): loads.append((file, False))
+
+        if not loads: return
+
+        repository = loads[0][0].repository
+        sha1s = [file.old_sha1 if old else file.new_sha1 for file, old in loads]
+
+        for (file, old), gitobject in zip(loads, repository.iterfetch(sha1s)):
+            data = gitobject.data
+            if old:
+                file.old_plain = splitlines(data)
+                file.old_eof_eol = data and data[-1] in "\n\r"
+            else:
+                file.new_plain = splitlines(data)
+                file.new_eof_eol = data and data[-1] in "\n\r"
+
     @staticmethod
     def sorted(files, key=lambda file: file.path):
         def compareFilenames(a, b):
@@ -15,6 +15,8 @@
 # the License.
 
 import difflib
+import bisect
+import heapq
 import re
 
 re_ignore = re.compile("^\\s*(?:[{}*]|else|do|\\*/)?\\s*$")
@@ -22,12 +24,23 @@ re_words = re.compile("([0-9]+|[A-Z][a-z]+|[A-Z]+|[a-z]+|[\\[\\]{}()]|\\s+|.)")
 re_ws = re.compile("\\s+")
 re_conflict = re.compile("^<<<<<<< .*$|^=======$|^>>>>>>> .*$")
 
+# Chunks with more pairs of deleted and inserted lines than this are not
+# analyzed line by line as a whole; instead, lines that are unchanged except
+# for white-space are matched first, and the chunks between them analyzed.
+MAXIMUM_LINE_PAIRS = 100000
+
+# Each deleted line is fully compared with at most this many inserted lines:
+# those with the most (and longest) tokens in common with it, and the closest
+# ones of those if there are more.  Without a limit, a chunk of lines that are
+# all similar to each other would need a full comparison of every pair.
+MAXIMUM_CANDIDATES = 16
+
 def analyzeChunk(deletedLines, insertedLines, moved=False):
     # Pure delete or pure insert, nothing to analyze.
     if not deletedLines or not insertedLines: return None
 
     # Large chunk, analysis would be expensive, so skip it.
-    if len(deletedLines) * len(insertedLines) <= 10000 and not moved:
+    if len(deletedLines) * len(insertedLines) <= MAXIMUM_LINE_PAIRS and not moved:
         analysis = analyzeChunk1(deletedLines, insertedLines)
     else:
         deletedLinesNoWS = [re_ws.sub(" ", line.strip()) for line in deletedLines]
@@ -63,72 +76,149 @@ def analyzeChunk(deletedLines, insertedLines, moved=False):
     if analysis: return analysis
     else: return None
 
+class AnalyzedLine:
+    """A line tokenized once for analysis by analyzeChunk1().
+
+       'counts' maps each non-white-space token in the line to the number of
+       times it occurs in the line."""
+
+    def __init__(self, line):
+        self.line = line
+        self.stripped = line.strip()
+        self.ignored = bool(re_ignore.match(line))
+
+        if not self.ignored:
+            self.words = re_words.findall(line)
+            self.length = len(re_ws.sub("", self.stripped))
+            self.counts = {}
+            for word in self.words:
+                if not word.isspace():
+                    self.counts[word] = self.counts.get(word, 0) + 1
+
+def ratio(sm, a, b, aLength, bLength):
+    matching = 0
+    for i, j, n in sm.get_matching_blocks():
+        matching += sum(map(len, map(str.strip, a[i:i+n])))
+    if aLength > 5 and len(sm.get_matching_blocks()) == 2:
+        return float(matching) / aLength
+    else:
+        return 2.0 * matching / (aLength + bLength)
+
+def maximumRatio(common, aLength, bLength):
+    """Upper bound of ratio() given the number of characters in tokens that the
+       two lines have in common, regardless of their order."""
+    if aLength > 5: return max(float(common) / aLength, 2.0 * common / (aLength + bLength))
+    else: return 2.0 * common / (aLength + bLength)
+
 def analyzeChunk1(deletedLines, insertedLines, offsetA=0, offsetB=0):
+    if len(deletedLines) * len(insertedLines) > MAXIMUM_LINE_PAIRS: return ""
+
+    deleted = map(AnalyzedLine, deletedLines)
+    inserted = map(AnalyzedLine, insertedLines)
+
+    # Map each token to the inserted lines containing it, so that each deleted
+    # line is only compared with the inserted lines it has enough tokens in
+    # common with to possibly match.  This is an upper bound of the ratio of a
+    # full comparison, so no matches are lost this way; only the limit of
+    # MAXIMUM_CANDIDATES full comparisons per deleted line can lose any.
+    postings = {}
+    for insertedIndex, line in enumerate(inserted):
+        if not line.ignored:
+            for word, count in line.counts.items():
+                postings.setdefault(word, []).append((insertedIndex, count))
+
+    # Ignored lines (empty lines, lone braces and such) are only paired with
+    # identical ignored lines.
+    ignoredInserted = {}
+    for insertedIndex, line in enumerate(inserted):
+        if line.ignored:
+            ignoredInserted.setdefault(line.stripped, []).append(insertedIndex)
+
+    # The inserted lines' SequenceMatcher objects are reused for every deleted
+    # line; SequenceMatcher caches information about its second sequence.
+    matchers = {}
+
+    # Used to estimate where in the inserted lines a deleted line would be.
+    scale = float(len(insertedLines)) / len(deletedLines)
+
     matches = []
     equals = []
 
-    if len(deletedLines) * len(insertedLines) > 10000: return ""
+    for deletedIndex, line in enumerate(deleted):
+        # Don't match conflict lines against anything.
+        if re_conflict.match(line.line): continue
 
-    def ratio(sm, a, b, aLength, bLength):
-        matching = 0
-        for i, j, n in sm.get_matching_blocks():
-            matching += sum(map(len, map(str.strip, a[i:i+n])))
-        if aLength > 5 and len(sm.get_matching_blocks()) == 2:
-            return float(matching) / aLength
-        else:
-            return 2.0 * matching / (aLength + bLength)
+        if line.ignored:
+            for insertedIndex in ignoredInserted.get(line.stripped, ()):
+                equals.append((deletedIndex, insertedIndex))
+            continue
 
-    for deletedIndex, deleted in enumerate(deletedLines):
-        deletedStripped = deleted.strip()
-        deletedNoWS = re_ws.sub("", deletedStripped)
+        common = {}
+        for word, count in line.counts.items():
+            for insertedIndex, insertedCount in postings.get(word, ()):
+                common[insertedIndex] = common.get(insertedIndex, 0) + min(count, insertedCount) * len(word)
 
-        # Don't match conflict lines against anything.
-        if re_conflict.match(deleted): continue
-
-        if not re_ignore.match(deleted):
-            deletedWords = re_words.findall(deleted)
-
-            for insertedIndex, inserted in enumerate(insertedLines):
-                insertedStripped = inserted.strip()
-                insertedNoWS = re_ws.sub("", insertedStripped)
-
-                if not re_ignore.match(inserted):
-                    insertedWords = re_words.findall(inserted)
-                    sm = difflib.SequenceMatcher(None, deletedWords, insertedWords)
-                    r = ratio(sm, deletedWords, insertedWords, len(deletedNoWS), len(insertedNoWS))
-                    if r > 0.5: matches.append((r, deletedIndex, insertedIndex, deletedWords, insertedWords, sm))
-                elif deletedStripped == insertedStripped:
-                    equals.append((deletedIndex, insertedIndex))
-        else:
-            for insertedIndex, inserted in enumerate(insertedLines):
-                if deletedStripped == inserted.strip():
-                    equals.append((deletedIndex, insertedIndex))
+        candidates = []
+        for insertedIndex, commonLength in common.items():
+            bound = maximumRatio(commonLength, line.length, inserted[insertedIndex].length)
+            if bound > 0.5: candidates.append((bound, -abs(insertedIndex - deletedIndex * scale), insertedIndex))
+
+        if len(candidates) > MAXIMUM_CANDIDATES:
+            candidates = heapq.nlargest(MAXIMUM_CANDIDATES, candidates)
+
+        for insertedIndex in sorted(insertedIndex for bound, distance, insertedIndex in candidates):
+            other = inserted[insertedIndex]
+
+            sm = matchers.get(insertedIndex)
+            if sm is None:
+                sm = matchers[insertedIndex] = difflib.SequenceMatcher(None, None, other.words)
+            sm.set_seq1(line.words)
+
+            r = ratio(sm, line.words, other.words, line.length, other.length)
+            if r > 0.5: matches.append((r, deletedIndex, insertedIndex))
 
     if matches:
         matches.sort(key=lambda x: x[0], reverse=True)
 
-        final = []
+        # Greedily pick the best matches that are consistent with the already
+        # picked matches, that is, that don't reuse a line and don't cross
+        # another match.  The picked matches are kept ordered, so that the
+        # consistency check is a matter of comparing with the neighbours.
+        pickedDeleted = []
+        pickedInserted = []
+
+        for r, deletedIndex, insertedIndex in matches:
+            position = bisect.bisect_left(pickedDeleted, deletedIndex)
+            if position < len(pickedDeleted) and pickedDeleted[position] == deletedIndex: continue
+            if position > 0 and pickedInserted[position - 1] >= insertedIndex: continue
+            if position < len(pickedInserted) and pickedInserted[position] <= insertedIndex: continue
+            pickedDeleted.insert(position, deletedIndex)
+            pickedInserted.insert(position, insertedIndex)
+
+        def consistent(deletedIndex, insertedIndex):
+            position = bisect.bisect_right(pickedDeleted, deletedIndex)
+            if position > 0 and insertedIndex < pickedInserted[position - 1]: return False
+            if position < len(pickedInserted) and insertedIndex >= pickedInserted[position]: return False
+            return True
+
+        equals = filter(lambda data: consistent(*data), equals)
+        equals.sort()
 
-        while matches:
-            r, deletedIndex, insertedIndex, deletedWords, insertedWords, sm = matches.pop(0)
-            final.append((deletedIndex, insertedIndex, deletedWords, insertedWords, sm))
-            matches = filter(lambda data: data[1] != deletedIndex and data[2] != insertedIndex and (data[1] < deletedIndex) == (data[2] < insertedIndex), matches)
-            equals = filter(lambda data: (data[0] < deletedIndex) == (data[1] < insertedIndex), equals)
+        final = zip(pickedDeleted, pickedInserted)
+        final.append((len(deletedLines), len(insertedLines)))
 
-        final.sort()
-        equals.sort()
         result = []
 
         previousDeletedIndex = -1
         previousInsertedIndex = -1
 
-        equals0 = equals[:]
-
-        final.append((len(deletedLines), len(insertedLines), None, None, None))
+        nequals = len(equals)
+        equalsIndex = 0
 
-        for deletedIndex, insertedIndex, deletedWords, insertedWords, sm in final:
-            while equals and (equals[0][0] < deletedIndex or equals[0][1] < insertedIndex):
-                di, ii = equals.pop(0)
+        for deletedIndex, insertedIndex in final:
+            while equalsIndex < nequals and (equals[equalsIndex][0] < deletedIndex or equals[equalsIndex][1] < insertedIndex):
+                di, ii = equals[equalsIndex]
+                equalsIndex += 1
                 if previousDeletedIndex < di < deletedIndex and previousInsertedIndex < ii < insertedIndex:
                     deletedLine = deletedLines[di]
                     insertedLine = insertedLines[ii]
@@ -137,9 +227,9 @@ def analyzeChunk1(deletedLines, insertedLines, offsetA=0, offsetB=0):
                     else: result.append("%d=%d" % (di + offsetA, ii + offsetB))
                     previousDeletedIndex = di
                     previousInsertedIndex = ii
-                while equals and (di == equals[0][0] or ii == equals[0][1]): equals.pop(0)
+                while equalsIndex < nequals and (di == equals[equalsIndex][0] or ii == equals[equalsIndex][1]): equalsIndex += 1
 
-            if sm is None: break
+            if deletedIndex == len(deletedLines): break
 
             lineDiff = []
             deletedLine = deletedLines[deletedIndex]
@@ -148,6 +238,9 @@ def analyzeChunk1(deletedLines, insertedLines, offsetA=0, offsetB=0):
                 lineDiff.append("ws")
                 lineDiff.append(analyzeWhiteSpaceLine(deletedLine, insertedLine))
             else:
+                deletedWords = deleted[deletedIndex].words
+                insertedWords = inserted[insertedIndex].words
+                sm = difflib.SequenceMatcher(None, deletedWords, insertedWords)
                 for tag, i1, i2, j1, j2 in sm.get_opcodes():
                     if tag == 'replace': lineDiff.append("r%d-%d=%d-%d" % (offsetInLine(deletedWords, i1), offsetInLine(deletedWords, i2), offsetInLine(insertedWords, j1), offsetInLine(insertedWords, j2)))
                     elif tag == 'delete': lineDiff.append("d%d-%d" % (offsetInLine(deletedWords, i1), offsetInLine(deletedWords, i2)))
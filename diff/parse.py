@@ -22,6 +22,10 @@ import re
 import itertools
 import analyze
 
+# Number of files with only white-space changes whose versions are fetched
+# from the repository at a time.
+WHITESPACE_ONLY_BATCH = 50
+
 def splitlines(source):
     if not source: return source
     elif source[-1] == "\n": return source[:-1].split("\n")
@@ -158,6 +162,38 @@ def parseDifferences(repository, commit=None, from_commit=None, to_commit=None,
          dict(parent_sha1 => [diff.File, ...] (if selected_path is None)
          diff.File                            (if selected_path is not None)"""
 
+    files = []
+    selected_file = None
+
+    for file in iterDifferences(repository, commit, from_commit, to_commit, filter_paths, selected_path, simple):
+        # Don't keep the contents of all files in memory.
+        file.old_plain = file.new_plain = None
+
+        if selected_path is not None and file.path == selected_path:
+            selected_file = file
+        files.append(file)
+
+    if from_commit and to_commit:
+        if selected_path is not None:
+            return selected_file
+        else:
+            return { from_commit.sha1: files }
+    elif not commit.parents:
+        return { None: files }
+    else:
+        return { commit.parents[0]: files }
+
+def iterDifferences(repository, commit=None, from_commit=None, to_commit=None, filter_paths=None, selected_path=None, simple=False):
+    """iterDifferences(repository, [commit] | [from_commit, to_commit][, selected_path]) => iterator
+
+       Yield a diff.File object for each changed file, in path order, as
+       git's output is read, so that the differences of any number of files
+       can be processed without holding all of them in memory.  Files whose
+       changes are all white-space changes follow the other files.
+
+       The plain lines of the yielded files may already be loaded; call
+       clean() on each file once done with it."""
+
     options = []
 
     if from_commit and to_commit:
@@ -176,11 +212,13 @@ def parseDifferences(repository, commit=None, from_commit=None, to_commit=None,
         command = 'diff'
         what = commit.parents[0] + '..' + commit.sha1
 
+    # Files with only white-space changes are left out of the differences
+    # when using --ignore-space-change, but they are still listed in the raw
+    # output, which git writes before the differences.
     if filter_paths is None and selected_path is None and not simple:
-        names = repository.run(command, *(options + ["--name-only", what]))
-        paths = set(filter(None, map(str.strip, names.splitlines())))
+        whitespace_only = {}
     else:
-        paths = set()
+        whitespace_only = None
 
     if not simple:
         options.append('--ignore-space-change')
@@ -194,37 +232,30 @@ def parseDifferences(repository, commit=None, from_commit=None, to_commit=None,
         options.append('--')
         options.append(selected_path)
 
-    stdout = repository.run(command, '--full-index', '--unified=1', '--patience', *options)
-    selected_file = None
+    lines = repository.iterlines(command, '--raw', '--no-abbrev', '--full-index', '--unified=1', '--patience', *options)
 
     re_chunk = re.compile('^@@ -(\\d+)(?:,\\d+)? \\+(\\d+)(?:,\\d+)? @@')
     re_binary = re.compile('^Binary files (?:a/(.+)|/dev/null) and (?:b/(.+)|/dev/null) differ')
     re_diff = re.compile("^diff --git a/(.*) b/(.*)$")
 
-    def isplitlines(text):
-        start = 0
-        length = len(text)
-
-        while start < length:
-            try:
-                end = text.index('\n', start)
-                yield text[start:end]
-                start = end + 1
-            except ValueError:
-                yield text[start:]
-                break
-
-    lines = isplitlines(stdout)
-
-    included = set()
-    files = []
-    files_by_path = {}
+    # The file currently being parsed, and files that are complete and ready
+    # to be yielded.  Differences in the same path (for instance when a file
+    # is replaced by a symbolic link) are adjacent in the output, and merged
+    # into one diff.File object.
+    current = [None]
+    finished = []
 
     def addFile(new_file):
-        assert new_file.path not in files_by_path
-        files.append(new_file)
-        files_by_path[new_file.path] = new_file
-        included.add(new_file.path)
+        if current[0]:
+            assert new_file.path != current[0].path
+            finished.append(current[0])
+        current[0] = new_file
+        if whitespace_only:
+            whitespace_only.pop(new_file.path, None)
+
+    def finish(file):
+        if not simple: mergeChunks(file)
+        return file
 
     old_mode = None
     new_mode = None
@@ -232,9 +263,20 @@ def parseDifferences(repository, commit=None, from_commit=None, to_commit=None,
     try:
         line = lines.next()
 
+        while line.startswith(":"):
+            if whitespace_only is not None:
+                modes_and_sha1s, path = line[1:].split("\t", 1)
+                raw_old_mode, raw_new_mode, raw_old_sha1, raw_new_sha1, status = modes_and_sha1s.split(" ")
+                if "160000" not in (raw_old_mode, raw_new_mode):
+                    whitespace_only[path] = (raw_old_sha1, raw_new_sha1)
+            line = lines.next()
+
         names = None
 
         while True:
+            for file in finished: yield finish(file)
+            del finished[:]
+
             old_mode = None
             new_mode = None
 
@@ -269,7 +311,7 @@ def parseDifferences(repository, commit=None, from_commit=None, to_commit=None,
                 old_sha1, new_sha1 = line[6:].split(' ', 1)[0].split("..")
 
             try: line = lines.next()
-            except:
+            except StopIteration:
                 if new_mode is not None:
                     assert names[0] == names[1]
 
@@ -279,6 +321,8 @@ def parseDifferences(repository, commit=None, from_commit=None, to_commit=None,
 
                     old_mode = new_mode = None
 
+                raise
+
             if re_diff.match(line):
                 new_file = diff.File(None, names[0] or names[1], old_sha1, new_sha1, repository, old_mode=old_mode, new_mode=new_mode)
 
@@ -341,7 +385,7 @@ def parseDifferences(repository, commit=None, from_commit=None, to_commit=None,
                                      old_mode=old_mode, new_mode=new_mode,
                                      chunks=[diff.Chunk(1, 1, 1, 1, analysis="0=0:r18-58=18-58")])
 
-                if path not in files_by_path: addFile(new_file)
+                if not current[0] or current[0].path != path: addFile(new_file)
 
                 old_mode = new_mode = None
 
@@ -358,14 +402,16 @@ def parseDifferences(repository, commit=None, from_commit=None, to_commit=None,
                 inserted_lines = []
 
                 if old_path and new_path and not simple:
-                    old_lines = splitlines(repository.fetch(old_sha1).data)
-                    new_lines = splitlines(repository.fetch(new_sha1).data)
+                    old_data = repository.fetch(old_sha1).data
+                    new_data = repository.fetch(new_sha1).data
+                    old_lines = splitlines(old_data)
+                    new_lines = splitlines(new_data)
                 else:
                     old_lines = None
                     new_lines = None
 
-                if path in files_by_path:
-                    new_file = files_by_path[path]
+                if current[0] and current[0].path == path:
+                    new_file = current[0]
                     if old_sha1 != '0' * 40:
                         assert new_file.old_sha1 == '0' * 40
                         new_file.old_sha1 = old_sha1
@@ -377,13 +423,16 @@ def parseDifferences(repository, commit=None, from_commit=None, to_commit=None,
                     new_file.chunks = []
                 else:
                     new_file = diff.File(None, path, old_sha1, new_sha1, repository, old_mode=old_mode, new_mode=new_mode, chunks=[])
+                    addFile(new_file)
 
-                old_mode = new_mode = None
-
-                if selected_path is not None and selected_path == path:
-                    selected_file = new_file
+                    if old_lines is not None:
+                        # Keep the lines for mergeChunks().
+                        new_file.old_plain = old_lines
+                        new_file.old_eof_eol = old_data and old_data[-1] in "\n\r"
+                        new_file.new_plain = new_lines
+                        new_file.new_eof_eol = new_data and new_data[-1] in "\n\r"
 
-                if path not in files_by_path: addFile(new_file)
+                old_mode = new_mode = None
 
                 previous_delete_offset = 1
                 previous_insert_offset = 1
@@ -408,7 +457,7 @@ def parseDifferences(repository, commit=None, from_commit=None, to_commit=None,
                         if line[0] not in (' ', '-', '+'): break
 
                         if line[0] != ' ' and previous_delete_offset is not None and old_lines and new_lines and not simple:
-                            detectWhiteSpaceChanges(files[-1], old_lines, previous_delete_offset, delete_offset, True, new_lines, previous_insert_offset, insert_offset, True)
+                            detectWhiteSpaceChanges(new_file, old_lines, previous_delete_offset, delete_offset, True, new_lines, previous_insert_offset, insert_offset, True)
                             previous_delete_offset = None
 
                         if line[0] == ' ' and previous_delete_offset is None:
@@ -429,7 +478,7 @@ def parseDifferences(repository, commit=None, from_commit=None, to_commit=None,
                                                       deleted_lines,
                                                       insert_offset - len(inserted_lines),
                                                       inserted_lines)
-                                files[-1].chunks.extend(chunks)
+                                new_file.chunks.extend(chunks)
                                 deleted_lines = []
                                 inserted_lines = []
 
@@ -441,12 +490,12 @@ def parseDifferences(repository, commit=None, from_commit=None, to_commit=None,
                                               deleted_lines,
                                               insert_offset - len(inserted_lines),
                                               inserted_lines)
-                        files[-1].chunks.extend(chunks)
+                        new_file.chunks.extend(chunks)
                         deleted_lines = []
                         inserted_lines = []
 
                 if previous_delete_offset is not None and old_lines and new_lines and not simple:
-                    detectWhiteSpaceChanges(files[-1], old_lines, previous_delete_offset, len(old_lines) + 1, True, new_lines, previous_insert_offset, len(new_lines) + 1, True)
+                    detectWhiteSpaceChanges(new_file, old_lines, previous_delete_offset, len(old_lines) + 1, True, new_lines, previous_insert_offset, len(new_lines) + 1, True)
                     previous_delete_offset = None
             except StopIteration:
                 if deleted_lines or inserted_lines:
@@ -454,12 +503,12 @@ def parseDifferences(repository, commit=None, from_commit=None, to_commit=None,
                                           deleted_lines,
                                           insert_offset - len(inserted_lines),
                                           inserted_lines)
-                    files[-1].chunks.extend(chunks)
+                    new_file.chunks.extend(chunks)
                     deleted_lines = []
                     inserted_lines = []
 
                 if previous_delete_offset is not None and old_lines and new_lines and not simple:
-                    detectWhiteSpaceChanges(files[-1], old_lines, previous_delete_offset, len(old_lines) + 1, True, new_lines, previous_insert_offset, len(new_lines) + 1, True)
+                    detectWhiteSpaceChanges(new_file, old_lines, previous_delete_offset, len(old_lines) + 1, True, new_lines, previous_insert_offset, len(new_lines) + 1, True)
 
                 raise
     except StopIteration:
@@ -468,51 +517,44 @@ def parseDifferences(repository, commit=None, from_commit=None, to_commit=None,
 
             addFile(diff.File(None, names[0], None, None, repository, old_mode=old_mode, new_mode=new_mode, chunks=[]))
 
-    for path in (paths - included):
-        lines = isplitlines(repository.run(command, '--full-index', '--unified=1', what, '--', path))
+    if current[0]: finished.append(current[0])
 
-        try:
-            line = lines.next()
+    for file in finished: yield finish(file)
 
-            while not line.startswith("index "): line = lines.next()
+    if whitespace_only:
+        # Files with only white-space changes.  Fetch their versions in
+        # batches.  Each batch is fetched completely before any file is
+        # yielded, since the caller may fetch other objects from the
+        # repository before resuming us.
+        paths = sorted(path for path, (old_sha1, new_sha1) in whitespace_only.items()
+                       if old_sha1 != '0' * 40 and new_sha1 != '0' * 40)
 
-            try:
-                sha1range, mode = line[6:].split(' ')
-                if mode == "160000":
-                    continue
-                old_sha1, new_sha1 = sha1range.split("..")
-            except:
-                old_sha1, new_sha1 = line[6:].split(' ', 1)[0].split("..")
+        def endsWithLinebreak(data): return data and data[-1] in "\n\r"
 
-            if old_sha1 == '0' * 40 or new_sha1 == '0' * 40:
-                # Added or removed empty file.
-                continue
+        for offset in range(0, len(paths), WHITESPACE_ONLY_BATCH):
+            batch = paths[offset:offset + WHITESPACE_ONLY_BATCH]
+            sha1s = []
 
-            addFile(diff.File(None, path, old_sha1, new_sha1, repository, chunks=[]))
+            for path in batch:
+                sha1s.extend(whitespace_only[path])
 
-            old_data = repository.fetch(old_sha1).data
-            old_lines = splitlines(old_data)
-            new_data = repository.fetch(new_sha1).data
-            new_lines = splitlines(new_data)
+            objects = iter(repository.fetchMany(sha1s))
+            processed = []
 
-            assert len(old_lines) == len(new_lines), "%s:%d != %s:%d" % (old_sha1, len(old_lines), new_sha1, len(new_lines))
+            for path in batch:
+                old_sha1, new_sha1 = whitespace_only[path]
 
-            def endsWithLinebreak(data): return data and data[-1] in "\n\r"
+                new_file = diff.File(None, path, old_sha1, new_sha1, repository, chunks=[])
 
-            detectWhiteSpaceChanges(files[-1], old_lines, 1, len(old_lines) + 1, endsWithLinebreak(old_data), new_lines, 1, len(new_lines) + 1, endsWithLinebreak(new_data))
-        except StopIteration:
-            pass
+                old_data = objects.next().data
+                old_lines = splitlines(old_data)
+                new_data = objects.next().data
+                new_lines = splitlines(new_data)
 
-    if not simple:
-        for file in files:
-            mergeChunks(file)
+                assert len(old_lines) == len(new_lines), "%s:%d != %s:%d" % (old_sha1, len(old_lines), new_sha1, len(new_lines))
 
-    if from_commit and to_commit:
-        if selected_path is not None:
-            return selected_file
-        else:
-            return { from_commit.sha1: files }
-    elif not commit.parents:
-        return { None: files }
-    else:
-        return { commit.parents[0]: files }
+                detectWhiteSpaceChanges(new_file, old_lines, 1, len(old_lines) + 1, endsWithLinebreak(old_data), new_lines, 1, len(new_lines) + 1, endsWithLinebreak(new_data))
+
+                processed.append(new_file)
+
+            for new_file in processed: yield finish(new_file)
@@ -1,4 +1,4 @@
-blahaaaaaaaa# -*- mode: python; encoding: utf-8 -*-
+# -*- mode: python; encoding: utf-8 -*-
 #
 # Copyright 2012 Jens Lindström, Opera Software ASA
 #
@@ -31,15 +31,26 @@ import shutil
 import os
 import atexit
 import stat
+import errno
+import signal
+import tempfile
+from collections import OrderedDict
 
 re_author_committer = re.compile("(.*) <(.*)> ([0-9]+ [-+][0-9]+)")
 re_sha1 = re.compile("^[A-Za-z0-9]{40}$")
+re_hex = re.compile("^[0-9A-Fa-f]{4,40}$")
+
+# Program run by 'python -c' to run a command (given as the remaining
+# arguments) in a new session and process group.
+SETSID_AND_EXEC = "import os, sys; os.setsid(); os.execvp(sys.argv[1], sys.argv[1:])"
 
 REPOSITORY_REPLAY_PATH_FORMAT = os.path.join(configuration.paths.DATA_DIR,
                                              "temporary",
                                              "%(repository.name)s",
                                              "%(user.name)s_%(commit.sha1)s_%(time)s")
 
+OBJECT_CACHE_DIR = os.path.join(configuration.paths.CACHE_DIR, "git-objects")
+
 class GitError(Exception):
     def __init__(self, message, sha1=None, ref=None, repository=None):
         super(GitError, self).__init__(message)
@@ -60,6 +71,171 @@ class GitObject:
         elif index == 2: return self.data
         raise IndexError, "GitObject index out of range: %d" % index
 
+class ObjectCache:
+    """Cache of git objects, with a size budget per object type.
+
+       Objects are evicted in least recently used order when the total size
+       of the cached objects of one type exceeds the budget for that type
+       (configuration.limits.OBJECT_CACHE_LIMITS.)  One cache is shared by
+       all repositories used by a database session."""
+
+    # Approximate per-object overhead, in bytes, added to the object's size.
+    OVERHEAD = 256
+
+    def __init__(self, db):
+        self.__db = db
+        self.__limits = configuration.limits.OBJECT_CACHE_LIMITS
+        self.__objects = {}
+        self.__sizes = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def get(db):
+        cache = db.storage.get("ObjectCache")
+        if cache is None:
+            cache = db.storage["ObjectCache"] = ObjectCache(db)
+        return cache
+
+    def lookup(self, sha1):
+        for object_type, objects in self.__objects.items():
+            git_object = objects.pop(sha1, None)
+            if git_object:
+                # Re-insert to mark it as the most recently used object.
+                objects[sha1] = git_object
+                self.hits += 1
+                self.__db.recordProfiling("object cache: %s hit" % object_type, 0)
+                return git_object
+        self.misses += 1
+        self.__db.recordProfiling("object cache: miss", 0)
+        return None
+
+    def add(self, git_object):
+        object_type = git_object.type
+        limit = self.__limits.get(object_type, 0)
+        size = git_object.size + ObjectCache.OVERHEAD
+
+        if git_object.data is None or size > limit:
+            return
+
+        objects = self.__objects.setdefault(object_type, OrderedDict())
+        if git_object.sha1 in objects: return
+
+        objects[git_object.sha1] = git_object
+        total = self.__sizes.get(object_type, 0) + size
+
+        while total > limit:
+            evicted_sha1, evicted = objects.popitem(last=False)
+            total -= evicted.size + ObjectCache.OVERHEAD
+            self.evictions += 1
+            self.__db.recordProfiling("object cache: %s evicted" % object_type, 0, rows=evicted.size)
+
+        self.__sizes[object_type] = total
+
+    def size(self, object_type=None):
+        if object_type is None: return sum(self.__sizes.values())
+        else: return self.__sizes.get(object_type, 0)
+
+class DiskObjectCache:
+    """Cache of git objects on disk, shared by all processes.
+
+       Objects are stored in files named by their SHA-1 in a directory per
+       repository under OBJECT_CACHE_DIR, so that a repository never finds an
+       object that only another repository contains.  Since objects are
+       immutable, cached objects never need to be invalidated; evict() is
+       called regularly by the changeset background service to keep the total
+       size of the cache below configuration.limits.DISK_OBJECT_CACHE_LIMIT."""
+
+    # Only commits and trees are cached; blobs are typically both larger and
+    # less frequently reused.
+    TYPES = frozenset(["commit", "tree"])
+
+    @staticmethod
+    def enabled():
+        return configuration.limits.DISK_OBJECT_CACHE_LIMIT > 0
+
+    @staticmethod
+    def path(repository_name, sha1):
+        return os.path.join(OBJECT_CACHE_DIR, repository_name, sha1[:2], sha1[2:])
+
+    @staticmethod
+    def lookup(repository_name, sha1):
+        if not DiskObjectCache.enabled(): return None
+
+        try:
+            with open(DiskObjectCache.path(repository_name, sha1)) as cached_file:
+                header, data = cached_file.read().split("\n", 1)
+            object_type, object_size = header.split(" ")
+            object_size = int(object_size)
+        except (IOError, ValueError):
+            return None
+
+        # Ignore (presumably) truncated files.
+        if len(data) != object_size: return None
+
+        return GitObject(sha1, object_type, object_size, data)
+
+    @staticmethod
+    def add(repository_name, git_object):
+        if not DiskObjectCache.enabled() or git_object.type not in DiskObjectCache.TYPES or git_object.data is None:
+            return
+
+        path = DiskObjectCache.path(repository_name, git_object.sha1)
+        if os.path.exists(path): return
+
+        try: os.makedirs(os.path.dirname(path))
+        except OSError, error:
+            if error.errno == errno.EEXIST: pass
+            else: return
+
+        # Write to a temporary file and rename it into place, so that other
+        # processes never see a partially written file.
+        temporary_path = "%s.%d.tmp" % (path, os.getpid())
+
+        try:
+            with open(temporary_path, "w") as cached_file:
+                cached_file.write("%s %d\n" % (git_object.type, git_object.size))
+                cached_file.write(git_object.data)
+            os.rename(temporary_path, path)
+        except (IOError, OSError):
+            try: os.unlink(temporary_path)
+            except OSError: pass
+
+    @staticmethod
+    def evict(limit=None):
+        """Delete the least recently added objects until the total size of
+           the cache is below the limit.  Returns the number of deleted
+           objects and the total size of the cache afterwards."""
+
+        if limit is None: limit = configuration.limits.DISK_OBJECT_CACHE_LIMIT
+        if not os.path.isdir(OBJECT_CACHE_DIR): return 0, 0
+
+        entries = []
+        total_size = 0
+
+        # os.walk() skips directories that can't be listed (because they were
+        # removed concurrently, say.)
+        for directory_path, directory_names, filenames in os.walk(OBJECT_CACHE_DIR):
+            for filename in filenames:
+                path = os.path.join(directory_path, filename)
+                try: status = os.stat(path)
+                except OSError: continue
+                entries.append((status.st_mtime, status.st_size, path))
+                total_size += status.st_size
+
+        entries.sort()
+        evicted = 0
+
+        for mtime, size, path in entries:
+            if total_size <= limit: break
+            try: os.unlink(path)
+            except OSError: continue
+            total_size -= size
+            evicted += 1
+
+        return evicted, total_size
+
 class NoSuchRepository(base.Error):
     def __init__(self, value):
         super(NoSuchRepository, self).__init__("No such repository: %s" % str(value))
@@ -83,6 +259,9 @@ class Repository:
         self.__main_branch_id = main_branch_id
         self.__batch = None
         self.__batchCheck = None
+        self.__batchBusy = set()
+        self.__names = {}
+        self.__mergebases = {}
         self.__cacheBlobs = False
         self.__cacheDisabled = False
 
@@ -95,8 +274,6 @@ class Repository:
             self.__db = None
             atexit.register(self.__terminate)
 
-        self.__startBatch()
-
     def __str__(self):
         return "%s:%s" % (configuration.base.HOSTNAME, self.path)
 
@@ -157,18 +334,17 @@ class Repository:
             if repository.iscommit(sha1): return repository
 
     def __terminate(self, db=None):
-        if self.__batch:
-            try: kill(self.__batch.pid, 9)
+        self.__stopBatch(True)
+        self.__stopBatch(False)
+
+    def __stopBatch(self, fetchData):
+        if fetchData: git, self.__batch = self.__batch, None
+        else: git, self.__batchCheck = self.__batchCheck, None
+        if git:
+            try: kill(git.pid, 9)
             except: pass
-            try: self.__batch.wait()
+            try: git.wait()
             except: pass
-            self.__batch = None
-        if self.__batchCheck:
-            try: kill(self.__batchCheck.pid, 9)
-            except: pass
-            try: self.__batchCheck.wait()
-            except: pass
-            self.__batchCheck = None
 
     def __startBatch(self):
         if self.__batch is None:
@@ -177,8 +353,65 @@ class Repository:
 
     def __startBatchCheck(self):
         if self.__batchCheck is None:
+            # Warnings (about ambiguous ref names, for instance) would put
+            # the output out of sync with the input, so discard them.
             self.__batchCheck = process([configuration.executables.GIT, 'cat-file', '--batch-check'],
-                                        stdin=PIPE, stdout=PIPE, stderr=STDOUT, cwd=self.path)
+                                        stdin=PIPE, stdout=PIPE, stderr=open(os.devnull, "w"), cwd=self.path)
+
+    def __beginBatch(self, fetchData):
+        """Claim the 'git cat-file --batch' (or '--batch-check') process for
+           one fetch, starting it if necessary, and return it.
+
+           Replies are read in the order requests were written, so two fetches
+           using the process at the same time would read each other's replies;
+           that raises a GitError instead."""
+
+        if fetchData in self.__batchBusy:
+            raise GitError("concurrent object fetches from %s" % self.path, repository=self)
+
+        if fetchData:
+            self.__startBatch()
+            git = self.__batch
+        else:
+            self.__startBatchCheck()
+            git = self.__batchCheck
+
+        self.__batchBusy.add(fetchData)
+        return git
+
+    def __endBatch(self, fetchData, in_sync=True):
+        """Release the process claimed by __beginBatch().  If its output may
+           not be in sync with its input, kill it; it is restarted by the next
+           fetch."""
+
+        self.__batchBusy.discard(fetchData)
+        if not in_sync: self.__stopBatch(fetchData)
+
+    def __readObject(self, stdout, requested, fetchData):
+        """Read the reply to a request for 'requested' from a batch process.
+           Returns a GitObject, or None if the object is missing."""
+
+        line = stdout.readline()
+
+        if line == ("%s missing\n" % requested):
+            return None
+
+        try: sha1, type, size = line.split()
+        except: raise GitError("unexpected output from 'git cat-file --batch': %s" % line)
+
+        if re_sha1.match(requested) and sha1 != requested.lower():
+            raise GitError("'git cat-file --batch' returned %s when %s was requested" % (sha1[:8], requested[:8]),
+                           sha1=requested, repository=self)
+
+        size = int(size)
+
+        if fetchData:
+            data = stdout.read(size)
+            stdout.read(1)
+        else:
+            data = None
+
+        return GitObject(sha1, type, size, data)
 
     def getJS(self):
         return "var repository = critic.repository = new Repository(%d, %s, %s);" % (self.id, htmlutils.jsify(self.name), htmlutils.jsify(self.path))
@@ -210,61 +443,204 @@ class Repository:
         else:
             return None
 
-    def fetch(self, sha1, fetchData=True):
-        if self.__db:
-            cache = self.__db.storage["Repository"]
-            cached_object = cache.get("object:" + sha1)
-            if cached_object:
-                self.__db.recordProfiling("fetch: " + cached_object.type + " (cached)", 0)
-                return cached_object
+    def __getObjectCache(self):
+        if self.__db and not self.__cacheDisabled:
+            return ObjectCache.get(self.__db)
+        else:
+            return None
 
-        before = time.time()
+    def __cacheObject(self, cache, git_object):
+        if cache and (git_object.type != "blob" or self.__cacheBlobs):
+            cache.add(git_object)
 
-        if fetchData:
-            self.__startBatch()
-            stdin, stdout = self.__batch.stdin, self.__batch.stdout
-        else:
-            self.__startBatchCheck()
-            stdin, stdout = self.__batchCheck.stdin, self.__batchCheck.stdout
+    def __useDiskCache(self):
+        # The disk cache is organized by repository name, so a repository
+        # object without one can't use it.
+        return not self.__cacheDisabled and self.name is not None
 
-        stdin.write(sha1 + '\n')
-        line = stdout.readline()
+    def __lookupCached(self, cache, sha1, object_type):
+        if cache:
+            git_object = cache.lookup(sha1)
+            if git_object: return git_object
 
-        if line == ("%s missing\n" % sha1):
-            raise GitError("%s missing from %s" % (sha1[:8], self.path), sha1=sha1, repository=self)
+        # Only look on disk if the caller expects a type of object that the
+        # disk cache stores; a failed lookup for every blob would be wasted.
+        if object_type in DiskObjectCache.TYPES and self.__useDiskCache():
+            before = time.time()
+            git_object = DiskObjectCache.lookup(self.name, sha1)
+            if git_object:
+                if self.__db:
+                    self.__db.recordProfiling("fetch: " + git_object.type + " (disk cache)", time.time() - before)
+                self.__cacheObject(cache, git_object)
+                return git_object
 
-        try: sha1, type, size = line.split()
-        except: raise GitError("unexpected output from 'git cat-file --batch': %s" % line)
+        return None
 
-        size = int(size)
+    def fetch(self, sha1, fetchData=True, object_type=None):
+        """Fetch an object, returning a GitObject.
 
-        if fetchData:
-            data = stdout.read(size)
-            stdout.read(1)
-        else:
-            data = None
+           If specified, 'object_type' is the type of object the caller
+           expects; the disk cache is only consulted if it is a commit or a
+           tree."""
+
+        cache = self.__getObjectCache()
+        cached_object = self.__lookupCached(cache, sha1, object_type)
+        if cached_object: return cached_object
+
+        before = time.time()
 
-        git_object = GitObject(sha1, type, size, data)
+        git = self.__beginBatch(fetchData)
+
+        try:
+            git.stdin.write(sha1 + '\n')
+            git_object = self.__readObject(git.stdout, sha1, fetchData)
+        except:
+            self.__endBatch(fetchData, in_sync=False)
+            raise
+
+        self.__endBatch(fetchData)
+
+        if git_object is None:
+            raise GitError("%s missing from %s" % (sha1[:8], self.path), sha1=sha1, repository=self)
 
         after = time.time()
 
-        if not self.__cacheDisabled and (type != "blob" or self.__cacheBlobs):
-            cache["object:" + sha1] = git_object
+        self.__cacheObject(cache, git_object)
+        if self.__useDiskCache(): DiskObjectCache.add(self.name, git_object)
 
         if self.__db:
-            self.__db.recordProfiling("fetch: " + type, after - before)
+            self.__db.recordProfiling("fetch: " + git_object.type, after - before)
 
         return git_object
 
+    def iterfetch(self, sha1s, fetchData=True, object_type=None):
+        """Fetch multiple objects, yielding a GitObject for each, in order.
+
+           All SHA-1s that aren't already cached are written to the batch
+           process up front, by a separate thread so that git's output can be
+           consumed while the input is still being written, instead of waiting
+           for each object before requesting the next one.  'object_type' is
+           as for fetch()."""
+
+        sha1s = list(sha1s)
+
+        cache = self.__getObjectCache()
+        cached_objects = dict((sha1, self.__lookupCached(cache, sha1, object_type)) for sha1 in sha1s)
+
+        requested = [sha1 for sha1 in sha1s if not cached_objects.get(sha1)]
+
+        if not requested:
+            for sha1 in sha1s: yield cached_objects[sha1]
+            return
+
+        before = time.time()
+
+        git = self.__beginBatch(fetchData)
+
+        def write():
+            # Fails if the process is killed because we stopped early.
+            try:
+                git.stdin.write("".join(sha1 + "\n" for sha1 in requested))
+                git.stdin.flush()
+            except (IOError, OSError):
+                pass
+
+        writer = threading.Thread(target=write)
+        writer.start()
+
+        pending = iter(requested)
+        remaining = len(requested)
+
+        try:
+            for sha1 in sha1s:
+                git_object = cached_objects.get(sha1)
+
+                if not git_object:
+                    git_object = self.__readObject(git.stdout, pending.next(), fetchData)
+
+                    if git_object is None:
+                        raise GitError("%s missing from %s" % (sha1[:8], self.path), sha1=sha1, repository=self)
+
+                    self.__cacheObject(cache, git_object)
+                    if self.__useDiskCache(): DiskObjectCache.add(self.name, git_object)
+
+                    remaining -= 1
+
+                    if not remaining:
+                        # All replies have been read; release the process
+                        # now rather than when the caller stops iterating,
+                        # which it may never do explicitly.
+                        writer.join()
+                        self.__endBatch(fetchData)
+
+                yield git_object
+        finally:
+            if remaining:
+                # We stopped early (an object was missing, a reply was
+                # unexpected, or the caller stopped iterating.)  Rather than
+                # trying to read the remaining replies, kill the process so
+                # that the next fetch starts with a fresh one.
+                self.__endBatch(fetchData, in_sync=False)
+                writer.join()
+
+            if self.__db:
+                self.__db.recordProfiling("fetch: batch", time.time() - before, repetitions=len(requested))
+
+    def fetchMany(self, sha1s, fetchData=True, object_type=None):
+        """Fetch multiple objects, returning a list of GitObject objects.
+
+           See iterfetch()."""
+        return list(self.iterfetch(sha1s, fetchData, object_type))
+
     def run(self, command, *arguments, **kwargs):
         return self.runCustom(self.path, command, *arguments, **kwargs)
 
+    def iterlines(self, command, *arguments, **kwargs):
+        """Run a git command in the repository and yield each line of its
+           output, without the line break, as it is read.
+
+           Unlike run(), the output is never held in memory as a whole.  If
+           'input' is specified, it is written to the command's standard
+           input before any output is read, so the command must read all its
+           input first (like 'git rev-list --stdin' does.)"""
+
+        argv = [configuration.executables.GIT, command]
+        argv.extend(arguments)
+        stdin_data = kwargs.get("input")
+        if stdin_data is None: stdin = None
+        else: stdin = PIPE
+        env = {}
+        env.update(environ)
+        if "GIT_DIR" in env: del env["GIT_DIR"]
+        stderr = tempfile.TemporaryFile()
+        git = process(argv, stdin=stdin, stdout=PIPE, stderr=stderr, cwd=self.path, env=env)
+        try:
+            if stdin_data is not None:
+                git.stdin.write(stdin_data)
+                git.stdin.close()
+            for line in iter(git.stdout.readline, ""):
+                if line[-1] == "\n": yield line[:-1]
+                else: yield line
+            if git.wait() != 0:
+                stderr.seek(0)
+                raise Exception, "'%s' failed: %s (in %s)" % (" ".join(argv), stderr.read().strip(), self.path)
+        finally:
+            if git.poll() is None:
+                git.kill()
+                git.wait()
+            git.stdout.close()
+            stderr.close()
+
+    # Serializes creation of relay repositories between threads.
+    __relay_lock = threading.Lock()
+
     def runRelay(self, command, *arguments, **kwargs):
-        if not os.path.isdir(self.relay):
-            try: os.makedirs(os.path.dirname(self.relay))
-            except: pass
+        with Repository.__relay_lock:
+            if not os.path.isdir(self.relay):
+                try: os.makedirs(os.path.dirname(self.relay))
+                except: pass
 
-            self.runCustom(os.path.dirname(self.relay), "clone", "--bare", self.path, os.path.basename(self.relay))
+                self.runCustom(os.path.dirname(self.relay), "clone", "--bare", self.path, os.path.basename(self.relay))
 
         return self.runCustom(self.relay, command, *arguments, **kwargs)
 
@@ -278,8 +654,30 @@ class Repository:
         env.update(environ)
         env.update(kwargs.get("env", {}))
         if "GIT_DIR" in env: del env["GIT_DIR"]
-        git = process(argv, stdin=stdin, stdout=PIPE, stderr=PIPE, cwd=cwd, env=env)
-        stdout, stderr = git.communicate(stdin_data)
+        timeout = kwargs.get("timeout")
+        if timeout is None:
+            git = process(argv, stdin=stdin, stdout=PIPE, stderr=PIPE, cwd=cwd, env=env)
+            stdout, stderr = git.communicate(stdin_data)
+        else:
+            # Run git in its own process group, so that any helper processes
+            # it has started (ssh, git-remote-https, ...) are killed with it
+            # if it doesn't finish in time.  The new session is created by a
+            # separate Python process that then executes git (keeping its
+            # process ID), rather than with 'preexec_fn', which isn't safe to
+            # use while other threads are running.
+            git = process([configuration.executables.PYTHON, "-c", SETSID_AND_EXEC] + argv,
+                          stdin=stdin, stdout=PIPE, stderr=PIPE, cwd=cwd, env=env, close_fds=True)
+            timed_out = []
+            def expire():
+                timed_out.append(True)
+                try: os.killpg(git.pid, signal.SIGKILL)
+                except OSError: pass
+            timer = threading.Timer(timeout, expire)
+            timer.start()
+            try: stdout, stderr = git.communicate(stdin_data)
+            finally: timer.cancel()
+            if timed_out:
+                raise GitError("'%s' timed out after %d seconds (in %s)" % (" ".join(argv), timeout, cwd), repository=self)
         if kwargs.get("check_errors", True):
             if git.returncode == 0:
                 if kwargs.get("include_stderr", False):
@@ -312,10 +710,19 @@ class Repository:
 
         assert len(sha1s) >= 2
 
+        # The merge-base of a set of commits never changes, so remember it
+        # when the commits are named by full SHA-1s.
+        key = tuple(sha1s)
+        if key in self.__mergebases: return self.__mergebases[key]
+
         git = process([configuration.executables.GIT, 'merge-base'] + sha1s,
                       stdout=PIPE, stderr=PIPE, cwd=self.path)
         stdout, stderr = git.communicate()
-        if git.returncode == 0: return stdout.strip()
+        if git.returncode == 0:
+            result = stdout.strip()
+            if all(re_sha1.match(sha1) for sha1 in sha1s):
+                self.__mergebases[key] = result
+            return result
         else: raise Exception, "'git merge-base' failed: %s" % stderr.strip()
 
     def getCommonAncestor(self, commit_or_commits):
@@ -329,12 +736,50 @@ class Repository:
         if len(mergebases) == 1: return mergebases[0]
         else: return self.getCommonAncestor(mergebases)
 
+    def __resolve(self, name):
+        """Return (sha1, type) for the object named by 'name', or None.
+
+           The name is resolved by the 'git cat-file --batch-check' process
+           that fetch() also uses, so that no git process is started per call.
+           Results for (possibly abbreviated) SHA-1s are remembered; other
+           names, like ref names, can change meaning and are always looked up
+           again."""
+
+        if name in self.__names: return self.__names[name]
+        if not name or "\n" in name: return None
+
+        git = self.__beginBatch(False)
+
+        try:
+            git.stdin.write(name + "\n")
+            git.stdin.flush()
+
+            # "<sha1> <type> <size>" or "<name> missing" (or "<name> ambiguous".)
+            words = git.stdout.readline().split()
+        except:
+            self.__endBatch(False, in_sync=False)
+            raise
+
+        self.__endBatch(False)
+
+        if len(words) == 3 and re_sha1.match(words[0]):
+            result = words[0], words[1]
+        else:
+            result = None
+
+        if re_hex.match(name):
+            # A missing object may still be added by a push, so only remember
+            # that for as long as the repository object is tied to a database
+            # connection (i.e. for the duration of a request.)
+            if result or self.__db:
+                self.__names[name] = result
+
+        return result
+
     def revparse(self, name):
-        git = process([configuration.executables.GIT, 'rev-parse', '--verify', '--quiet', name],
-                      stdout=PIPE, stderr=PIPE, cwd=self.path)
-        stdout, stderr = git.communicate()
-        if git.returncode == 0: return stdout.strip()
-        else: raise GitError("'git rev-parse' failed: %s" % stderr.strip(), ref=name, repository=self)
+        result = self.__resolve(name)
+        if result: return result[0]
+        else: raise GitError("'git rev-parse' failed: %s: no such object" % name, ref=name, repository=self)
 
     def revlist(self, included, excluded, *args, **kwargs):
         args = list(args)
@@ -346,11 +791,8 @@ class Repository:
         return self.run('rev-list', *args).splitlines()
 
     def iscommit(self, name):
-        git = process([configuration.executables.GIT, 'cat-file', '-t', name],
-                      stdout=PIPE, stderr=PIPE, cwd=self.path)
-        stdout, stderr = git.communicate()
-        if git.returncode == 0: return stdout.strip() == "commit"
-        else: return False
+        result = self.__resolve(name)
+        return result is not None and result[1] == "commit"
 
     def keepalive(self, commit):
         self.run('update-ref', 'refs/keepalive/%s' % str(commit), str(commit))
@@ -563,7 +1005,16 @@ class Commit:
 
     @staticmethod
     def fromSHA1(db, repository, sha1, commit_id=None):
-        return Commit.fromGitObject(db, repository, repository.fetch(sha1), commit_id)
+        return Commit.fromGitObject(db, repository, repository.fetch(sha1, object_type="commit"), commit_id)
+
+    @staticmethod
+    def fromSHA1s(db, repository, sha1s, commit_ids=None):
+        """Return a list of Commit objects, fetching all the commit objects in
+           one batch.  If specified, 'commit_ids' is a list of the
+           corresponding commit ids."""
+        if commit_ids is None: commit_ids = [None] * len(sha1s)
+        return [Commit.fromGitObject(db, repository, gitobject, commit_id)
+                for gitobject, commit_id in zip(repository.iterfetch(sha1s, object_type="commit"), commit_ids)]
 
     @staticmethod
     def fromId(db, repository, commit_id):
@@ -575,6 +1026,19 @@ class Commit:
             commit = Commit.fromSHA1(db, repository, sha1, commit_id)
         return commit
 
+    @staticmethod
+    def fromIds(db, repository, commit_ids):
+        """Return a list of Commit objects, looking up and fetching all the
+           ones not already cached in one query and one batch."""
+        cache = db.storage["Commit"]
+        missing = list(set(commit_id for commit_id in commit_ids if commit_id not in cache))
+        if missing:
+            cursor = db.cursor()
+            cursor.execute("SELECT id, sha1 FROM commits WHERE id=ANY (%s)", (missing,))
+            rows = cursor.fetchall()
+            Commit.fromSHA1s(db, repository, [sha1 for commit_id, sha1 in rows], [commit_id for commit_id, sha1 in rows])
+        return [cache[commit_id] for commit_id in commit_ids]
+
     def __hash__(self): return hash(self.sha1)
     def __eq__(self, other): return self.sha1 == str(other)
     def __ne__(self, other): return self.sha1 != str(other)
@@ -636,7 +1100,162 @@ class Commit:
         except KeyError:
             return None
 
-RE_LSTREE_LINE = re.compile("^([0-9]{6}) (blob|tree|commit) ([0-9a-f]{40})  *([0-9]+|-)\t(.*)$")
+class CommitGraph:
+    """In-memory graph of the commits in a repository that are reachable from
+       a set of head commits but not from their common ancestor (the "base"
+       commit), with a generation number for each commit.
+
+       The graph is loaded with one 'git rev-list' command, and answers
+       ancestry and merge-base questions about the head commits and the
+       commits between them and the base without running git again.  Other
+       questions fall back to running 'git merge-base'."""
+
+    def __init__(self, repository, heads):
+        self.repository = repository
+        self.heads = set(str(head) for head in heads)
+
+        assert len(self.heads) >= 2
+
+        returncode, stdout, stderr = repository.run("merge-base", "--octopus", *self.heads, check_errors=False)
+
+        if returncode == 0: self.base = stdout.strip()
+        else: self.base = None
+
+        if self.base: excluded = [self.base]
+        else: excluded = []
+
+        self.parents = {}
+        self.generations = {}
+
+        lines = repository.revlist(self.heads, excluded, "--parents", "--topo-order")
+
+        for line in lines:
+            sha1s = line.split()
+            self.parents[sha1s[0]] = sha1s[1:]
+
+        # Children are listed before their parents, so compute generation
+        # numbers in reverse order.  Commits outside the graph count as
+        # generation zero.
+        for line in reversed(lines):
+            sha1 = line[:40]
+            self.generations[sha1] = 1 + max([self.generations.get(parent_sha1, 0) for parent_sha1 in self.parents[sha1]] or [0])
+
+    def __contains__(self, commit):
+        return str(commit) in self.parents
+
+    def __reaches(self, sha1, target, minimum_generation):
+        stack = [sha1]
+        seen = set(stack)
+
+        while stack:
+            for parent_sha1 in self.parents[stack.pop()]:
+                if parent_sha1 == target:
+                    return True
+                elif parent_sha1 in self.parents and parent_sha1 not in seen \
+                        and self.generations[parent_sha1] > minimum_generation:
+                    seen.add(parent_sha1)
+                    stack.append(parent_sha1)
+
+        return False
+
+    def __ancestors(self, sha1):
+        """Return the set of commits in the graph that 'sha1' (which must be in
+           the graph) is or descends from, whether it descends from the base
+           commit, and whether it descends from any commit outside the
+           graph."""
+
+        ancestors = set([sha1])
+        stack = [sha1]
+        reaches_base = False
+        leaves_graph = False
+
+        while stack:
+            for parent_sha1 in self.parents[stack.pop()]:
+                if parent_sha1 in self.parents:
+                    if parent_sha1 not in ancestors:
+                        ancestors.add(parent_sha1)
+                        stack.append(parent_sha1)
+                else:
+                    leaves_graph = True
+                    if parent_sha1 == self.base:
+                        reaches_base = True
+
+        return ancestors, reaches_base, leaves_graph
+
+    def isAncestorOf(self, ancestor, commit):
+        """Return true if 'ancestor' is 'commit' or an ancestor of it, like
+           Commit.isAncestorOf() does."""
+
+        ancestor = str(ancestor)
+        commit = str(commit)
+
+        if ancestor == commit:
+            return True
+        elif commit in self.parents:
+            if ancestor in self.parents:
+                # An ancestor always has a lower generation number.
+                if self.generations[ancestor] >= self.generations[commit]:
+                    return False
+                return self.__reaches(commit, ancestor, self.generations[ancestor])
+            elif ancestor == self.base:
+                return self.__reaches(commit, ancestor, 0)
+
+        return self.repository.mergebase([ancestor, commit]) == ancestor
+
+    def mergebase(self, commit1, commit2):
+        """Return the merge-base of two commits, like Repository.mergebase()."""
+
+        commit1 = str(commit1)
+        commit2 = str(commit2)
+
+        if commit1 in self.parents and commit2 in self.parents:
+            ancestors1, reaches_base1, leaves_graph1 = self.__ancestors(commit1)
+            ancestors2, reaches_base2, leaves_graph2 = self.__ancestors(commit2)
+
+            common = ancestors1 & ancestors2
+
+            if common:
+                # The best common ancestors in the graph are those that aren't
+                # parents of other common ancestors.
+                best = common.copy()
+                for sha1 in common:
+                    best.difference_update(self.parents[sha1])
+                if len(best) == 1:
+                    candidate = best.pop()
+                    # Common ancestors outside the graph are ancestors of the
+                    # base commit.  Unless the candidate descends from the
+                    # base commit, one of those may be another best common
+                    # ancestor (with criss-cross merges), and then git decides
+                    # which one is the merge-base.
+                    if not (leaves_graph1 and leaves_graph2) or self.__ancestors(candidate)[1]:
+                        return candidate
+            elif reaches_base1 and reaches_base2:
+                # Every common ancestor outside the graph is an ancestor of the
+                # base commit, so the base commit is the best one.
+                return self.base
+
+        return self.repository.mergebase([commit1, commit2])
+
+    def getIndependent(self, commits):
+        """Return the set of commits in 'commits' that are not ancestors of
+           another commit in 'commits'."""
+
+        commits = set(str(commit) for commit in commits)
+        result = set()
+
+        # Checking the commits in order of descending generation number means
+        # that descendants are found before their ancestors.
+        def generation(sha1):
+            return self.generations.get(sha1, 0)
+
+        for sha1 in sorted(commits, key=generation, reverse=True):
+            for other in result:
+                if self.isAncestorOf(sha1, other):
+                    break
+            else:
+                result.add(sha1)
+
+        return result
 
 class Tree:
     class Entry:
@@ -698,25 +1317,27 @@ class Tree:
         assert path[0] == "/"
 
         if path == "/":
-            what = commit.sha1
+            what = "%s^{tree}" % commit.sha1
         else:
-            if path[-1] != "/": path += "/"
-            what = "%s:%s" % (commit.sha1, path[1:])
-
-        entries = []
+            what = "%s:%s" % (commit.sha1, path[1:].rstrip("/"))
 
-        for line in commit.repository.run("ls-tree", "-l", what).splitlines():
-            match = RE_LSTREE_LINE.match(line)
-            assert match
+        tree_sha1 = commit.repository.revparse(what)
+        tree = Tree.fromSHA1(commit.repository, tree_sha1)
 
-            entries.append(Tree.Entry(match.group(5), match.group(1), match.group(2), match.group(3), int(match.group(4)) if match.group(2) == "blob" else None))
+        # Like 'git ls-tree -l', only report sizes of blobs.
+        for entry in tree:
+            if entry.type != "blob": entry.size = None
 
-        return Tree(entries)
+        return tree
 
     @staticmethod
     def fromSHA1(repository, sha1):
-        data = repository.fetch(sha1).data
-        entries = []
+        git_object = repository.fetch(sha1, object_type="tree")
+        if git_object.type != "tree":
+            raise GitError("%s is not a tree object" % sha1[:8], sha1=sha1, repository=repository)
+
+        data = git_object.data
+        parsed = []
 
         while len(data):
             space = data.index(" ")
@@ -728,12 +1349,22 @@ class Tree:
             sha1_binary = data[null + 1:null + 21]
             sha1 = "".join([("%02x" % ord(c)) for c in sha1_binary])
 
-            entry_object = repository.fetch(sha1, fetchData=False)
-
-            entries.append(Tree.Entry(name, mode, entry_object.type, sha1, entry_object.size))
+            parsed.append((name, mode, sha1))
 
             data = data[null + 21:]
 
+        # Submodule entries refer to commits in other repositories.
+        def isGitLink(mode): return int(mode, 8) == 0160000
+
+        entry_objects = iter(repository.fetchMany([sha1 for name, mode, sha1 in parsed if not isGitLink(mode)], fetchData=False))
+        entries = []
+
+        for name, mode, sha1 in parsed:
+            if isGitLink(mode): entries.append(Tree.Entry(name, mode, "commit", sha1, None))
+            else:
+                entry_object = entry_objects.next()
+                entries.append(Tree.Entry(name, mode, entry_object.type, sha1, entry_object.size))
+
         return Tree(entries)
 
 def getTaggedCommit(repository, sha1):
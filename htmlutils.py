@@ -205,17 +205,40 @@ class MetaInformation(object):
 
 class PausedRendering: pass
 
+# Size of the chunks produced by Document.stream().
+STREAM_CHUNK_SIZE = 65536
+
+class StreamOutput(object):
+    """Output buffer used by Document.stream()."""
+
+    def __init__(self):
+        self.__chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.__chunks.append(data)
+        self.size += len(data)
+
+    def take(self):
+        data = "".join(self.__chunks)
+        self.__chunks = []
+        self.size = 0
+        return data
+
 class Fragment(object):
     def __init__(self, is_element=False, req=None):
         self.__children = []
         self.__metaInformation = not is_element and MetaInformation() or None
+        self.__has_elements = False
 
     def appendChild(self, child):
         self.__children.append(child)
+        if isinstance(child, Element): self.__has_elements = True
         return child
 
     def insertChild(self, child, offset=0):
         self.__children.insert(offset, child)
+        if isinstance(child, Element): self.__has_elements = True
         return child
 
     def removeChild(self, child):
@@ -225,6 +248,9 @@ class Fragment(object):
     def metaInformation(self):
         return self.__metaInformation
 
+    def hasElements(self):
+        return self.__has_elements
+
     def __len__(self): return len(self.__children)
     def __getitem__(self, index): return self.__children[index]
     def __str__(self): return "".join(map(str, self.__children))
@@ -234,10 +260,22 @@ class Fragment(object):
             child.render(output, level, indent_before, stop=stop, pretty=pretty)
             if pretty: output.write("\n")
 
+    def stream(self, output, level=0, indent_before=True, stop=None, pretty=True):
+        for child in self.__children:
+            if isinstance(child, Element) and child.hasElements():
+                for chunk in child.stream(output, level, indent_before, stop=stop, pretty=pretty):
+                    yield chunk
+            else:
+                child.render(output, level, indent_before, stop=stop, pretty=pretty)
+            if pretty: output.write("\n")
+
     def deleteChildren(self, count=None):
         if count is None: self.__children = []
         else: del self.__children[:count]
 
+    def releaseChild(self, index):
+        self.__children[index] = None
+
 class Element(Fragment):
     def __init__(self, name):
         super(Element, self).__init__(True)
@@ -272,11 +310,7 @@ class Element(Fragment):
         else:
             return "<%s%s>%s</%s>" % (self.__name, attributes, Fragment.__str__(self), self.__name)
 
-    def render(self, output, level=0, indent_before=True, stop=None, pretty=True):
-        if self.__disabled: return
-
-        if self.__metaInformation: self.__metaInformation.render(Generator(self, None))
-
+    def __prepare(self, level, indent_before, pretty):
         if pretty: indent = "  " * level
         else: indent = ""
 
@@ -299,17 +333,29 @@ class Element(Fragment):
             endindent = ""
         else: child_level = level + 1
 
-        attributes = "".join([(" %s=%s" % (name, htmlify(value, True, pretty))) for name, value in self.__attributes.items()])
+        return startindent, indent_before, linebreak, endindent, child_level
 
-        if self.__empty:
-            if not self.__rendered:
+    def __renderStartTag(self, output, startindent, linebreak, pretty):
+        if not self.__rendered:
+            attributes = "".join([(" %s=%s" % (name, htmlify(value, True, pretty))) for name, value in self.__attributes.items()])
+
+            if self.__empty:
                 output.write("%s<%s%s>" % (startindent, self.__name, attributes))
-            self.__rendered = True
-        else:
-            if not self.__rendered:
+            else:
                 output.write("%s<%s%s>%s" % (startindent, self.__name, attributes, linebreak))
-            self.__rendered = True
 
+        self.__rendered = True
+
+    def render(self, output, level=0, indent_before=True, stop=None, pretty=True):
+        if self.__disabled: return
+
+        if self.__metaInformation: self.__metaInformation.render(Generator(self, None))
+
+        startindent, indent_before, linebreak, endindent, child_level = self.__prepare(level, indent_before, pretty)
+
+        self.__renderStartTag(output, startindent, linebreak, pretty)
+
+        if not self.__empty:
             children_rendered = 0
             for child in self:
                 if self.__preformatted: child.setPreFormatted()
@@ -326,6 +372,47 @@ class Element(Fragment):
             if self == stop: raise PausedRendering
             else: output.write("%s</%s>" % (endindent, self.__name))
 
+    def stream(self, output, level=0, indent_before=True, stop=None, pretty=True):
+        """Like render(), but a generator that yields a chunk of output each
+           time at least STREAM_CHUNK_SIZE bytes have been written, and that
+           drops each child as soon as it has been rendered."""
+
+        if self.__disabled: return
+
+        if self.__metaInformation: self.__metaInformation.render(Generator(self, None))
+
+        startindent, indent_before, linebreak, endindent, child_level = self.__prepare(level, indent_before, pretty)
+
+        self.__renderStartTag(output, startindent, linebreak, pretty)
+
+        if not self.__empty:
+            children_rendered = 0
+            for index in range(len(self)):
+                child = self[index]
+                if self.__preformatted: child.setPreFormatted()
+                try:
+                    if isinstance(child, Element) and child.hasElements() and not self.__preformatted:
+                        for chunk in child.stream(output, child_level, indent_before, stop, pretty):
+                            yield chunk
+                    else:
+                        child.render(output, child_level, indent_before, stop, pretty)
+                    output.write(linebreak)
+                    children_rendered += 1
+                except PausedRendering:
+                    self.deleteChildren(children_rendered)
+                    raise
+
+                self.releaseChild(index)
+                del child
+
+                if output.size >= STREAM_CHUNK_SIZE:
+                    yield output.take()
+
+            self.deleteChildren()
+
+            if self == stop: raise PausedRendering
+            else: output.write("%s</%s>" % (endindent, self.__name))
+
     def empty(self):
         self.__empty = True
 
@@ -474,6 +561,9 @@ class Generator(object):
     def render(self, output, level=0, stop=None, pretty=True):
         self.__target.render(output, level, stop=stop, pretty=pretty)
 
+    def stream(self, output, level=0, stop=None, pretty=True):
+        return self.__target.stream(output, level, stop=stop, pretty=pretty)
+
     def empty(self):
         self.__target.empty()
         return self
@@ -544,6 +634,41 @@ class Document(Generator):
         self.__start = time.time()
         return output.getvalue()
 
+    def stream(self, plain=False, stop=None, pretty=True):
+        """Render the document like render(), but incrementally.
+
+           Returns a generator that yields the output in chunks of roughly
+           STREAM_CHUNK_SIZE bytes.  Elements are dropped from the document
+           as soon as they have been rendered, so the complete output never
+           needs to exist in memory at once."""
+
+        self.__generation += time.time() - self.__start
+
+        output = StreamOutput()
+        if not plain and self.__doctype:
+            output.write("<!DOCTYPE html>")
+            self.__doctype = False
+
+        before = time.time()
+        try:
+            for chunk in Generator.stream(self, output, stop=stop, pretty=pretty):
+                self.__rendering += time.time() - before
+                yield chunk
+                before = time.time()
+            finished = True
+        except PausedRendering:
+            finished = False
+
+        self.__rendering += time.time() - before
+
+        if not plain and finished:
+            output.write("\n<!-- generation: %.2f ms, rendering: %.2f ms -->" % (self.__generation * 1000, self.__rendering * 1000))
+
+        self.__start = time.time()
+
+        if output.size:
+            yield output.take()
+
     def __str__(self):
         return self.render()
 
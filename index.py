@@ -1,4 +1,3 @@
-blah
 # -*- mode: python; encoding: utf-8 -*-
 #
 # Copyright 2012 Jens Lindström, Opera Software ASA
@@ -24,6 +23,7 @@ from os import getuid
 
 from dbutils import *
 import gitutils
+from utf8utils import convertUTF8
 from log.commitset import CommitSet
 
 import dbutils
@@ -85,6 +85,41 @@ def processCommits(repository_name, sha1):
 You're trying to add %d new commits to this repository.  Are you
 perhaps pushing to the wrong repository?""" % count
 
+    # List all commits that aren't reachable from the head of any branch in
+    # the database, with their parents, authors and committers, using a single
+    # 'git rev-list' command.  Everything reachable from those heads is in the
+    # database already, since a commit is only ever added together with all
+    # its ancestors.
+    cursor.execute("""SELECT DISTINCT commits.sha1
+                        FROM commits
+                        JOIN branches ON (branches.head=commits.id)
+                       WHERE branches.repository=%s""",
+                   (repository.id,))
+
+    # A head that is missing from the repository (after a gc of a mirror, say)
+    # would make 'git rev-list' fail, so skip those.  iscommit() asks the
+    # repository's persistent 'git cat-file --batch-check' process.
+    excluded = "".join("^%s\n" % head_sha1 for (head_sha1,) in cursor.fetchall()
+                       if repository.iscommit(head_sha1))
+    graph = {}
+
+    lines = repository.iterlines("rev-list", "--stdin", "--parents", "--format=%an%x00%ae%x00%at%x00%cn%x00%ce%x00%ct", sha1, input=excluded)
+
+    for line in lines:
+        commit_sha1, _, parents = line[len("commit "):].partition(" ")
+        author_name, author_email, author_time, committer_name, committer_email, committer_time = lines.next().split("\0")
+
+        author = gitutils.CommitUserTime(convertUTF8(author_name), convertUTF8(author_email), gmtime(int(author_time)))
+        committer = gitutils.CommitUserTime(convertUTF8(committer_name), convertUTF8(committer_email), gmtime(int(committer_time)))
+
+        graph[commit_sha1] = (parents.split(), author, committer)
+
+    if emptydb or not graph:
+        existing = set()
+    else:
+        cursor.execute("SELECT sha1 FROM commits WHERE sha1=ANY (%s)", (graph.keys(),))
+        existing = set(commit_sha1 for (commit_sha1,) in cursor)
+
     commit_count = 0
 
     commits_values = []
@@ -92,30 +127,22 @@ perhaps pushing to the wrong repository?""" % count
 
     while True:
         if sha1 not in commits:
-            commit = gitutils.Commit.fromSHA1(db, repository, sha1)
+            commits.add(sha1)
 
-            if commit.author.email: author_id = commit.author.getGitUserId(db)
-            else: author_id = 0
+            if sha1 in graph and sha1 not in existing:
+                parents, author, committer = graph[sha1]
 
-            if commit.committer.email: committer_id = commit.committer.getGitUserId(db)
-            else: committer_id = 0
+                if author.email: author_id = author.getGitUserId(db)
+                else: author_id = 0
 
-            if emptydb: row = None
-            else:
-                cursor.execute("SELECT id FROM commits WHERE sha1=%s", (commit.sha1,))
-                row = cursor.fetchone()
-                new_commit = False
+                if committer.email: committer_id = committer.getGitUserId(db)
+                else: committer_id = 0
 
-            if not row:
                 commit_count += 1
-                commits_values.append((commit.sha1, author_id, committer_id, timestamp(commit.author.time), timestamp(commit.committer.time)))
-                new_commit = True
+                commits_values.append((sha1, author_id, committer_id, timestamp(author.time), timestamp(committer.time)))
 
-            commits.add(sha1)
-
-            if new_commit:
-                edges_values.extend([(parent_sha1, commit.sha1) for parent_sha1 in set(commit.parents)])
-                stack.extend(set(commit.parents))
+                edges_values.extend([(parent_sha1, sha1) for parent_sha1 in set(parents)])
+                stack.extend(set(parents))
 
         if not stack: break
 
@@ -125,16 +152,23 @@ perhaps pushing to the wrong repository?""" % count
         stdout.write("\n")
         stdout.flush()
 
-    cursor.executemany("""INSERT INTO commits (sha1, author_gituser, commit_gituser, author_time, commit_time)
-                               VALUES (%s, %s, %s, %s, %s)""",
-                       commits_values)
+    if commits_values:
+        cursor.copy_from("commits",
+                         ("sha1", "author_gituser", "commit_gituser", "author_time", "commit_time"),
+                         commits_values)
+
+    if edges_values:
+        sha1s = set()
+        for parent_sha1, child_sha1 in edges_values:
+            sha1s.add(parent_sha1)
+            sha1s.add(child_sha1)
+
+        cursor.execute("SELECT sha1, id FROM commits WHERE sha1=ANY (%s)", (list(sha1s),))
+        commit_ids = dict(cursor)
 
-    cursor.executemany("""INSERT INTO edges (parent, child)
-                               SELECT parents.id, children.id
-                                 FROM commits AS parents,
-                                      commits AS children
-                                WHERE parents.sha1=%s AND children.sha1=%s""",
-                       edges_values)
+        cursor.copy_from("edges",
+                         ("parent", "child"),
+                         [(commit_ids[parent_sha1], commit_ids[child_sha1]) for parent_sha1, child_sha1 in edges_values])
 
     db.commit()
 
@@ -196,21 +230,23 @@ def createBranches(user_name, repository_name, branches):
             # Try a natural ordering based on the relationships of the head
             # commits of the two branches, unless the heads are the same:
             if head1 != head2:
-                base = repository.mergebase([head1, head2])
-
-                # If either head is an ancestor of the other head, merge-base
-                # between them will be the ancestor head, and in that case,
-                # process that branch first.  Otherwise, then that would be
-                # guaranteed to show up as empty, and that's probably not the
-                # intention.
-                if base == head1: return -1
-                elif base == head2: return 1
+                # If either head is an ancestor of the other head, process
+                # that branch first.  Otherwise, then that would be guaranteed
+                # to show up as empty, and that's probably not the intention.
+                if graph.isAncestorOf(head1, head2): return -1
+                elif graph.isAncestorOf(head2, head1): return 1
 
             # Two non-taskbranch branches that seem "unrelated".  Process them
             # ordered by name, mostly so that this comparison function is well-
             # behaved.
             return compareBranchNames(name1, name2)
 
+        heads = set(head for name, head in branches)
+
+        # One commit graph answers every ancestry question the sorting asks.
+        if len(heads) > 1:
+            graph = gitutils.CommitGraph(repository, heads)
+
         branches.sort(cmp=compareBranches)
 
     for name, head in branches: createBranch(user, repository, name, head)
@@ -436,12 +472,7 @@ Please don't push it manually to this repository.""" % (name, remote_name, remot
             if conflicting:
                 if forced:
                     if branch.base is None:
-                        cursor.executemany("""DELETE FROM reachable
-                                                    USING commits
-                                                    WHERE reachable.branch=%s
-                                                      AND reachable.commit=commits.id
-                                                      AND commits.sha1=%s""",
-                                           [(branch.id, sha1) for sha1 in conflicting])
+                        dbutils.remove_reachable(db, branch.id, conflicting)
                     else:
                         output = "Non-fast-forward update detected; deleting and recreating branch."
 
@@ -456,11 +487,7 @@ can delete the branch using
   git push critic :%s
 first, and then repeat this push.""" % name
 
-            cursor.executemany("""INSERT INTO reachable (branch, commit)
-                                       SELECT %s, commits.id
-                                         FROM commits
-                                        WHERE sha1=%s""",
-                               [(branch.id, sha1) for sha1 in added])
+            dbutils.add_reachable(db, branch.id, added)
 
             new_head = gitutils.Commit.fromSHA1(db, repository, new)
 
@@ -617,11 +644,9 @@ onto the %s.""" % (merged_thing, review.branch.name, old_upstream_name, old_head
 
                 new_sha1s = repository.revlist([new], [new_upstream.sha1], '--topo-order')
                 rebased_commits = [gitutils.Commit.fromSHA1(db, repository, sha1) for sha1 in new_sha1s]
-                reachable_values = [(review.branch.id, sha1) for sha1 in new_sha1s]
 
                 cursor.execute("INSERT INTO previousreachable (rebase, commit) SELECT %s, commit FROM reachable WHERE branch=%s", (rebase_id, review.branch.id))
-                cursor.execute("DELETE FROM reachable WHERE branch=%s", (review.branch.id,))
-                cursor.executemany("INSERT INTO reachable (branch, commit) SELECT %s, commits.id FROM commits WHERE commits.sha1=%s", reachable_values)
+                dbutils.set_reachable(db, review.branch.id, new_sha1s)
                 cursor.execute("UPDATE branches SET head=%s WHERE id=%s", (gitutils.Commit.fromSHA1(db, repository, new).getId(db), review.branch.id))
 
                 pending_mails = []
@@ -663,11 +688,9 @@ the same tree as the old head of the branch."""
 
                 rebased_commits = [gitutils.Commit.fromSHA1(db, repository, sha1) for sha1 in repository.revlist([new_head], old_commitset.getTails(), '--topo-order')]
                 new_commits = [gitutils.Commit.fromSHA1(db, repository, sha1) for sha1 in repository.revlist([new], [new_head], '--topo-order')]
-                reachable_values = [(review.branch.id, sha1) for sha1 in new_sha1s]
 
                 cursor.execute("INSERT INTO previousreachable (rebase, commit) SELECT %s, commit FROM reachable WHERE branch=%s", (rebase_id, review.branch.id))
-                cursor.execute("DELETE FROM reachable WHERE branch=%s", (review.branch.id,))
-                cursor.executemany("INSERT INTO reachable (branch, commit) SELECT %s, commits.id FROM commits WHERE commits.sha1=%s", reachable_values)
+                dbutils.set_reachable(db, review.branch.id, new_sha1s)
                 cursor.execute("UPDATE branches SET head=%s WHERE id=%s", (gitutils.Commit.fromSHA1(db, repository, new).getId(db), review.branch.id))
 
                 pending_mails = []
@@ -701,13 +724,24 @@ first, and then repeat this push.""" % name
     cursor.execute("SELECT id FROM branches WHERE repository=%s AND base IS NULL ORDER BY id ASC LIMIT 1", (repository.id,))
     root_branch_id = cursor.fetchone()[0]
 
+    reachable_branch_ids = [branch.id, root_branch_id]
+    if base_branch_id: reachable_branch_ids.append(base_branch_id)
+
+    # Commits reachable from the old head are already accounted for, so only
+    # the commits 'git rev-list' lists as new (with their parents) need to be
+    # looked up, all at once, in the reachable sets of the relevant branches.
+    graph = dbutils.load_commit_graph(repository, [new], [old])
+
+    candidates = set(graph.keys())
+    for parents in graph.values():
+        candidates.update(parents)
+
+    reachable = dbutils.filter_reachable(db, reachable_branch_ids, candidates)
+
+    if is_review and branch.tail: reachable.add(branch.tail.sha1)
+
     def isreachable(sha1):
-        #if rescan: return False
-        #if is_review: cursor.execute("SELECT 1 FROM commits, reachable, branches WHERE commits.sha1=%s AND commits.id=reachable.commit AND reachable.branch=branches.id AND branches.repository=%s", [sha1, repository.id])
-        if is_review and sha1 == branch.tail: return True
-        if base_branch_id: cursor.execute("SELECT 1 FROM commits, reachable WHERE commits.sha1=%s AND commits.id=reachable.commit AND reachable.branch IN (%s, %s, %s)", [sha1, branch.id, base_branch_id, root_branch_id])
-        else: cursor.execute("SELECT 1 FROM commits, reachable WHERE commits.sha1=%s AND commits.id=reachable.commit AND reachable.branch IN (%s, %s)", [sha1, branch.id, root_branch_id])
-        return cursor.fetchone() is not None
+        return sha1 not in graph or sha1 in reachable
 
     stack = [new]
     commits = set()
@@ -729,10 +763,7 @@ first, and then repeat this push.""" % name
             commits.add(sha1)
             commit_list.append(sha1)
 
-            #if is_review:
-            #    stack.append(gitutils.Commit.fromSHA1(repository, sha1).parents[0])
-            #else:
-            stack.extend([parent_sha1 for parent_sha1 in gitutils.Commit.fromSHA1(db, repository, sha1).parents if parent_sha1 not in processed])
+            stack.extend([parent_sha1 for parent_sha1 in graph[sha1] if parent_sha1 not in processed])
 
         processed.add(sha1)
 
@@ -762,9 +793,7 @@ Perhaps you should request a new review of the follow-up commits?"""
 
         review_utils.addCommitsToReview(db, user, review, all_commits, commitset=commits, tracked_branch=tracked_branch)
 
-    reachable_values = [(branch.id, sha1) for sha1 in reversed(commit_list) if sha1 in commits]
-
-    cursor.executemany("INSERT INTO reachable (branch, commit) SELECT %s, commits.id FROM commits WHERE commits.sha1=%s", reachable_values)
+    dbutils.add_reachable(db, branch.id, commit_list)
     cursor.execute("UPDATE branches SET head=%s WHERE id=%s", (gitutils.Commit.fromSHA1(db, repository, new).getId(db), branch.id))
 
     db.commit()
@@ -31,3 +31,19 @@ PUSH_COMMIT_LIMIT = 10000
 # For branches containing more commits than this, fall back to simpler
 # branch log rendering for performance reasons.
 MAXIMUM_REACHABLE_COMMITS = 4000
+
+# Maximum total size, in bytes, of git objects of each type that are cached
+# in memory by each database session (that is, per page load, or for the
+# lifetime of a background service process.)  When a limit is exceeded, the
+# least recently used objects of that type are evicted.  Blobs are only
+# cached when explicitly enabled, for pages that benefit from it.
+OBJECT_CACHE_LIMITS = { "commit": 32 * 1024 ** 2,
+                        "tree": 32 * 1024 ** 2,
+                        "blob": 128 * 1024 ** 2,
+                        "tag": 1024 ** 2 }
+
+# Maximum total size, in bytes, of the on-disk cache of commit and tree
+# objects shared by all processes (stored under the CACHE_DIR directory.)
+# The least recently added objects are evicted daily by the changeset
+# background service.  Set to zero to disable the on-disk cache.
+DISK_OBJECT_CACHE_LIMIT = 256 * 1024 ** 2
@@ -49,6 +49,41 @@ HIGHLIGHT["max_workers"] = 4
 CHANGESET["max_workers"] = 4
 CHANGESET["rss_limit"] = 1024 ** 3
 
+# Use a pool of long-lived worker processes, each processing many requests,
+# instead of starting a new process per request.  A worker process is
+# replaced once it has processed "worker_max_jobs" requests, or (if the
+# service has an "rss_limit") when its RSS exceeds that limit.  Queued
+# requests for the same repository are handed to a worker in batches of up
+# to "worker_batch_size" requests.
+HIGHLIGHT["worker_pool"] = True
+HIGHLIGHT["worker_max_jobs"] = 200
+HIGHLIGHT["worker_batch_size"] = 50
+
+CHANGESET["worker_pool"] = True
+CHANGESET["worker_max_jobs"] = 50
+CHANGESET["worker_batch_size"] = 4
+
+# Maximum number of queued (not yet started) requests per priority level.
+# Requests from the web front-end are started before requests made while
+# processing pushes, which are started before requests made by the branch
+# tracker.  Requests beyond the limit fail immediately.
+HIGHLIGHT["max_queued"] = 10000
+CHANGESET["max_queued"] = 10000
+
+# Number of remotes the branch tracker updates in parallel.  All tracked
+# branches in a repository that track the same remote are fetched together.
+# A fetch that takes longer than "fetch_timeout" seconds is aborted (and
+# retried at the next scheduled update); "remote_fetch_timeouts" can map
+# individual remote URLs to other timeouts.
+BRANCHTRACKER["max_workers"] = 4
+BRANCHTRACKER["fetch_timeout"] = 600
+BRANCHTRACKER["remote_fetch_timeouts"] = {}
+
+# Number of SMTP connections (and delivery threads) the mail delivery service
+# uses.  Queued mails are picked up as soon as they are written to the outbox
+# and sent over whichever connection is free.
+MAILDELIVERY["max_connections"] = 4
+
 WATCHDOG["rss_soft_limit"] = 1024 ** 3
 WATCHDOG["rss_hard_limit"] = 2 * WATCHDOG["rss_soft_limit"]
 
@@ -81,28 +81,15 @@ ancestor of another tail commit of the set.  If the tail commits of the set
 are all different commits on an upstream branch, then this will return only
 the latest one."""
 
-        candidates = self.getTails()
-        result = set()
-
-        while candidates:
-            tail = candidates.pop()
-
-            eliminated = set()
-            for other in candidates:
-                base = repository.mergebase([tail, other])
-                if base == tail:
-                    # Tail is an ancestor of other: tail should not be included
-                    # in the returned set.
-                    break
-                elif base == other:
-                    # Other is an ancestor of tail: other should not be included
-                    # in the returned set.
-                    eliminated.add(other)
-            else:
-                result.add(tail)
-            candidates -= eliminated
-
-        return result
+        tails = self.getTails()
+
+        if len(tails) < 2:
+            return tails
+
+        # Answer all the ancestry questions using a single commit graph of the
+        # commits between the tails and their common ancestor, rather than
+        # running 'git merge-base' for every pair of tails.
+        return gitutils.CommitGraph(repository, tails).getIndependent(tails)
 
     def getTailsFrom(self, commit):
         """Return a set containing the each tail commit of the set of commits that are
@@ -217,20 +204,38 @@ have no common ancestor within this set."""
     @staticmethod
     def fromRange(db, from_commit, to_commit, commits=None):
         repository = from_commit.repository
-        commits = set()
+        included = set()
 
         class NotPossible(Exception): pass
 
-        if commits:
-            def getCommit(sha1):
-                return commits[sha1]
-        else:
-            def getCommit(sha1):
-                return gitutils.Commit.fromSHA1(db, repository, sha1)
+        if commits is None and from_commit != to_commit:
+            # Fetch all commits in the range in one batch up front, instead
+            # of one at a time while walking the history below.
+            sha1s = repository.revlist([to_commit], [from_commit])
+            commits = dict((commit.sha1, commit) for commit in gitutils.Commit.fromSHA1s(db, repository, sha1s))
+
+        graph = []
+
+        def isFromCommitAncestorOfMergeBase(merge):
+            if len(merge.parents) != 2:
+                return from_commit.isAncestorOf(repository.mergebase(merge))
+
+            # Load the commit graph between 'from_commit' and 'to_commit' once,
+            # on the first merge, and use it for all merges.
+            if not graph:
+                graph.append(gitutils.CommitGraph(repository, [from_commit, to_commit]))
+
+            return graph[0].isAncestorOf(from_commit, graph[0].mergebase(*merge.parents))
+
+        def getCommit(sha1):
+            commit = commits.get(sha1)
+            if commit is None:
+                commit = gitutils.Commit.fromSHA1(db, repository, sha1)
+            return commit
 
         def process(iter_commit):
-            while iter_commit != from_commit and iter_commit not in commits:
-                commits.add(iter_commit)
+            while iter_commit != from_commit and iter_commit not in included:
+                included.add(iter_commit)
 
                 if len(iter_commit.parents) > 1:
                     # A merge commit.  Check if 'from_commit' is an ancestor of
@@ -239,7 +244,7 @@ have no common ancestor within this set."""
                     # particularly difficult, but because such a commit-set
                     # would contain "unexpected" merged-in commits.)
 
-                    if from_commit.isAncestorOf(repository.mergebase(iter_commit)):
+                    if isFromCommitAncestorOfMergeBase(iter_commit):
                         map(process, [getCommit(sha1) for sha1 in iter_commit.parents])
                         return
                     else:
@@ -252,6 +257,6 @@ have no common ancestor within this set."""
 
         try:
             process(to_commit)
-            return CommitSet(commits)
+            return CommitSet(included)
         except NotPossible:
             return None
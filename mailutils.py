@@ -70,10 +70,10 @@ def sendAdministratorMessage(source, summary, message):
     sendMessage(recipients, "%s: %s" % (source, summary), message)
 
 def sendMessage(recipients, subject, body):
-    from_user = User(configuration.base1.SYSTEM_USER_NAME, configuration.base.SYSTEM_USER_EMAIL, "Critic System")
+    from_user = User(configuration.base.SYSTEM_USER_NAME, configuration.base.SYSTEM_USER_EMAIL, "Critic System")
     filenames = []
 
-    for to_user in racapants:
+    for to_user in recipients:
         filenames.append(queueMail(from_user, to_user, recipients, subject, body))
 
     sendPendingMails(filenames)
@@ -0,0 +1,135 @@
+# -*- mode: python; encoding: utf-8 -*-
+#
+# Copyright 2012 Jens Lindström, Opera Software ASA
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+# Measures the time it takes to insert a synthetic changeset's files, file
+# versions and chunks into the database, using per-row statements and a
+# findfile()/finddirectory() lookup per file (the way changeset/create.py and
+# dbutils.find_file() used to do it) and using dbutils.find_files() and COPY.
+# Everything is rolled back afterwards.
+#
+# Usage: python maintenance/bench-changeset-insert.py [FILES [CHUNKS_PER_FILE]]
+
+import sys
+import os
+import os.path
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(sys.argv[0]), "..")))
+
+import dbutils
+
+files_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+chunks_per_file = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+class File:
+    def __init__(self, path):
+        self.path = path
+        self.id = None
+
+db = dbutils.Database()
+db.disableProfiling()
+
+cursor = db.cursor()
+cursor.execute("SELECT id FROM commits ORDER BY id DESC LIMIT 1")
+
+row = cursor.fetchone()
+if not row:
+    print "No commits in the database; need one to attach the changeset to."
+    sys.exit(1)
+
+commit_id = row[0]
+prefix = "bench-changeset-insert-%d" % os.getpid()
+
+def createFiles():
+    return [File("%s/d%d/s%d/file%d.txt" % (prefix, index % 100, index % 7, index)) for index in range(files_count)]
+
+def createChangeset():
+    cursor.execute("INSERT INTO changesets (type, parent, child) VALUES ('custom', %s, %s) RETURNING id", (commit_id, commit_id))
+    return cursor.fetchone()[0]
+
+def fileversionsValues(changeset_id, files):
+    return [(changeset_id, file.id, "0" * 40, "1" * 40, "100644", "100644") for file in files]
+
+def chunksValues(changeset_id, files):
+    return [(changeset_id, file.id, 10 * index + 1, 2, 10 * index + 1, 3, "0=0:r", 0)
+            for file in files for index in range(chunks_per_file)]
+
+# The per-row lookup that dbutils.find_directory() and dbutils.find_file() used
+# to do: a findfile()/finddirectory() query for each file, and an insert for
+# each missing file and directory.
+def perRowFindDirectory(path):
+    cursor.execute("SELECT finddirectory(%s)", (path,))
+    directory_id = cursor.fetchone()[0]
+    if directory_id is not None: return directory_id
+
+    if "/" in path:
+        directory, name = path.rsplit("/", 1)
+        directory = perRowFindDirectory(directory)
+    else:
+        directory, name = 0, path
+
+    cursor.execute("INSERT INTO directories (directory, name) VALUES (%s, %s) RETURNING id", (directory, name))
+    return cursor.fetchone()[0]
+
+def perRowFindFile(path):
+    cursor.execute("SELECT findfile(%s)", (path,))
+    file_id = cursor.fetchone()[0]
+    if file_id is not None: return file_id
+
+    if "/" in path:
+        directory, name = path.rsplit("/", 1)
+        directory = perRowFindDirectory(directory)
+    else:
+        directory, name = 0, path
+
+    cursor.execute("INSERT INTO files (directory, name) VALUES (%s, %s) RETURNING id", (directory, name))
+    return cursor.fetchone()[0]
+
+def perRow():
+    files = createFiles()
+    for file in files: file.id = perRowFindFile(file.path)
+    changeset_id = createChangeset()
+    cursor.executemany("""INSERT INTO fileversions (changeset, file, old_sha1, new_sha1, old_mode, new_mode)
+                               VALUES (%s, %s, %s, %s, %s, %s)""",
+                       fileversionsValues(changeset_id, files))
+    cursor.executemany("""INSERT INTO chunks (changeset, file, deleteOffset, deleteCount, insertOffset, insertCount, analysis, whitespace)
+                               VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""",
+                       chunksValues(changeset_id, files))
+
+def bulk():
+    files = createFiles()
+    dbutils.find_files(db, files)
+    changeset_id = createChangeset()
+    cursor.copy_from("fileversions",
+                     ("changeset", "file", "old_sha1", "new_sha1", "old_mode", "new_mode"),
+                     fileversionsValues(changeset_id, files))
+    cursor.copy_from("chunks",
+                     ("changeset", "file", "deleteoffset", "deletecount", "insertoffset", "insertcount", "analysis", "whitespace"),
+                     chunksValues(changeset_id, files))
+
+rows = files_count * (2 + chunks_per_file)
+
+print "%d files, %d chunks per file (%d rows including files):" % (files_count, chunks_per_file, rows)
+
+for label, fn in (("per-row", perRow), ("bulk", bulk)):
+    before = time.time()
+    fn()
+    duration = time.time() - before
+    db.rollback()
+
+    print "  %-8s %8.2f s %10.0f rows/s" % (label, duration, rows / duration)
+
+db.close()
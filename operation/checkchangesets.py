@@ -0,0 +1,31 @@
+# -*- mode: python; encoding: utf-8 -*-
+#
+# Copyright 2012 Jens Lindström, Opera Software ASA
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import changeset.client as changeset_client
+
+from operation import Operation, OperationResult
+
+class CheckChangesets(Operation):
+    def __init__(self):
+        Operation.__init__(self, { "ticket": str },
+                           accept_anonymous_user=True)
+
+    def process(self, db, user, ticket):
+        pending, results = changeset_client.pollChangesets(ticket)
+
+        errors = [result["error"] for result in results if "error" in result]
+
+        return OperationResult(pending=pending, finished=len(results), errors=errors)
@@ -88,7 +88,7 @@ def renderDashboard(req, db, user):
     target = body.div("main")
 
     def flush(target):
-        return document.render(stop=target, pretty=not compact)
+        return document.stream(stop=target, pretty=not compact)
 
     def includeReview(review_id):
         if repository:
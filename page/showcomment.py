@@ -76,7 +76,7 @@ def renderShowComment(req, db, user):
     if user.getPreference(db, "ui.keyboardShortcuts"):
         page.utils.renderShortcuts(body, "showcomment")
 
-    yield document.render(pretty=not compact)
+    yield document.stream(pretty=not compact)
 
 def renderShowComments(req, db, user):
     context_lines = req.getParameter("context", user.getPreference(db, "comment.diff.contextLines"), filter=int)
@@ -278,4 +278,4 @@ def renderShowComments(req, db, user):
 
     profiler.output(db, user, document)
 
-    yield document.render(pretty=not compact)
+    yield document.stream(pretty=not compact)
@@ -34,6 +34,11 @@ import re
 
 from time import strftime
 
+# Number of seconds to wait for changesets to be computed before rendering a
+# placeholder page that is updated when they are ready, instead of keeping
+# the request waiting.
+COMPUTE_TIMEOUT = 5
+
 def renderCommitInfo(db, target, user, repository, review, commit, conflicts=False, minimal=False):
     cursor = db.cursor()
 
@@ -658,8 +663,11 @@ def commitRangeFromReview(db, user, review, filter, file_ids):
                        (user.id, review.id))
 
         edges = set()
+        rows = cursor.fetchall()
+
+        dbutils.explode_paths(db, [file_id for parent_id, child_id, file_id, is_reviewer in rows])
 
-        for parent_id, child_id, file_id, is_reviewer in cursor:
+        for parent_id, child_id, file_id, is_reviewer in rows:
             if is_reviewer or filters.isRelevant(db, user, file_id):
                 edges.add((parent_id, child_id))
     elif filter == "files":
@@ -822,31 +830,10 @@ including the unrelated changes.</p>
     return tail.sha1, head.sha1, commits, listed_commits
 
 def getCommitList(db, repository, from_commit, to_commit):
-    commits = set()
-
-    class NotPossible(Exception): pass
-
-    def process(iter_commit):
-        while iter_commit != from_commit and iter_commit not in commits:
-            commits.add(iter_commit)
+    commits = CommitSet.fromRange(db, from_commit, to_commit)
 
-            if len(iter_commit.parents) > 1:
-                if from_commit.isAncestorOf(repository.mergebase(iter_commit)):
-                    map(process, [gitutils.Commit.fromSHA1(db, repository, sha1) for sha1 in iter_commit.parents])
-                    return
-                else:
-                    raise NotPossible
-            else:
-                iter_commit = gitutils.Commit.fromSHA1(db, repository, iter_commit.parents[0])
-
-    if from_commit == to_commit:
-        return [to_commit]
-
-    try:
-        process(to_commit)
-        return list(commits)
-    except NotPossible:
-        return []
+    if commits is None: return []
+    else: return list(commits)
 
 def getApproximativeCommitList(db, repository, from_commit, to_commit, paths):
     ancestor = repository.getCommonAncestor([from_commit, to_commit])
@@ -856,6 +843,19 @@ def getApproximativeCommitList(db, repository, from_commit, to_commit, paths):
             [gitutils.Commit.fromSHA1(db, repository, sha1).getId(db)
              for sha1 in repository.revlist([to_commit], [ancestor], paths=paths)])
 
+def renderComputing(db, req, user, review, ticket):
+    """Render a placeholder page that is reloaded once the changesets
+       requested under 'ticket' have been computed."""
+
+    def renderMessage(target):
+        target.h3(id="computing").text("Computing changes ...")
+
+    document = page.utils.displayMessage(db, req, user, "Please Wait", review=review, message=renderMessage)
+    document.addExternalScript("resource/computing.js")
+    document.addInternalScript("waitForChangesets(%s);" % htmlutils.jsify(ticket))
+
+    return document
+
 def renderShowCommit(req, db, user):
     profiler = profiling.Profiler()
 
@@ -1028,7 +1028,12 @@ def renderShowCommit(req, db, user):
     profiler.check("prologue")
 
     if from_commit and to_commit:
-        changesets = changeset_utils.createChangeset(db, user, repository, from_commit=from_commit, to_commit=to_commit, rescan=rescan, reanalyze=reanalyze, filtered_file_ids=file_ids)
+        try:
+            changesets = changeset_utils.createChangeset(db, user, repository, from_commit=from_commit, to_commit=to_commit, rescan=rescan, reanalyze=reanalyze, filtered_file_ids=file_ids, timeout=None if rescan else COMPUTE_TIMEOUT)
+        except changeset_utils.ChangesetPending, pending:
+            yield renderComputing(db, req, user, review, pending.ticket)
+            return
+
         assert len(changesets) == 1
 
         if review and review_filter in ("reviewable", "relevant", "files"):
@@ -1069,7 +1074,11 @@ def renderShowCommit(req, db, user):
             changesets = changeset_utils.createFullMergeChangeset(db, user, repository, commit, review=review)
             commits = [commit]
         else:
-            changesets = changeset_utils.createChangeset(db, user, repository, commit=commit, rescan=rescan, reanalyze=reanalyze, conflicts=conflicts, filtered_file_ids=file_ids, review=review)
+            try:
+                changesets = changeset_utils.createChangeset(db, user, repository, commit=commit, rescan=rescan, reanalyze=reanalyze, conflicts=conflicts, filtered_file_ids=file_ids, review=review, timeout=None if rescan else COMPUTE_TIMEOUT)
+            except changeset_utils.ChangesetPending, pending:
+                yield renderComputing(db, req, user, review, pending.ticket)
+                return
             commits = [commit]
 
     profiler.check("create changeset")
@@ -1120,6 +1129,8 @@ def renderShowCommit(req, db, user):
                 filters = review_filters.Filters()
                 filters.load(db, review=review, user=user)
 
+                dbutils.explode_paths(db, [file.id for file in changeset.files])
+
                 def isRelevant(file):
                     if file.id in reviewable_files: return True
                     elif filters.isRelevant(db, user, file): return True
@@ -1176,11 +1187,11 @@ def renderShowCommit(req, db, user):
     document.addInternalScript("var keyboardShortcuts = %s;" % (user.getPreference(db, "ui.keyboardShortcuts") and "true" or "false"))
 
     for stop in render(db, body, user, repository, review, changesets, commits, listed_commits, context_lines=context, conflicts=conflicts, moves=moves, compact=compact, wrap=wrap, tabify=tabify, profiler=profiler, rebases=rebases):
-        yield document.render(stop=stop, pretty=not compact)
+        yield document.stream(stop=stop, pretty=not compact)
 
     profiler.check("rendering")
     profiler.output(db, user, document)
 
     db.commit()
 
-    yield document.render(pretty=not compact)
+    yield document.stream(pretty=not compact)
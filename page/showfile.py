@@ -189,7 +189,7 @@ def renderShowFile(req, db, user):
 
     tbody = table.tbody("lines")
 
-    yield document.render(stop=tbody, pretty=not compact)
+    yield document.stream(stop=tbody, pretty=not compact)
 
     for linenr, line in enumerate(file.newLines(True)):
         linenr = linenr + 1
@@ -215,8 +215,8 @@ def renderShowFile(req, db, user):
         row.td("edge").text()
 
         if linenr % 500:
-            yield document.render(stop=tbody, pretty=not compact)
+            yield document.stream(stop=tbody, pretty=not compact)
 
     table.tbody('spacer bottom').tr('spacer bottom').td(colspan=8).text()
 
-    yield document.render(pretty=not compact)
+    yield document.stream(pretty=not compact)
@@ -282,7 +282,7 @@ def renderShowReview(req, db, user):
     body = html.body(onunload="void(0);")
 
     def flush(target=None):
-        return document.render(stop=target, pretty=not compact)
+        return document.stream(stop=target, pretty=not compact)
 
     def renderHeaderItems(target):
         has_draft_items = review_utils.renderDraftItems(db, user, review, target)
@@ -26,7 +26,7 @@ def renderStatistics(req, db, user):
     body = html.body()
 
     def flush(stop):
-        return document.render(stop=stop)
+        return document.stream(stop=stop)
 
     page.utils.generateHeader(body, db, user, current_page="statistics")
 
@@ -0,0 +1,48 @@
+/* -*- mode: js; indent-tabs-mode: nil -*-
+
+ Copyright 2012 Jens Lindström, Opera Software ASA
+
+ Licensed under the Apache License, Version 2.0 (the "License"); you may not
+ use this file except in compliance with the License.  You may obtain a copy of
+ the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+ WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+ License for the specific language governing permissions and limitations under
+ the License.
+
+*/
+
+/* Poll the changeset service until the changesets requested under 'ticket'
+   have been computed, and then reload the page to display them. */
+function waitForChangesets(ticket)
+{
+  function check()
+  {
+    var operation = new Operation({ action: "check changesets",
+                                    url: "checkchangesets",
+                                    data: { ticket: ticket },
+                                    callback: finished });
+
+    operation.execute();
+  }
+
+  function finished(result)
+  {
+    if (!result)
+      return;
+
+    if (result.pending == 0)
+      setTimeout(function () { location.reload(); }, 0);
+    else
+    {
+      $("#computing").text("Computing changes; " + result.finished + " of " + (result.finished + result.pending) + " changesets finished ...");
+      setTimeout(check, 1000);
+    }
+  }
+
+  $(function () { setTimeout(check, 1000); });
+}
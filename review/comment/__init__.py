@@ -98,10 +98,20 @@ class CommentChain:
         return self
 
     def loadComments(self, db, user, include_draft_comments=True):
+        CommentChain.loadCommentsForChains(db, [self], user, include_draft_comments)
+
+    @staticmethod
+    def loadCommentsForChains(db, chains, user, include_draft_comments=True):
+        """Load the comments of all the chains in 'chains' with one query."""
+
+        if not chains: return
+
         draft_user_id = user.id if include_draft_comments else None
+        chains_by_id = dict((chain.id, chain) for chain in chains)
 
         cursor = db.cursor()
-        cursor.execute("""SELECT comments.id,
+        cursor.execute("""SELECT comments.chain,
+                                 comments.id,
                                  comments.batch,
                                  comments.state,
                                  comments.uid,
@@ -111,16 +121,22 @@ class CommentChain:
                                  commentstoread.uid IS NOT NULL AS unread
                             FROM comments
                  LEFT OUTER JOIN commentstoread ON (comments.id=commentstoread.comment AND commentstoread.uid=%s)
-                           WHERE comments.chain=%s
+                           WHERE comments.chain=ANY (%s)
                              AND ((comments.state='draft' AND comments.uid=%s) OR comments.state='current')
                         ORDER BY time""",
-                       (user.id, self.id, draft_user_id))
-        last = None
-        for comment_id, batch_id, comment_state, user_id, time, comment, code, unread in cursor.fetchall():
-            comment = Comment(self, batch_id, comment_id, comment_state, dbutils.User.fromId(db, user_id), time, comment, code, unread)
-            if comment_state == 'draft': last = comment
-            else: self.comments.append(comment)
-        if last: self.comments.append(last)
+                       (user.id, chains_by_id.keys(), draft_user_id))
+        rows = cursor.fetchall()
+
+        dbutils.User.fromIds(db, list(set(row[4] for row in rows)))
+
+        drafts = {}
+        for chain_id, comment_id, batch_id, comment_state, user_id, time, comment, code, unread in rows:
+            chain = chains_by_id[chain_id]
+            comment = Comment(chain, batch_id, comment_id, comment_state, dbutils.User.fromId(db, user_id), time, comment, code, unread)
+            if comment_state == 'draft': drafts[chain_id] = comment
+            else: chain.comments.append(comment)
+        for chain_id, comment in drafts.items():
+            chains_by_id[chain_id].comments.append(comment)
 
     def when(self):
         return time.strftime("%Y-%m-%d %H:%M", self.comments[0].time.timetuple())
@@ -229,59 +245,94 @@ class CommentChain:
 
     @staticmethod
     def fromId(db, id, user, review=None, skip=None):
-        cursor = db.cursor()
-        cursor.execute("SELECT review, batch, uid, type, state, origin, file, first_commit, last_commit, closed_by, addressed_by FROM commentchains WHERE id=%s", [id])
-        row = cursor.fetchone()
-        if not row: return None
-        else:
-            review_id, batch_id, user_id, type, state, origin, file_id, first_commit_id, last_commit_id, closed_by_id, addressed_by_id = row
-            type_is_draft = False
-            state_is_draft = False
-
-            cursor.execute("""SELECT from_type, to_type, from_state, to_state, from_last_commit, to_last_commit
-                                FROM commentchainchanges
-                               WHERE chain=%s
-                                 AND uid=%s
-                                 AND state='draft'""",
-                           [id, user.id])
-
-            for from_type, to_type, from_state, to_state, from_last_commit_id, to_last_commit_id in cursor:
-                if from_state == state and from_last_commit_id == last_commit_id:
-                    state = to_state
-                    state_is_draft = True
-                    last_commit_id = to_last_commit_id
-                    if to_state != "open":
-                        closed_by_id = user.id
-                if from_type == type:
-                    type = to_type
-                    type_is_draft = True
+        chains = CommentChain.fromIds(db, [id], user, review, skip)
+        if chains: return chains[0]
+        else: return None
 
+    @staticmethod
+    def fromIds(db, ids, user, review=None, skip=None):
+        """Return a list of CommentChain objects for the chain ids in 'ids' (in
+           the same order, but skipping ids of chains that don't exist), with a
+           fixed number of queries regardless of the number of chains."""
+
+        if not ids: return []
+
+        cursor = db.cursor()
+        cursor.execute("SELECT id, review, batch, uid, type, state, origin, file, first_commit, last_commit, closed_by, addressed_by FROM commentchains WHERE id=ANY (%s)", (list(ids),))
+        rows = dict((row[0], list(row[1:])) for row in cursor)
+
+        cursor.execute("""SELECT chain, from_type, to_type, from_state, to_state, from_last_commit, to_last_commit
+                            FROM commentchainchanges
+                           WHERE chain=ANY (%s)
+                             AND uid=%s
+                             AND state='draft'""",
+                       (rows.keys(), user.id))
+
+        type_is_draft = set()
+        state_is_draft = set()
+
+        for chain_id, from_type, to_type, from_state, to_state, from_last_commit_id, to_last_commit_id in cursor:
+            row = rows[chain_id]
+            # Indexes in 'row': 3=type, 4=state, 8=last_commit, 9=closed_by.
+            if from_state == row[4] and from_last_commit_id == row[8]:
+                row[4] = to_state
+                state_is_draft.add(chain_id)
+                row[8] = to_last_commit_id
+                if to_state != "open":
+                    row[9] = user.id
+            if from_type == row[3]:
+                row[3] = to_type
+                type_is_draft.add(chain_id)
+
+        reviews = {}
+        if review is not None:
+            reviews[review.id] = review
+
+        user_ids = set()
+        commit_ids = {}
+
+        for chain_id, (review_id, batch_id, user_id, type, state, origin, file_id, first_commit_id, last_commit_id, closed_by_id, addressed_by_id) in rows.items():
             if review is None:
-                review = dbutils.Review.fromId(db, review_id, load_commits=False)
+                if review_id not in reviews:
+                    reviews[review_id] = dbutils.Review.fromId(db, review_id, load_commits=False)
             else:
                 assert review.id == review_id
 
+            user_ids.add(user_id)
+            if closed_by_id: user_ids.add(closed_by_id)
+
+            commit_ids.setdefault(review_id, set()).update(commit_id for commit_id in (first_commit_id, last_commit_id, addressed_by_id) if commit_id)
+
+        dbutils.User.fromIds(db, list(user_ids))
+
+        if not skip or 'commits' not in skip:
+            for review_id, review_commit_ids in commit_ids.items():
+                gitutils.Commit.fromIds(db, reviews[review_id].repository, list(review_commit_ids))
+
+        chains = {}
+
+        for chain_id, (review_id, batch_id, user_id, type, state, origin, file_id, first_commit_id, last_commit_id, closed_by_id, addressed_by_id) in rows.items():
+            chain_review = reviews[review_id]
             first_commit = last_commit = addressed_by = None
 
             if not skip or 'commits' not in skip:
-                if first_commit_id: first_commit = gitutils.Commit.fromId(db, review.repository, first_commit_id)
-                if last_commit_id: last_commit = gitutils.Commit.fromId(db, review.repository, last_commit_id)
-                if addressed_by_id: addressed_by = gitutils.Commit.fromId(db, review.repository, addressed_by_id)
+                if first_commit_id: first_commit = gitutils.Commit.fromId(db, chain_review.repository, first_commit_id)
+                if last_commit_id: last_commit = gitutils.Commit.fromId(db, chain_review.repository, last_commit_id)
+                if addressed_by_id: addressed_by = gitutils.Commit.fromId(db, chain_review.repository, addressed_by_id)
 
             if closed_by_id: closed_by = dbutils.User.fromId(db, closed_by_id)
             else: closed_by = None
 
-            chain = CommentChain(id, dbutils.User.fromId(db, user_id), review, batch_id, type, state, origin, file_id, first_commit, last_commit, closed_by, addressed_by, type_is_draft=type_is_draft, state_is_draft=state_is_draft)
+            chains[chain_id] = CommentChain(chain_id, dbutils.User.fromId(db, user_id), chain_review, batch_id, type, state, origin, file_id, first_commit, last_commit, closed_by, addressed_by, type_is_draft=chain_id in type_is_draft, state_is_draft=chain_id in state_is_draft)
 
-            if not skip or 'lines' not in skip:
-                cursor.execute("SELECT sha1, first_line, last_line FROM commentchainlines WHERE chain=%s AND (state='current' OR uid=%s)", (id, user.id))
-                for sha1, first_line, last_line in cursor.fetchall():
-                    chain.setLines(sha1, first_line, last_line - first_line + 1)
+        if not skip or 'lines' not in skip:
+            cursor.execute("SELECT chain, sha1, first_line, last_line FROM commentchainlines WHERE chain=ANY (%s) AND (state='current' OR uid=%s)", (chains.keys(), user.id))
+            for chain_id, sha1, first_line, last_line in cursor.fetchall():
+                chains[chain_id].setLines(sha1, first_line, last_line - first_line + 1)
 
-            return chain
+        return [chains[chain_id] for chain_id in ids if chain_id in chains]
 
 def loadCommentChains(db, review, user, file=None, changeset=None, commit=None, local_comments_only=False):
-    result = []
     cursor = db.cursor()
 
     chain_ids = None
@@ -327,19 +378,21 @@ def loadCommentChains(db, review, user, file=None, changeset=None, commit=None,
         if file is not None: files = [file]
         else: files = changeset.files
 
-        for file in files:
-            cursor.execute("""SELECT id
+        if files:
+            cursor.execute("""SELECT commentchains.id
                               FROM commentchains
                               JOIN commentchainlines ON (commentchainlines.chain=commentchains.id)
+                              JOIN (SELECT UNNEST(%s) AS file, UNNEST(%s) AS old_sha1, UNNEST(%s) AS new_sha1) AS versions
+                                ON (versions.file=commentchains.file)
                               WHERE commentchains.review=%s
-                                AND commentchains.file=%s
                                 AND commentchains.state!='empty'
                                 AND (commentchains.state!='draft' OR commentchains.uid=%s)
-                                AND (commentchainlines.sha1=%s
-                                  OR commentchainlines.sha1=%s)
+                                AND (commentchainlines.sha1=versions.old_sha1
+                                  OR commentchainlines.sha1=versions.new_sha1)
                                 AND (commentchainlines.state='current'
                                   OR commentchainlines.uid=%s)""",
-                           (review.id, file.id, user.id, file.old_sha1, file.new_sha1, user.id))
+                           ([file.id for file in files], [file.old_sha1 for file in files], [file.new_sha1 for file in files],
+                            review.id, user.id, user.id))
 
             for (chain_id,) in cursor.fetchall():
                 chain_ids.add(chain_id)
@@ -350,10 +403,8 @@ def loadCommentChains(db, review, user, file=None, changeset=None, commit=None,
         for (chain_id,) in cursor.fetchall():
             chain_ids.add(chain_id)
 
-    for chain_id in sorted(chain_ids):
-        chain = CommentChain.fromId(db, chain_id, user, review=review)
-        chain.loadComments(db, user)
-        result.append(chain)
+    result = CommentChain.fromIds(db, sorted(chain_ids), user, review=review)
+    CommentChain.loadCommentsForChains(db, result, user)
 
     return result
 
@@ -663,34 +714,62 @@ def updateCommentChains(db, user, review, changeset):
     commentchainlines_values = []
     addressed = set()
 
-    for file in changeset.files:
-        cursor.execute("""SELECT id, commentchains.uid, type, commentchains.state, first_line, last_line
-                          FROM commentchains
-                            INNER JOIN commentchainlines ON (id=chain)
-                          WHERE commentchains.review=%s
-                            AND commentchains.state in ('draft', 'open')
-                            AND commentchains.file=%s
-                            AND commentchainlines.sha1=%s
-                       ORDER BY commentchainlines.first_line""",
-                       [review.id, file.id, file.old_sha1])
+    files = dict((file.id, file) for file in changeset.files)
+
+    if not files:
+        return
+
+    # Open and draft comment chains in all the modified files, with the lines
+    # they are attached to in the old versions of the files.
+    cursor.execute("""SELECT commentchains.file, id, commentchains.uid, type, commentchains.state, first_line, last_line
+                        FROM commentchains
+                        JOIN commentchainlines ON (id=chain)
+                        JOIN (SELECT UNNEST(%s) AS file, UNNEST(%s) AS sha1) AS versions
+                          ON (versions.file=commentchains.file
+                          AND versions.sha1=commentchainlines.sha1)
+                       WHERE commentchains.review=%s
+                         AND commentchains.state in ('draft', 'open')
+                    ORDER BY commentchainlines.first_line""",
+                   [files.keys(), [file.old_sha1 for file in files.values()], review.id])
+
+    rows_per_file = {}
+    for row in cursor:
+        rows_per_file.setdefault(row[0], []).append(row[1:])
+
+    if not rows_per_file:
+        return
+
+    if len(changeset.child.parents) != 1:
+        # The chunks in the changeset are relative to the merge's parents, not
+        # to the changeset's parent; diff the affected files in one go.
+        chunks_per_file = {}
+        paths = dict((files[file_id].path, file_id) for file_id in rows_per_file)
+
+        for full_file in diff.parse.iterDifferences(review.repository, from_commit=changeset.parent, to_commit=changeset.child, filter_paths=sorted(paths)):
+            if full_file.path in paths:
+                chunks_per_file[paths[full_file.path]] = full_file.chunks
+            full_file.old_plain = full_file.new_plain = None
+    else:
+        chunks_per_file = dict((file_id, files[file_id].chunks) for file_id in rows_per_file)
 
-        rows = cursor.fetchall()
-        if not rows: continue
+    cursor.execute("SELECT chain, sha1 FROM commentchainlines WHERE chain=ANY (%s)",
+                   (list(set(row[0] for rows in rows_per_file.values() for row in rows)),))
+    existing_lines = set(cursor)
 
-        if len(changeset.child.parents) != 1:
-            full_file = diff.parse.parseDifferences(review.repository, from_commit=changeset.parent, to_commit=changeset.child, selected_path=file.path)
-            if not full_file: continue
-            chunks = full_file.chunks
-        else:
-            chunks = file.chunks
+    for file_id, rows in rows_per_file.items():
+        chunks = chunks_per_file.get(file_id)
+        if chunks is None: continue
+
+        file = files[file_id]
 
         for chain_id, chain_user_id, chain_type, chain_state, first_line, last_line in rows:
             verdict, new_first_line, new_last_line = updateCommentChain(first_line, last_line, chunks)
 
             if verdict == "modified" and chain_type == "issue": addressed.add(chain_id)
             elif verdict == "transfer":
-                cursor.execute("SELECT 1 FROM commentchainlines WHERE chain=%s AND sha1=%s", (chain_id, file.new_sha1))
-                if not cursor.fetchone():
+                if (chain_id, file.new_sha1) not in existing_lines:
+                    existing_lines.add((chain_id, file.new_sha1))
+
                     if chain_state == 'open':
                         lines_state = 'current'
                         lines_user_id = user.id
@@ -700,21 +779,22 @@ def updateCommentChains(db, user, review, changeset):
 
                     commentchainlines_values.append([chain_id, lines_user_id, lines_state, changeset.child.getId(db), file.new_sha1, new_first_line, new_last_line])
 
-    cursor.executemany("""INSERT INTO commentchainlines (chain, uid, state, commit, sha1, first_line, last_line)
-                          VALUES (%s, %s, %s, %s, %s, %s, %s)""",
-                       commentchainlines_values)
+    if commentchainlines_values:
+        cursor.copy_from("commentchainlines",
+                         ("chain", "uid", "state", "commit", "sha1", "first_line", "last_line"),
+                         commentchainlines_values)
 
     if addressed:
-        cursor.executemany("UPDATE commentchains SET state='addressed', addressed_by=%s WHERE id=%s AND state='open'", [[changeset.child.id, chain_id] for chain_id in addressed])
-        cursor.executemany("UPDATE commentchains SET addressed_by=%s WHERE id=%s AND state='draft'", [[changeset.child.id, chain_id] for chain_id in addressed])
+        cursor.execute("UPDATE commentchains SET state='addressed', addressed_by=%s WHERE id=ANY (%s) AND state='open'", [changeset.child.id, list(addressed)])
+        cursor.execute("UPDATE commentchains SET addressed_by=%s WHERE id=ANY (%s) AND state='draft'", [changeset.child.id, list(addressed)])
+
+        chains = [chain for chain in CommentChain.fromIds(db, sorted(addressed), user, review=review) if chain.state == 'addressed']
+        CommentChain.loadCommentsForChains(db, chains, user)
 
         print "Addressed issues:"
-        for chain_id in addressed:
-            chain = CommentChain.fromId(db, chain_id, user, review=review)
-            if chain.state == 'addressed':
-                chain.loadComments(db, user)
-                title = "  %s: " % chain.title(False)
-                print "%s%s" % (title, chain.leader(max_length=80 - len(title), text=True))
+        for chain in chains:
+            title = "  %s: " % chain.title(False)
+            print "%s%s" % (title, chain.leader(max_length=80 - len(title), text=True))
 
 def validateCommentChain(db, review, file_id, sha1, offset, count):
     """Check whether the commented lines are changed by later commits in the review.
@@ -22,6 +22,12 @@ class Filters:
         self.files = {}       # dict(file_id      -> dict(user_id -> tuple(filter_type, delegate)))
         self.paths = {}       # dict(directory_id -> tuple(set(directory_id), set(file_id))
 
+        # Users whose filters apply to each directory, including filters on
+        # parent directories, with more specific filters overriding less
+        # specific ones.  Computed on demand; dictionaries are shared between
+        # directories when a directory has no filters of its own.
+        self.effective = {}   # dict(directory_id -> dict(user_id -> tuple(filter_type, delegate)))
+
     def add(self, db, directory_id, file_id, filter_type, delegate, user_id):
         assert isinstance(directory_id, int)
         assert isinstance(file_id, int)
@@ -50,6 +56,8 @@ class Filters:
                     try: del self.files[file_id][user_id]
                     except: pass
 
+        self.effective = {}
+
         if file_id:
             data = self.files.get(file_id)
             if data is None:
@@ -66,6 +74,12 @@ class Filters:
         return bool(self.directories) or bool(self.files)
 
     def addFilters(self, db, filters, sort):
+        filters = list(filters)
+
+        # Look up the paths of all the filtered files up front, with a single
+        # query, instead of one at a time in add().
+        dbutils.explode_paths(db, [item[1] for item in filters if item[1]])
+
         if sort:
             sortedFilters = []
             for item in filters:
@@ -121,60 +135,65 @@ class Filters:
         else:
             loadGlobal(repository, recursive)
 
-    def __getUserFileAssociation(self, db, user_id, file_id):
-        user_id = int(user_id)
-        file_id = int(file_id)
+    def __getDirectoryUsers(self, path):
+        # 'path' is a list of directory ids from the root directory (0) down
+        # to the directory whose users are returned.
+        index = len(path)
+        while index and path[index - 1] not in self.effective:
+            index -= 1
 
-        data = self.files.get(file_id)
-        if data:
-            data = data.get(user_id)
-            if data: return data[0]
+        if index: users = self.effective[path[index - 1]]
+        else: users = {}
 
-        for directory_id in reversed([0] + dbutils.explode_path(db, file_id=file_id)):
+        for directory_id in path[index:]:
             data = self.directories.get(directory_id)
             if data:
-                data = data.get(user_id)
-                if data: return data[0]
+                users = users.copy()
+                users.update(data)
+            self.effective[directory_id] = users
 
-        return None
+        return users
 
-    def isReviewer(self, db, user_id, file_id):
-        return self.__getUserFileAssociation(db, user_id, file_id) == 'reviewer'
+    def __getFileUsers(self, file_id, path):
+        users = self.__getDirectoryUsers([0] + path)
 
-    def isWatcher(self, db, user_id, file_id):
-        return self.__getUserFileAssociation(db, user_id, file_id) == 'watcher'
+        data = self.files.get(file_id)
+        if data:
+            users = users.copy()
+            users.update(data)
 
-    def isRelevant(self, db, user_id, file_id):
-        return self.__getUserFileAssociation(db, user_id, file_id) is not None
+        return users
 
-    def isReviewer(self, db, user_id, file_id):
+    def __getUserFileAssociation(self, db, user_id, file_id):
         user_id = int(user_id)
         file_id = int(file_id)
 
-        data = self.files.get(file_id)
-        if data:
-            data = data.get(user_id)
-            if data: return data[0] == 'reviewer'
+        data = self.__getFileUsers(file_id, dbutils.explode_path(db, file_id=file_id)).get(user_id)
+        if data: return data[0]
+        else: return None
 
-        for directory_id in reversed([0] + dbutils.explode_path(db, file_id=file_id)):
-            data = self.directories.get(directory_id)
-            if data:
-                data = data.get(user_id)
-                if data: return data[0] == 'reviewer'
+    def isReviewer(self, db, user_id, file_id):
+        return self.__getUserFileAssociation(db, user_id, file_id) == 'reviewer'
 
-        return False
+    def isWatcher(self, db, user_id, file_id):
+        return self.__getUserFileAssociation(db, user_id, file_id) == 'watcher'
+
+    def isRelevant(self, db, user_id, file_id):
+        return self.__getUserFileAssociation(db, user_id, file_id) is not None
 
     def listUsers(self, db, file_id):
-        users = {}
+        return dict(self.__getFileUsers(file_id, dbutils.explode_path(db, file_id=file_id)))
 
-        for directory_id in [0] + dbutils.explode_path(db, file_id=file_id):
-            data = self.directories.get(directory_id)
-            if data: users.update(data)
+    def listUsersForFiles(self, db, file_ids):
+        """Return a dictionary mapping each file id in 'file_ids' to what
+           listUsers() would return for it.  The files' paths are looked up
+           with (at most) a single query."""
 
-        data = self.files.get(file_id)
-        if data: users.update(data)
+        if not self.hasFilters():
+            return dict((file_id, {}) for file_id in file_ids)
 
-        return users
+        return dict((file_id, dict(self.__getFileUsers(file_id, path)))
+                    for file_id, path in dbutils.explode_paths(db, file_ids).items())
 
     def getRelevantFiles(self, db, review):
         cursor = db.cursor()
@@ -182,8 +201,8 @@ class Filters:
 
         relevant = {}
 
-        for (file_id,) in cursor:
-            for user_id in self.listUsers(db, file_id).keys():
+        for file_id, users in self.listUsersForFiles(db, [file_id for (file_id,) in cursor]).items():
+            for user_id in users:
                 relevant.setdefault(user_id, set()).add(file_id)
 
         return relevant
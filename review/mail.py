@@ -52,10 +52,64 @@ def generateSubjectLine(db, user, review, item):
     try: return format % data
     except Exception, exc: return "%s (format: %r)" % (str(exc), format)
 
-def renderChainInMail(db, to_user, chain, focus_comment, new_state, new_type, line_length, context_lines):
+class MailCache(object):
+    """Cache of rendering work shared by the mails sent to all recipients.
+
+       One instance is used while generating the mails about one event (a
+       submitted batch, pushed commits or a created review.)  Values are
+       computed by the callback the first time a key is requested and reused
+       for every other recipient."""
+
+    def __init__(self):
+        self.__values = {}
+
+    def get(self, key, callback, *args):
+        try: return self.__values[key]
+        except KeyError:
+            value = self.__values[key] = callback(*args)
+            return value
+
+def getCommitDiff(db, cache, review, commit, context_lines):
+    def getChangesetId():
+        cursor = db.cursor()
+        cursor.execute("""SELECT id
+                            FROM reviewchangesets
+                            JOIN changesets ON (id=changeset)
+                           WHERE review=%s
+                             AND child=%s""", (review.id, commit.getId(db)))
+        return cursor.fetchone()[0]
+
+    changeset_id = cache.get(("changeset", commit.sha1), getChangesetId)
+
+    return cache.get(("diff", changeset_id, context_lines),
+                     lambda: changeset_text.unified(db, changeset_load.loadChangeset(db, review.repository, changeset_id), context_lines))
+
+def getCommitStats(cache, review, commit):
+    return cache.get(("stats", commit.sha1),
+                     lambda: review.repository.run("show", "--oneline", "--stat", commit.sha1).split('\n', 1)[1])
+
+def getAddressedChainIds(db, cache, review, commit_id):
+    def fetch():
+        cursor = db.cursor()
+        cursor.execute("SELECT id FROM commentchains WHERE review=%s AND state='addressed' AND addressed_by=%s", (review.id, commit_id))
+        return [chain_id for (chain_id,) in cursor]
+
+    return cache.get(("addressed", commit_id), fetch)
+
+def renderChainInMail(db, to_user, chain, focus_comment, new_state, new_type, line_length, context_lines, cache=None):
+    if cache is None: cache = MailCache()
+
+    urls = to_user.getCriticURLs(db)
+    mode = to_user.getPreference(db, "email.updatedReview.quotedComments")
+
+    key = ("chain", chain.id, chain.type, chain.state, len(chain.comments), focus_comment.id if focus_comment else None,
+           new_state, new_type, line_length, context_lines, tuple(urls), mode)
+
+    return cache.get(key, renderChain, db, cache, chain, focus_comment, new_state, new_type, line_length, context_lines, urls, mode)
+
+def renderChain(db, cache, chain, focus_comment, new_state, new_type, line_length, context_lines, urls, mode):
     result = ""
     hr = "-" * line_length
-    urls = to_user.getCriticURLs(db)
     url = "\n".join(["  %s/showcomment?chain=%d" % (url, chain.id) for url in urls])
 
     cursor = db.cursor()
@@ -88,23 +142,26 @@ def renderChainInMail(db, to_user, chain, focus_comment, new_state, new_type, li
                                  AND reviewchangesets.review=%s""",
                            [chain.file_id, chain.last_commit.getId(db), chain.review.id])
 
-        try: mode, sha1 = cursor.fetchone()
+        try: file_mode, sha1 = cursor.fetchone()
         except:
-            mode = None
+            file_mode = None
             sha1 = chain.lines_by_sha1.keys()[0]
 
         first_line, count = chain.lines_by_sha1[sha1]
 
-        context = changeset_utils.getCodeContext(db, sha1, first_line, minimized=True)
+        context = cache.get(("context", sha1, first_line), changeset_utils.getCodeContext, db, sha1, first_line, True)
         if context: result += "%s in %s, %s:\n%s\n%s\n" % (chain.type.capitalize(), path, context, url, hr)
         else: result += "%s in %s:\n%s\n%s\n" % (chain.type.capitalize(), path, url, hr)
 
-        try:
-            file = diff.File(id=chain.file_id, path=path, new_mode=mode, new_sha1=sha1, repository=chain.review.repository)
-            file.loadNewLines()
-            lines = file.newLines(False)
-        except:
-            raise Exception, repr((chain.id, file.id, mode, sha1))
+        def loadLines():
+            try:
+                file = diff.File(id=chain.file_id, path=path, new_mode=file_mode, new_sha1=sha1, repository=chain.review.repository)
+                file.loadNewLines()
+                return file.newLines(False)
+            except:
+                raise Exception, repr((chain.id, chain.file_id, file_mode, sha1))
+
+        lines = cache.get(("lines", chain.file_id, sha1), loadLines)
 
         last_line = first_line + count - 1
         first_line = max(1, first_line - context_lines)
@@ -129,8 +186,6 @@ def renderChainInMail(db, to_user, chain, focus_comment, new_state, new_type, li
     else:
         result += "General %s:\n%s\n%s\n" % (chain.type, url, hr)
 
-    mode = to_user.getPreference(db, "email.updatedReview.quotedComments")
-
     def formatComment(comment):
         return "%s at %s:\n%s\n" % (comment.user.fullname, comment.when(), textutils.reflow(comment.comment, line_length, indent=2))
 
@@ -195,10 +250,12 @@ def renderChainInMail(db, to_user, chain, focus_comment, new_state, new_type, li
 
     return result
 
-def sendReviewCreated(db, from_user, to_user, recipients, review):
+def sendReviewCreated(db, from_user, to_user, recipients, review, cache=None):
     # First check if the user has activated email sending at all.
     if not to_user.getPreference(db, "email.activated"): return []
 
+    if cache is None: cache = MailCache()
+
     line_length = to_user.getPreference(db, "email.lineLength")
     hr = "-" * line_length
 
@@ -270,7 +327,7 @@ the review is currently stuck; it cannot finish unless there are reviewers.
     pending_files_lines = cursor.fetchall()
 
     if pending_files_lines:
-        body += renderFiles(db, to_user, review, "These changes were assigned to you:", pending_files_lines, showcommit_link=True)
+        body += renderFiles(db, to_user, review, "These changes were assigned to you:", pending_files_lines, showcommit_link=True, cache=cache)
 
     all_commits = to_user.getPreference(db, "email.newReview.displayCommits")
 
@@ -294,15 +351,7 @@ the review is currently stuck; it cannot finish unless there are reviewers.
 
             for commit in commits:
                 if len(commit.parents) == 1:
-                    cursor.execute("""SELECT id
-                                        FROM reviewchangesets
-                                        JOIN changesets ON (id=changeset)
-                                       WHERE review=%s
-                                         AND child=%s""", (review.id, commit.getId(db)))
-
-                    (changeset_id,) = cursor.fetchone()
-
-                    diff = changeset_text.unified(db, changeset_load.loadChangeset(db, review.repository, changeset_id), contextLines)
+                    diff = getCommitDiff(db, cache, review, commit, contextLines)
                     diffs[commit] = diff
                     lines += diff.count("\n")
                     if lines > diffMaxLines:
@@ -315,7 +364,7 @@ the review is currently stuck; it cannot finish unless there are reviewers.
             lines = 0
 
             for commit in commits:
-                commit_stats = review.repository.run("show", "--oneline", "--stat", commit.sha1).split('\n', 1)[1]
+                commit_stats = getCommitStats(cache, review, commit)
                 stats[commit] = commit_stats
                 lines += commit_stats.count('\n')
                 if lines > statsMaxLines:
@@ -348,14 +397,26 @@ Author: %(author.fullname)s <%(author.email)s> at %(author.time)s
 
     return [sendMail(db, review, message_id, from_user, to_user, recipients, generateSubjectLine(db, to_user, review, 'newReview'), body)]
 
-def renderFiles(db, to_user, review, title, files_lines, commits=None, relevant_only=False, relevant_files=None, showcommit_link=False):
+def renderFiles(db, to_user, review, title, files_lines, commits=None, relevant_only=False, relevant_files=None, showcommit_link=False, cache=None):
+    if relevant_only:
+        files_lines = [(file_id, delete_count, insert_count) for file_id, delete_count, insert_count in files_lines if file_id in relevant_files]
+
+    if cache is None: cache = MailCache()
+
+    if showcommit_link: urls = tuple(to_user.getCriticURLs(db))
+    else: urls = None
+
+    key = ("files", title, tuple(files_lines), tuple(commits or ()), showcommit_link, urls)
+
+    return cache.get(key, renderFileList, db, review, title, files_lines, commits, showcommit_link, urls)
+
+def renderFileList(db, review, title, files_lines, commits, showcommit_link, urls):
     result = ""
     if files_lines:
         files = []
 
         for file_id, delete_count, insert_count in files_lines:
-            if not relevant_only or file_id in relevant_files:
-                files.append((dbutils.describe_file(db, file_id), delete_count, insert_count))
+            files.append((dbutils.describe_file(db, file_id), delete_count, insert_count))
 
         if files:
             paths = []
@@ -394,8 +455,6 @@ def renderFiles(db, to_user, review, title, files_lines, commits=None, relevant_
                     result += "  %s %s\n" % (commit.sha1[:8], commit.niceSummary())
 
             if showcommit_link:
-                urls = to_user.getCriticURLs(db)
-
                 try:
                     from_sha1, to_sha1 = showcommit_link
                     url_format = "  %%s/showcommit?review=%%d&from=%s&to=%s&filter=pending\n" % (from_sha1, to_sha1)
@@ -492,13 +551,100 @@ the review is currently stuck; it cannot finish unless there are reviewers.
 
     return [sendMail(db, review, message_id, review.owners[0], to_user, [to_user], generateSubjectLine(db, to_user, review, "newishReview"), body)]
 
-def sendReviewBatch(db, from_user, to_user, recipients, review, batch_id, was_accepted, is_accepted, profiler=None):
+class SubmittedBatch(object):
+    """The parts of a submitted batch that are the same in every recipient's mail."""
+
+    def __init__(self, db, review, batch_id, from_user, profiler=None):
+        cursor = db.cursor()
+
+        cursor.execute("SELECT comment FROM batches WHERE id=%s", [batch_id])
+        self.chain_id = cursor.fetchone()[0]
+
+        if self.chain_id is not None:
+            self.chain = review_comment.CommentChain.fromId(db, self.chain_id, from_user, review=review)
+            self.chain.loadComments(db, from_user)
+        else:
+            self.chain = None
+
+        if profiler: profiler.check("generate mail: batch chain")
+
+        def fetchFilesLines(to_state):
+            cursor.execute("""SELECT reviewfiles.file, SUM(reviewfiles.deleted), SUM(reviewfiles.inserted)
+                                FROM reviewfiles
+                                JOIN reviewfilechanges ON (reviewfilechanges.file=reviewfiles.id)
+                               WHERE reviewfilechanges.batch=%s
+                                 AND reviewfilechanges.to=%s
+                            GROUP BY reviewfiles.file""",
+                           (batch_id, to_state))
+            return cursor.fetchall()
+
+        def fetchCommits(to_state):
+            cursor.execute("""SELECT DISTINCT changesets.child
+                                FROM reviewfiles
+                                JOIN reviewfilechanges ON (reviewfilechanges.file=reviewfiles.id)
+                                JOIN changesets ON (changesets.id=reviewfiles.changeset)
+                               WHERE reviewfilechanges.batch=%s
+                                 AND reviewfilechanges.to=%s""",
+                           (batch_id, to_state))
+            return cursor.fetchall()
+
+        self.reviewed_files_lines = fetchFilesLines('reviewed')
+        self.reviewed_commits = fetchCommits('reviewed')
+        self.unreviewed_files_lines = fetchFilesLines('pending')
+        self.unreviewed_commits = fetchCommits('pending')
+
+        if profiler: profiler.check("generate mail: files/lines and commits")
+
+        cursor.execute("SELECT id FROM commentchains WHERE batch=%s AND type='issue' ORDER BY id ASC", [batch_id])
+        new_issue_ids = [chain_id for (chain_id,) in cursor if chain_id != self.chain_id]
+
+        cursor.execute("SELECT id FROM commentchains WHERE batch=%s AND type='note' ORDER BY id ASC", [batch_id])
+        new_note_ids = [chain_id for (chain_id,) in cursor if chain_id != self.chain_id]
+
+        cursor.execute("""SELECT commentchains.id, comments.id, commentchainchanges.to_state, commentchainchanges.to_type
+                            FROM commentchains
+                 LEFT OUTER JOIN comments ON (commentchains.id=comments.chain
+                                          AND comments.batch=%s)
+                 LEFT OUTER JOIN commentchainchanges ON (commentchains.id=commentchainchanges.chain
+                                                     AND commentchainchanges.batch=%s)
+                           WHERE commentchains.review=%s
+                             AND commentchains.batch!=%s""",
+                       [batch_id, batch_id, review.id, batch_id])
+
+        additional = [(chain_id, new_state, new_type)
+                      for chain_id, comment_id, new_state, new_type in cursor.fetchall()
+                      if comment_id is not None or new_state is not None or new_type is not None]
+
+        chain_ids = set(new_issue_ids) | set(new_note_ids) | set(chain_id for chain_id, new_state, new_type in additional)
+        chains = dict((chain.id, chain) for chain in review_comment.CommentChain.fromIds(db, sorted(chain_ids), from_user, review=review))
+
+        review_comment.CommentChain.loadCommentsForChains(db, chains.values(), from_user)
+
+        self.new_issues = [(chains[chain_id], None, None) for chain_id in new_issue_ids]
+        self.new_notes = [(chains[chain_id], None, None) for chain_id in new_note_ids]
+        self.additional_comments = [(chains[chain_id], new_state, new_type) for chain_id, new_state, new_type in additional]
+
+        # Users associated with each comment chain in a file, for recipients
+        # that only want mails about changes relevant to them.
+        self.chain_users = {}
+
+        file_chain_ids = [chain_id for chain_id, chain in chains.items() if chain.file_id is not None]
+        if file_chain_ids:
+            cursor.execute("SELECT chain, uid FROM commentchainusers WHERE chain=ANY (%s)", (file_chain_ids,))
+            for chain_id, user_id in cursor:
+                self.chain_users.setdefault(chain_id, set()).add(user_id)
+
+        if profiler: profiler.check("generate mail: comment chains")
+
+def sendReviewBatch(db, from_user, to_user, recipients, review, batch_id, was_accepted, is_accepted, profiler=None, cache=None):
     if profiler: profiler.check("generate mail: start")
 
     # First check if the user has activated email sending at all.
     if not to_user.getPreference(db, "email.activated"): return []
     if from_user == to_user and to_user.getPreference(db, "email.ignoreOwnChanges"): return []
 
+    if cache is None: cache = MailCache()
+
     cursor = db.cursor()
 
     line_length = to_user.getPreference(db, "email.lineLength")
@@ -522,57 +668,10 @@ def sendReviewBatch(db, from_user, to_user, recipients, review, batch_id, was_ac
 
     if profiler: profiler.check("generate mail: get relevant files")
 
-    cursor.execute("SELECT comment FROM batches WHERE id=%s", [batch_id])
-    batch_chain_id = cursor.fetchone()[0]
-
-    if profiler: profiler.check("generate mail: batch chain")
-
-    cursor.execute("""SELECT reviewfiles.file, SUM(reviewfiles.deleted), SUM(reviewfiles.inserted)
-                        FROM reviewfiles
-                        JOIN reviewfilechanges ON (reviewfilechanges.file=reviewfiles.id)
-                       WHERE reviewfilechanges.batch=%s
-                         AND reviewfilechanges.to='reviewed'
-                    GROUP BY reviewfiles.file""",
-                       (batch_id,))
-    reviewed_files_lines = cursor.fetchall()
-
-    if profiler: profiler.check("generate mail: reviewed files/lines")
-
-    cursor.execute("""SELECT DISTINCT changesets.child
-                        FROM reviewfiles
-                        JOIN reviewfilechanges ON (reviewfilechanges.file=reviewfiles.id)
-                        JOIN changesets ON (changesets.id=reviewfiles.changeset)
-                       WHERE reviewfilechanges.batch=%s
-                         AND reviewfilechanges.to='reviewed'""",
-                       (batch_id,))
-    reviewed_commits = cursor.fetchall()
-
-    if profiler: profiler.check("generate mail: reviewed commits")
-
-    cursor.execute("""SELECT reviewfiles.file, SUM(reviewfiles.deleted), SUM(reviewfiles.inserted)
-                        FROM reviewfiles
-                        JOIN reviewfilechanges ON (reviewfilechanges.file=reviewfiles.id)
-                       WHERE reviewfilechanges.batch=%s
-                         AND reviewfilechanges.to='pending'
-                    GROUP BY reviewfiles.file""",
-                   (batch_id,))
-    unreviewed_files_lines = cursor.fetchall()
+    batch = cache.get(("batch", batch_id), SubmittedBatch, db, review, batch_id, from_user, profiler)
 
-    if profiler: profiler.check("generate mail: unreviewed files/lines")
-
-    cursor.execute("""SELECT DISTINCT changesets.child
-                        FROM reviewfiles
-                        JOIN reviewfilechanges ON (reviewfilechanges.file=reviewfiles.id)
-                        JOIN changesets ON (changesets.id=reviewfiles.changeset)
-                       WHERE reviewfilechanges.batch=%s
-                         AND reviewfilechanges.to='pending'""",
-                       (batch_id,))
-    unreviewed_commits = cursor.fetchall()
-
-    if profiler: profiler.check("generate mail: unreviewed commits")
-
-    reviewed_files = renderFiles(db, to_user, review, "Reviewed Files:", reviewed_files_lines, reviewed_commits, relevant_only, relevant_files)
-    unreviewed_files = renderFiles(db, to_user, review, "Unreviewed Files:", unreviewed_files_lines, unreviewed_commits, relevant_only, relevant_files)
+    reviewed_files = renderFiles(db, to_user, review, "Reviewed Files:", batch.reviewed_files_lines, batch.reviewed_commits, relevant_only, relevant_files, cache=cache)
+    unreviewed_files = renderFiles(db, to_user, review, "Unreviewed Files:", batch.unreviewed_files_lines, batch.unreviewed_commits, relevant_only, relevant_files, cache=cache)
 
     if profiler: profiler.check("generate mail: render files")
 
@@ -582,52 +681,19 @@ def sendReviewBatch(db, from_user, to_user, recipients, review, batch_id, was_ac
 
     def isRelevantComment(chain):
         if chain.file_id is None or chain.file_id in relevant_files: return True
+        return to_user.id in batch.chain_users.get(chain.id, ())
+
+    def filterCommentChains(chains):
+        if relevant_only:
+            return [(chain, new_state, new_type) for chain, new_state, new_type in chains if isRelevantComment(chain)]
+        else:
+            return chains
 
-        cursor.execute("SELECT 1 FROM commentchainusers WHERE chain=%s AND uid=%s", (chain.id, to_user.id))
-        return cursor.fetchone() is not None
-
-    def fetchNewCommentChains():
-        chains = []
-        for (chain_id,) in cursor.fetchall():
-            if chain_id != batch_chain_id:
-                chain = review_comment.CommentChain.fromId(db, chain_id, from_user, review=review)
-                if not relevant_only or isRelevantComment(chain):
-                    chain.loadComments(db, from_user)
-                    chains.append((chain, None, None))
-        return chains
-
-    def fetchAdditionalCommentChains():
-        chains = []
-        for chain_id, comment_id, new_state, new_type in cursor.fetchall():
-            if comment_id is not None or new_state is not None or new_type is not None:
-                chain = review_comment.CommentChain.fromId(db, chain_id, from_user, review=review)
-                if not relevant_only or isRelevantComment(chain):
-                    chain.loadComments(db, from_user)
-                    chains.append((chain, new_state, new_type))
-        return chains
-
-    cursor.execute("SELECT id FROM commentchains WHERE batch=%s AND type='issue' ORDER BY id ASC", [batch_id])
-    new_issues = fetchNewCommentChains()
-
-    if profiler: profiler.check("generate mail: new issues")
-
-    cursor.execute("SELECT id FROM commentchains WHERE batch=%s AND type='note' ORDER BY id ASC", [batch_id])
-    new_notes = fetchNewCommentChains()
-
-    if profiler: profiler.check("generate mail: new notes")
-
-    cursor.execute("""SELECT commentchains.id, comments.id, commentchainchanges.to_state, commentchainchanges.to_type
-                        FROM commentchains
-             LEFT OUTER JOIN comments ON (commentchains.id=comments.chain
-                                      AND comments.batch=%s)
-             LEFT OUTER JOIN commentchainchanges ON (commentchains.id=commentchainchanges.chain
-                                                 AND commentchainchanges.batch=%s)
-                       WHERE commentchains.review=%s
-                         AND commentchains.batch!=%s""",
-                   [batch_id, batch_id, review.id, batch_id])
-    additional_comments = fetchAdditionalCommentChains()
-
-    if profiler: profiler.check("generate mail: additional comments")
+    new_issues = filterCommentChains(batch.new_issues)
+    new_notes = filterCommentChains(batch.new_notes)
+    additional_comments = filterCommentChains(batch.additional_comments)
+
+    if profiler: profiler.check("generate mail: filter comment chains")
 
     if is_accepted != was_accepted and not reviewed_files and not unreviewed_files and not new_issues and not new_notes and not additional_comments:
         return []
@@ -646,18 +712,13 @@ This is an automatic message generated by the review at:
 
 """ % data
 
-    if batch_chain_id is not None:
-        batch_chain = review_comment.CommentChain.fromId(db, batch_chain_id, from_user, review=review)
-    else:
-        batch_chain = None
+    batch_chain = batch.chain
 
     data["batch.author.fullname"] = from_user.fullname
 
     first_name = from_user.getFirstName()
 
     if batch_chain is not None:
-        batch_chain.loadComments(db, from_user)
-
         comment_ids.add(batch_chain.comments[0].id)
 
         remark = """%s'%s comment:
@@ -696,7 +757,7 @@ This is an automatic message generated by the review at:
                 else:
                     focus_comment = None
                 if focus_comment is not None or new_state is not None or new_type is not None:
-                    result += renderChainInMail(db, to_user, chain, focus_comment, new_state, new_type, line_length, context_lines) + "\n\n"
+                    result += renderChainInMail(db, to_user, chain, focus_comment, new_state, new_type, line_length, context_lines, cache) + "\n\n"
                 if focus_comment is not None:
                     comment_ids.add(focus_comment.id)
         return result
@@ -780,11 +841,13 @@ This is an automatic message generated by the review at:
 
     return files
 
-def sendReviewAddedCommits(db, from_user, to_user, recipients, review, changesets, tracked_branch=False):
+def sendReviewAddedCommits(db, from_user, to_user, recipients, review, changesets, tracked_branch=False, cache=None):
     # First check if the user has activated email sending at all.
     if not to_user.getPreference(db, "email.activated"): return []
     if from_user == to_user and to_user.getPreference(db, "email.ignoreOwnChanges"): return []
 
+    if cache is None: cache = MailCache()
+
     line_length = to_user.getPreference(db, "email.lineLength")
     hr = "-" * line_length
     relevant_only = to_user not in review.owners and to_user != from_user and to_user.getPreference(db, "email.updatedReview.relevantChangesOnly")
@@ -805,12 +868,11 @@ def sendReviewAddedCommits(db, from_user, to_user, recipients, review, changeset
                     relevant_commits.add(changeset.child.getId(db))
                     break
             else:
-                cursor.execute("SELECT id FROM commentchains WHERE review=%s AND state='addressed' AND addressed_by=%s", (review.id, changeset.child.getId(db)))
-                for chain_id in cursor.fetchall():
-                    cursor.execute("SELECT 1 FROM commentchainusers WHERE chain=%s AND uid=%s", (chain_id, to_user.id))
+                chain_ids = getAddressedChainIds(db, cache, review, changeset.child.getId(db))
+                if chain_ids:
+                    cursor.execute("SELECT 1 FROM commentchainusers WHERE chain=ANY (%s) AND uid=%s LIMIT 1", (chain_ids, to_user.id))
                     if cursor.fetchone():
                         relevant_commits.add(changeset.child.getId(db))
-                        break
 
         if not relevant_commits:
             return []
@@ -868,7 +930,7 @@ This is an automatic message generated by the review at:
         else:
             showcommit_link = False
 
-        body += renderFiles(db, to_user, review, "These changes were assigned to you:", pending_files_lines, showcommit_link=showcommit_link)
+        body += renderFiles(db, to_user, review, "These changes were assigned to you:", pending_files_lines, showcommit_link=showcommit_link, cache=cache)
 
     all_commits = to_user.getPreference(db, "email.updatedReview.displayCommits")
     context_lines = to_user.getPreference(db, "email.comment.contextLines")
@@ -891,15 +953,7 @@ This is an automatic message generated by the review at:
 
             for commit in commits:
                 if len(commit.parents) == 1 and (relevant_commits is None or commit.getId(db) in relevant_commits):
-                    cursor.execute("""SELECT id
-                                        FROM reviewchangesets
-                                        JOIN changesets ON (id=changeset)
-                                       WHERE review=%s
-                                         AND child=%s""", (review.id, commit.getId(db)))
-
-                    (changeset_id,) = cursor.fetchone()
-
-                    diff = changeset_text.unified(db, changeset_load.loadChangeset(db, review.repository, changeset_id), contextLines)
+                    diff = getCommitDiff(db, cache, review, commit, contextLines)
                     diffs[commit] = diff
                     lines += diff.count("\n")
                     if lines > diffMaxLines:
@@ -912,7 +966,7 @@ This is an automatic message generated by the review at:
             lines = 0
 
             for commit in commits:
-                commit_stats = review.repository.run("show", "--oneline", "--stat", commit.sha1).split('\n', 1)[1]
+                commit_stats = getCommitStats(cache, review, commit)
                 stats[commit] = commit_stats
                 lines += commit_stats.count('\n')
                 if lines > statsMaxLines:
@@ -938,14 +992,10 @@ Author: %(author.fullname)s <%(author.email)s> at %(author.time)s
             if diffs and commit in diffs:
                 body += "\n" + diffs[commit]
 
-            cursor.execute("SELECT id FROM commentchains WHERE review=%s AND state='addressed' AND addressed_by=%s", (review.id, commit.getId(db)))
-            rows = cursor.fetchall()
-
-            if rows:
-                for (chain_id,) in rows:
-                    chain = review_comment.CommentChain.fromId(db, chain_id, to_user, review=review)
-                    chain.loadComments(db, to_user, include_draft_comments=False)
-                    body += "\n\n" + renderChainInMail(db, to_user, chain, None, "addressed", None, line_length, context_lines)
+            for chain_id in getAddressedChainIds(db, cache, review, commit.getId(db)):
+                chain = review_comment.CommentChain.fromId(db, chain_id, to_user, review=review)
+                chain.loadComments(db, to_user, include_draft_comments=False)
+                body += "\n\n" + renderChainInMail(db, to_user, chain, None, "addressed", None, line_length, context_lines, cache)
 
     cursor.execute("SELECT messageid FROM reviewmessageids WHERE uid=%s AND review=%s", [to_user.id, review.id])
     row = cursor.fetchone()
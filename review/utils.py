@@ -76,17 +76,25 @@ is used as a key in the dictionary instead of a real user ID."""
     reviewers = {}
     watchers = {}
 
+    changeset_file_ids = {}
+
+    cursor.execute("SELECT DISTINCT changeset, file FROM fileversions WHERE changeset=ANY (%s)",
+                   ([changeset.id for changeset in changesets],))
+
+    for changeset_id, file_id in cursor:
+        changeset_file_ids.setdefault(changeset_id, []).append(file_id)
+
+    file_users = filters.listUsersForFiles(db, set(file_id for file_ids in changeset_file_ids.values() for file_id in file_ids))
+
     for changeset in changesets:
         author_user_id = changeset.child.author.getUserId(db) if changeset.child else None
 
-        cursor.execute("SELECT DISTINCT file FROM fileversions WHERE changeset=%s", (changeset.id,))
-
-        for (file_id,) in cursor:
+        for file_id in changeset_file_ids.get(changeset.id, []):
             reviewers_found = False
 
-            for user_id, (filter_type, delegate) in filters.listUsers(db, file_id).items():
+            for user_id, (filter_type, delegate) in file_users[file_id].items():
                 try: assert isinstance(user_id, int)
-                except: raise Exception, repr(filters.listUsers(db, file_id))
+                except: raise Exception, repr(file_users[file_id])
 
                 if filter_type == 'reviewer':
                     if author_user_id != user_id:
@@ -231,7 +239,7 @@ def assignChanges(db, user, review, commits=None, changesets=None, update=False,
                     reviewusers_values.add((review.id, user_id))
                 for changeset_id in user_changesets:
                     if (user_id, changeset_id, file_id) not in reviewuserfiles_existing:
-                        reviewuserfiles_values.add((user_id, review.id, changeset_id, file_id))
+                        reviewuserfiles_values.add((user_id, changeset_id, file_id))
 
     for file_id, file_users in watchers.items():
         for user_id, user_changesets in file_users.items():
@@ -245,7 +253,23 @@ def assignChanges(db, user, review, commits=None, changesets=None, update=False,
     new_watchers -= old_reviewers | new_reviewers
 
     cursor.executemany("INSERT INTO reviewusers (review, uid) VALUES (%s, %s)", reviewusers_values)
-    cursor.executemany("INSERT INTO reviewuserfiles (file, uid) SELECT id, %s FROM reviewfiles WHERE review=%s AND changeset=%s AND file=%s", reviewuserfiles_values)
+
+    if reviewuserfiles_values:
+        # Map the (changeset, file) pairs to review files with one join,
+        # rather than with one sub-query per assigned (user, changeset, file).
+        # The table is dropped when the transaction ends even if something
+        # below fails and the connection is then used for something else.
+        cursor.execute("CREATE TEMPORARY TABLE assignedchanges (uid INTEGER, changeset INTEGER, file INTEGER) ON COMMIT DROP")
+        cursor.copy_from("assignedchanges", ("uid", "changeset", "file"), reviewuserfiles_values)
+        cursor.execute("ANALYZE assignedchanges")
+        cursor.execute("""INSERT INTO reviewuserfiles (file, uid)
+                               SELECT reviewfiles.id, assignedchanges.uid
+                                 FROM assignedchanges
+                                 JOIN reviewfiles ON (reviewfiles.changeset=assignedchanges.changeset
+                                                  AND reviewfiles.file=assignedchanges.file)
+                                WHERE reviewfiles.review=%s""",
+                       (review.id,))
+        cursor.execute("DROP TABLE assignedchanges")
 
     return new_reviewers, new_watchers
 
@@ -403,8 +427,9 @@ Please confirm that this is intended by loading:
 
     if not new_review and notify_changesets:
         recipients = review.getRecipients(db)
+        cache = mail.MailCache()
         for to_user in recipients:
-            pending_mails.extend(mail.sendReviewAddedCommits(db, user, to_user, recipients, review, notify_changesets, tracked_branch=tracked_branch))
+            pending_mails.extend(mail.sendReviewAddedCommits(db, user, to_user, recipients, review, notify_changesets, tracked_branch=tracked_branch, cache=cache))
 
     mail.sendPendingMails(pending_mails)
 
@@ -489,8 +514,9 @@ using the command<p>
 
         pending_mails = []
         recipients = review.getRecipients(db)
+        cache = mail.MailCache()
         for to_user in recipients:
-            pending_mails.extend(mail.sendReviewCreated(db, user, to_user, recipients, review))
+            pending_mails.extend(mail.sendReviewCreated(db, user, to_user, recipients, review, cache=cache))
 
         db.commit()
 
@@ -708,7 +734,10 @@ def addReviewFilters(db, creator, user, review, reviewer_directory_ids, reviewer
                              AND reviewuserfiles.uid=%s""",
                        (review.id, user.id))
 
-        for review_file_id, file_id in cursor:
+        rows = cursor.fetchall()
+        dbutils.explode_paths(db, [file_id for review_file_id, file_id in rows])
+
+        for review_file_id, file_id in rows:
             if not filters.isReviewer(db, user.id, file_id):
                 delete_files.add(review_file_id)
 
@@ -726,7 +755,10 @@ def addReviewFilters(db, creator, user, review, reviewer_directory_ids, reviewer
                              AND reviewuserfiles.uid IS NULL""",
                        (user.id, review.id, user.id))
 
-        for review_file_id, file_id in cursor:
+        rows = cursor.fetchall()
+        dbutils.explode_paths(db, [file_id for review_file_id, file_id in rows])
+
+        for review_file_id, file_id in rows:
             if filters.isReviewer(db, user.id, file_id):
                 insert_files.add(review_file_id)
 
@@ -853,8 +885,9 @@ def generateMailsForBatch(db, batch_id, was_accepted, is_accepted, profiler=None
     pending_mails = []
 
     recipients = review.getRecipients(db)
+    cache = mail.MailCache()
     for to_user in recipients:
-        pending_mails.extend(mail.sendReviewBatch(db, from_user, to_user, recipients, review, batch_id, was_accepted, is_accepted, profiler=profiler))
+        pending_mails.extend(mail.sendReviewBatch(db, from_user, to_user, recipients, review, batch_id, was_accepted, is_accepted, profiler=profiler, cache=cache))
 
     return pending_mails
 
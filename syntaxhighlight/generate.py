@@ -30,11 +30,22 @@ def createHighlighter(language):
     highlighter = generic.HighlightGeneric.create(language)
     if highlighter: return highlighter
 
-def generateHighlight(repository_path, sha1, language, output_file=None):
+# Repositories by path, kept for the lifetime of the process so that their
+# 'git cat-file --batch' processes can be reused for all highlighted blobs.
+repositories = {}
+
+def getRepository(repository_path):
+    repository = repositories.get(repository_path)
+    if not repository:
+        repository = repositories[repository_path] = gitutils.Repository(path=repository_path)
+    return repository
+
+def generateHighlight(repository_path, sha1, language, output_file=None, source=None):
     highlighter = createHighlighter(language)
     if not highlighter: return False
 
-    source = gitutils.Repository.readObject(repository_path, "blob", sha1)
+    if source is None:
+        source = getRepository(repository_path).fetch(sha1).data
 
     if output_file:
         highlighter(source, output_file, None)
@@ -57,3 +68,26 @@ def generateHighlight(repository_path, sha1, language, output_file=None):
         os.rename(output_path + ".tmp", output_path)
 
     return True
+
+def generateHighlights(repository_path, blobs):
+    """Highlight several blobs from one repository.
+
+       The 'blobs' argument is a list of (sha1, language) tuples.  All the
+       blobs are read from the repository in one batch.  Yields the return
+       value of generateHighlight() for each blob, in order, as each blob is
+       highlighted."""
+
+    repository = getRepository(repository_path)
+    wanted = [sha1 for sha1, language in blobs if createHighlighter(language)]
+    git_objects = repository.iterfetch(wanted)
+
+    try:
+        for sha1, language in blobs:
+            if createHighlighter(language):
+                yield generateHighlight(repository_path, sha1, language, source=git_objects.next().data)
+            else:
+                yield False
+    finally:
+        # Release the repository's batch process even if highlighting failed
+        # and the traceback keeps this generator alive.
+        git_objects.close()
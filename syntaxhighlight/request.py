@@ -17,12 +17,15 @@
 import configuration
 import syntaxhighlight
 import socket
+import background.utils
 
 try: from json import dumps as json_encode, loads as json_decode
 except: from cjson import encode as json_encode, decode as json_decode
 
-def requestHighlights(repository, sha1s):
-    requests = [{ "repository_path": repository.path, "sha1": sha1, "path": path, "language": language }
+def requestHighlights(repository, sha1s, priority=None):
+    if priority is None: priority = background.utils.getDefaultPriority()
+
+    requests = [{ "repository_path": repository.path, "sha1": sha1, "path": path, "language": language, "priority": priority }
                 for sha1, (path, language) in sha1s.items()
                 if not syntaxhighlight.isHighlighted(sha1, language)]
 